@@ -0,0 +1,821 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import batched
+
+import numpy as np
+
+from data.ann import IVFIndex
+from data.benchmark import (
+    synthetic_movies, synthetic_queries, synthetic_embeddings, rss_mb, peak_rss_mb, private_rss_mb, timed, latency_percentiles,
+    top_k_overlap
+)
+from data.definitions import (
+    BM25_WINDOW, EMBED_BATCH_SIZE, QUERY_BATCH_SIZE, QUERY_BATCH_WAIT_MS, QUERY_PRECISIONS, RESCORE_CANDIDATES, SEMANTIC_CHUNK_OVERLAP,
+    SEMANTIC_CHUNK_SIZE, SEMANTIC_MODEL
+)
+from data.document_store import DOCUMENTS_FILE, DocumentStore, write_document_store
+from data.embedding_store import EmbeddingStore
+from data.inverted_index import InvertedIndex, INDEX_FILE
+from data.movies import MovieStream
+from data.quantization import QuantizedVectors, STORAGE_MODES
+from data.query_cache import QueryCache
+from data.sharding import ShardedSearch, build_keyword_shards, build_semantic_shards
+from data.utils import Tokenizer, get_semantic_chunks_from_str
+from data.vectors import cosine_similarity, normalize_rows, cosine_top_k, cosine_top_k_many
+
+
+def measure_index_load(cache_dir, index_format, queries):
+    """Runs in a fresh process: load the index, run the queries, report time and RSS growth."""
+    baseline_rss = rss_mb()
+    index = InvertedIndex(Tokenizer(), cache_dir)
+    _, load_time = timed(index.load if index_format == "binary" else index.load_pickle)
+    load_rss = rss_mb()
+
+    _, query_time = timed(lambda: [index.bm25_search(query, 5) for query in queries])
+    return load_time, query_time / len(queries), load_rss - baseline_rss, rss_mb() - baseline_rss
+
+
+def index_load(docs, query_count):
+    movies = synthetic_movies(docs)
+    queries = synthetic_queries(movies, query_count)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        index = InvertedIndex(Tokenizer(), cache_dir)
+        index.build(movies)
+        index.save_pickle()
+        index.save()
+        del index, movies
+
+        pickle_size = sum(
+            os.path.getsize(os.path.join(cache_dir, name))
+            for name in ("index.pkl", "docmap.pkl", "term_frequencies.pkl", "doc_lengths.pkl"))
+        binary_size = os.path.getsize(os.path.join(cache_dir, INDEX_FILE))
+
+        print(f"{docs} documents, {query_count} queries")
+        print(f"{'format':<8} {'size (MB)':>10} {'load (ms)':>10} {'query (ms)':>11} {'RSS load (MB)':>14} {'RSS query (MB)':>15}")
+        context = multiprocessing.get_context("spawn")
+        for index_format, size in (("pickle", pickle_size), ("binary", binary_size)):
+            with context.Pool(1) as pool:
+                load_time, query_time, load_rss, query_rss = pool.apply(
+                    measure_index_load, (cache_dir, index_format, queries))
+            print(f"{index_format:<8} {size / 2**20:>10.1f} {load_time * 1000:>10.1f} {query_time * 1000:>11.2f} {load_rss:>14.1f} {query_rss:>15.1f}")
+
+
+def build(docs, workers):
+    movies = synthetic_movies(docs)
+    tokenizer = Tokenizer()
+
+    print(f"{docs} documents, {os.cpu_count()} CPUs")
+    print(f"{'workers':>7} {'build (s)':>10} {'speedup':>8} {'identical':>10}")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        serial = None
+        for count in workers:
+            index = InvertedIndex(tokenizer, cache_dir)
+            _, build_time = timed(index.build, movies, count)
+            index.save()
+            with open(os.path.join(cache_dir, INDEX_FILE), "br") as f:
+                data = f.read()
+            if serial is None:
+                serial = (build_time, data)
+            print(f"{count:>7} {build_time:>10.2f} {serial[0] / build_time:>7.2f}x {str(data == serial[1]):>10}")
+
+
+def bm25_pruning(docs, query_count, limit, window):
+    movies = synthetic_movies(docs)
+    rng = random.Random(0)
+    words = [query.split() for query in synthetic_queries(movies, query_count * 4)]
+    query_sets = {
+        "short": [" ".join(rng.sample(pool, min(2, len(pool)))) for pool in words[:query_count]],
+        "long": [" ".join(sum(words[i:i + 4], [])[:16]) for i in range(0, query_count * 4, 4)],
+    }
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        index = InvertedIndex(Tokenizer(), cache_dir)
+        index.build(movies)
+        index.save()
+        index.load()
+        scorer = index.scorer
+
+        print(f"{docs} documents, {query_count} queries per set, top {limit}, windows of {window} rows")
+        print(f"{'queries':<8} {'tokens':>7} {'exhaustive (ms/q)':>18} {'docs scored':>12} {'pruned (ms/q)':>14} {'docs scored':>12} {'identical':>10}")
+        for name, queries in query_sets.items():
+            tokens = [index.tokenizer.tokenize_str(query) for query in queries]
+            exhaustive, exhaustive_time = timed(lambda: [scorer.score(query, limit) for query in tokens])
+            pruned, pruned_time = timed(lambda: [scorer.score_pruned(query, limit, window) for query in tokens])
+            # exhaustive scoring scores every document matching any token
+            matched = [len(np.unique(np.concatenate([scorer.postings[t][0] for t in set(query) if t in scorer.postings] or [np.empty(0)])))
+                       for query in tokens]
+            identical = all(np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1]) for a, b in zip(exhaustive, pruned))
+            print(f"{name:<8} {np.mean([len(t) for t in tokens]):>7.1f} {exhaustive_time / query_count * 1000:>18.2f} {np.mean(matched):>12.0f} "
+                  f"{pruned_time / query_count * 1000:>14.2f} {np.mean([p[2] for p in pruned]):>12.0f} {str(identical):>10}")
+
+
+def legacy_keyword_search(index, query, limit):
+    """The original `search`: every posting of a token is materialized as a
+    document and sorted, kept as the reference."""
+    curr = set()
+    result = []
+    for tok in index.tokenizer.tokenize_str(query):
+        docs = index.get_documents(tok)
+        result.extend(filter(lambda doc: doc["id"] not in curr, docs))
+        if len(result) > limit:
+            result = result[:limit]
+            break
+
+        curr.update(map(lambda doc: doc["id"], docs))
+    return [doc["id"] for doc in result]
+
+
+def keyword_search(docs, query_count, limit):
+    movies = synthetic_movies(docs)
+    rng = random.Random(0)
+    words = [query.split() for query in synthetic_queries(movies, query_count * 4)]
+    query_sets = {
+        "short": [" ".join(rng.sample(pool, min(2, len(pool)))) for pool in words[:query_count]],
+        "long": [" ".join(sum(words[i:i + 4], [])[:8]) for i in range(0, query_count * 4, 4)],
+    }
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        index = InvertedIndex(Tokenizer(), cache_dir)
+        index.build(movies)
+        index.save()
+        index.load()
+        del movies
+
+        def ids(query, mode):
+            return [doc["id"] for doc in index.search(query, limit, mode)]
+
+        def reference(query, combine):
+            sets = [index.index.get(token, set()) for token in index.tokenizer.tokenize_str(query)]
+            return sorted(combine(*sets) if sets else set())[:limit]
+
+        print(f"{docs} documents, {query_count} queries per set, top {limit}")
+        print(f"{'queries':<8} {'mode':<6} {'legacy (ms/q)':>14} {'sorted postings (ms/q)':>23} {'identical':>10}")
+        for name, queries in query_sets.items():
+            legacy, legacy_time = timed(lambda: [legacy_keyword_search(index, query, limit) for query in queries])
+            for mode, expected in (("first", legacy), ("and", None), ("or", None)):
+                found, found_time = timed(lambda: [ids(query, mode) for query in queries])
+                if expected is None:
+                    expected = [reference(query, set.intersection if mode == "and" else set.union) for query in queries]
+                legacy_ms = f"{legacy_time / query_count * 1000:.2f}" if mode == "first" else "-"
+                print(f"{name:<8} {mode:<6} {legacy_ms:>14} {found_time / query_count * 1000:>23.3f} {str(found == expected):>10}")
+
+
+def loop_top_k(embeddings, query, limit):
+    """The original per-row scoring loop, kept as the reference."""
+    scores = [(cosine_similarity(query, doc_embed), i) for i, doc_embed in enumerate(embeddings)]
+    scores.sort(key=lambda elt: elt[0], reverse=True)
+    return [i for _, i in scores[:limit]]
+
+
+def semantic_search(sizes, dimensions, query_count, limit, loop_max):
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((query_count, dimensions), dtype=np.float32)
+
+    print(f"{dimensions} dimensions, {query_count} queries, top {limit}")
+    print(f"{'docs':>9} {'normalize (ms)':>15} {'loop (ms/q)':>12} {'matvec (ms/q)':>14} {'batched (ms/q)':>15} {'same ranking':>13}")
+    for size in sizes:
+        embeddings = rng.standard_normal((size, dimensions), dtype=np.float32)
+        normalized, normalize_time = timed(normalize_rows, embeddings)
+
+        single, single_time = timed(lambda: [cosine_top_k(normalized, query, limit)[0] for query in queries])
+        batched, batched_time = timed(cosine_top_k_many, normalized, queries, limit)
+        same = all(np.array_equal(rows, batch_rows) for rows, (batch_rows, _) in zip(single, batched))
+
+        loop_column = "-"
+        if size <= loop_max:
+            sample = queries[:3]
+            looped, loop_time = timed(lambda: [loop_top_k(embeddings, query, limit) for query in sample])
+            loop_column = f"{loop_time / len(sample) * 1000:.1f}"
+            same = same and all(looped[i] == single[i].tolist() for i in range(len(sample)))
+
+        print(f"{size:>9} {normalize_time * 1000:>15.1f} {loop_column:>12} {single_time / query_count * 1000:>14.2f} {batched_time / query_count * 1000:>15.2f} {str(same):>13}")
+        del embeddings, normalized
+
+
+def ann(docs, dimensions, query_count, limit, nlist, nprobes):
+    embeddings = synthetic_embeddings(docs + query_count, dimensions)
+    normalized = normalize_rows(embeddings[:docs])
+    queries = embeddings[docs:]
+
+    index, train_time = timed(IVFIndex.train, normalized, nlist)
+    exact, exact_time = timed(lambda: [cosine_top_k(normalized, query, limit)[0] for query in queries])
+
+    print(f"{docs} documents, {dimensions} dimensions, {len(index.centroids)} lists, {query_count} queries, top {limit}")
+    print(f"training: {train_time:.2f} s")
+    print(f"{'search':<12} {'ms/query':>9} {'recall@' + str(limit):>10}")
+    print(f"{'exact':<12} {exact_time / query_count * 1000:>9.2f} {1.0:>10.3f}")
+    for nprobe in nprobes:
+        approximate, ann_time = timed(lambda: [index.search(normalized, query, limit, nprobe)[0] for query in queries])
+        recall = np.mean([len(np.intersect1d(a, e)) / len(e) for a, e in zip(approximate, exact)])
+        print(f"{'nprobe=' + str(nprobe):<12} {ann_time / query_count * 1000:>9.2f} {recall:>10.3f}")
+
+
+def quantization(docs, dimensions, query_count, limit, rescore):
+    embeddings = synthetic_embeddings(docs + query_count, dimensions)
+    documents = embeddings[:docs]
+    queries = embeddings[docs:]
+    reference = QuantizedVectors.encode(documents, "float32")
+    exact = [reference.top_k(query, limit)[0] for query in queries]
+
+    print(f"{docs} documents, {dimensions} dimensions, {query_count} queries, top {limit}, {rescore} rescored")
+    print(f"{'storage':<8} {'MiB':>7} {'load (ms)':>10} {'ms/query':>9} {'recall@' + str(limit):>10} {'rescored ms/q':>14} {'recall@' + str(limit):>10}")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for mode in STORAGE_MODES:
+            vectors = QuantizedVectors.encode(documents, mode)
+            path = os.path.join(cache_dir, f"{mode}.npz")
+            vectors.save(path)
+            _, load_time = timed(QuantizedVectors.load, path)
+
+            approximate, search_time = timed(lambda: [vectors.top_k(query, limit)[0] for query in queries])
+            recall = np.mean([len(np.intersect1d(a, e)) / len(e) for a, e in zip(approximate, exact)])
+            rescore_column = recall_column = "-"
+            if not vectors.exact:
+                rescored, rescore_time = timed(lambda: [vectors.rescore(query, vectors.top_k(query, max(limit, rescore))[0], limit)[0] for query in queries])
+                rescore_column = f"{rescore_time / query_count * 1000:.2f}"
+                recall_column = f"{np.mean([len(np.intersect1d(a, e)) / len(e) for a, e in zip(rescored, exact)]):.3f}"
+            print(f"{mode:<8} {vectors.nbytes / 2**20:>7.1f} {load_time * 1000:>10.1f} {search_time / query_count * 1000:>9.2f} {recall:>10.3f} {rescore_column:>14} {recall_column:>10}")
+
+
+def chunk_encoding(docs, duplicates, batch_size, workers):
+    # only this benchmark needs the model
+    from sentence_transformers import SentenceTransformer
+
+    movies = synthetic_movies(docs)
+    rng = random.Random(0)
+    # remakes and re-releases share their description with another movie
+    for movie in rng.sample(movies, int(duplicates * docs)):
+        movie["description"] = rng.choice(movies)["description"]
+    chunks = [
+        chunk for movie in movies
+        for chunk in get_semantic_chunks_from_str(movie["description"], SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP)
+    ]
+    model = SentenceTransformer(SEMANTIC_MODEL)
+
+    def unsorted():
+        return np.concatenate([model.encode(list(batch)) for batch in batched(chunks, batch_size)])
+
+    def pipeline(store, pool):
+        encode = (lambda texts: model.encode_multi_process(texts, pool)) if pool else model.encode
+        store.encode_missing(chunks, encode, batch_size)
+        return store.encode(chunks, encode, batch_size)
+
+    print(f"{docs} documents, {len(chunks)} chunks, {len(set(chunks))} distinct, batches of {batch_size}")
+    print(f"{'pipeline':<28} {'seconds':>8} {'chunks/s':>9} {'same vectors':>13}")
+    reference, reference_time = timed(unsorted)
+    print(f"{'every chunk, in order':<28} {reference_time:>8.1f} {len(chunks) / reference_time:>9.0f} {'-':>13}")
+    for count in workers:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store = EmbeddingStore(SEMANTIC_MODEL, os.path.join(cache_dir, "embeddings.sqlite"))
+            pool = model.start_multi_process_pool(["cpu"] * count) if count > 1 else None
+            try:
+                vectors, pipeline_time = timed(pipeline, store, pool)
+            finally:
+                if pool:
+                    model.stop_multi_process_pool(pool)
+                store.close()
+        same = np.allclose(vectors, reference, atol=1e-5)
+        label = f"distinct, sorted, {count} proc"
+        print(f"{label:<28} {pipeline_time:>8.1f} {len(chunks) / pipeline_time:>9.0f} {str(same):>13}")
+
+
+def measure_documents(workdir, layout, rows, limit):
+    """Runs in a fresh process from `workdir`: hold the catalog the way
+    `layout` says, then fetch the documents of `rows`, `limit` per query.
+    Reports times, private RSS growth after loading and after the queries,
+    and growth of the peak and of the resident pages of mapped files."""
+    os.chdir(workdir)
+    baseline_rss, baseline_private = rss_mb(), private_rss_mb()
+
+    def load():
+        match layout:
+            case "dicts":
+                # what the semantic retrievers kept before the document store
+                document_map = {doc["id"]: doc for doc in MovieStream()}
+                return list(document_map.values())
+            case "store":
+                # what they do now on every load
+                write_document_store(os.path.join("cache", DOCUMENTS_FILE), MovieStream())
+                return DocumentStore(os.path.join("cache", DOCUMENTS_FILE)).view()
+            case "mapped":
+                return DocumentStore(os.path.join("cache", DOCUMENTS_FILE)).view()
+
+    documents, load_time = timed(load)
+    load_private = private_rss_mb()
+    _, fetch_time = timed(lambda: [[documents[row]["title"] for row in query] for query in batched(rows, limit)])
+    private = private_rss_mb()
+    return (
+        load_time, fetch_time / len(rows) * limit, load_private - baseline_private, private - baseline_private,
+        peak_rss_mb() - baseline_rss, (rss_mb() - private) - (baseline_rss - baseline_private),
+    )
+
+
+def documents(docs, query_count, limit):
+    movies = synthetic_movies(docs)
+    rows = np.random.default_rng(0).integers(docs, size=query_count * limit).tolist()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, "data"))
+        os.makedirs(os.path.join(workdir, "cache"))
+        with open(os.path.join(workdir, "data", "movies.json"), "w") as f:
+            json.dump({"movies": movies}, f)
+        write_document_store(os.path.join(workdir, "cache", DOCUMENTS_FILE), movies)
+        catalog_size = os.path.getsize(os.path.join(workdir, "data", "movies.json"))
+        store_size = os.path.getsize(os.path.join(workdir, "cache", DOCUMENTS_FILE))
+        del movies
+
+        print(f"{docs} documents ({catalog_size / 2**20:.1f} MB of JSON, {store_size / 2**20:.1f} MB stored), {query_count} queries of {limit}")
+        print(f"{'documents':<28} {'load (ms)':>10} {'query (ms)':>11} {'private load (MB)':>18} {'private query (MB)':>19} "
+              f"{'peak RSS (MB)':>14} {'mapped (MB)':>12}")
+        context = multiprocessing.get_context("spawn")
+        for layout, label in (("dicts", "dicts from movies.json"), ("store", "movies.json into the store"), ("mapped", "store only")):
+            with context.Pool(1) as pool:
+                load_time, query_time, load_private, query_private, peak_rss, mapped = pool.apply(measure_documents, (workdir, layout, rows, limit))
+            print(f"{label:<28} {load_time * 1000:>10.1f} {query_time * 1000:>11.3f} {load_private:>18.1f} {query_private:>19.1f} "
+                  f"{peak_rss:>14.1f} {mapped:>12.1f}")
+
+
+SUITE_RETRIEVERS = ("keyword", "semantic", "chunked")
+# files under cache/ that make up the index of each retriever
+SUITE_FILES = {"keyword": ("index.bin", "stems.json"), "semantic": ("movie_embeddings*",), "chunked": ("chunk_embeddings*",)}
+# measurements where a higher value is a regression; top_k_overlap may only go down
+SUITE_COSTS = ("build_s", "build_peak_rss_mb", "load_s", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb", "index_mb")
+
+
+def suite_searcher(retriever):
+    match retriever:
+        case "keyword":
+            tokenizer = Tokenizer()
+            tokenizer.load_stop_words(os.path.join("data", "stopwords.txt"))
+            return InvertedIndex(tokenizer)
+        case "semantic":
+            # only the semantic retrievers need the model
+            from data.semantic_search import SemanticSearch
+            return SemanticSearch()
+        case "chunked":
+            from data.chunked_semantic_search import ChunkedSemantticSearch
+            return ChunkedSemantticSearch()
+
+
+def suite_ranking(retriever, searcher, query, limit):
+    """The documents `searcher` ranks first for `query`, as comparable keys."""
+    match retriever:
+        case "keyword":
+            return [doc["id"] for doc, _ in searcher.bm25_search(query, limit)]
+        case "semantic":
+            rows, _ = searcher.top_k_rows(searcher.generate_embedding(query), limit)
+            return [searcher.documents[row]["id"] for row in rows.tolist()]
+        case "chunked":
+            return [f"{result["title"]}\n{result["description"]}" for result in searcher.search_chunks(query, limit)]
+
+
+def suite_build(workdir, retriever, queries, limit):
+    """Runs in a fresh process from `workdir`: build and save the index of
+    one retriever, then rank `queries` with the reference implementation."""
+    os.chdir(workdir)
+    movies = list(MovieStream())
+    searcher = suite_searcher(retriever)
+    match retriever:
+        case "keyword":
+            _, build_time = timed(lambda: (searcher.build(movies), searcher.save()))
+        case "semantic":
+            _, build_time = timed(searcher.build_embeddings, movies)
+        case "chunked":
+            _, build_time = timed(searcher.build_chunk_embeddings, movies)
+    peak_rss = peak_rss_mb()
+
+    # naive BM25 over the in-memory index, exact float32 scans for embeddings
+    match retriever:
+        case "keyword":
+            reference = [[doc["id"] for doc, _ in searcher.bm25_search(query, limit, "naive")] for query in queries]
+        case "semantic":
+            searcher.normalized_embeddings = QuantizedVectors.encode(searcher.embeddings, "float32")
+            reference = [suite_ranking(retriever, searcher, query, limit) for query in queries]
+        case "chunked":
+            searcher.normalized_chunk_embeddings = QuantizedVectors.encode(searcher.chunk_embeddings, "float32")
+            reference = [suite_ranking(retriever, searcher, query, limit) for query in queries]
+
+    index_size = sum(
+        os.path.getsize(path) for pattern in SUITE_FILES[retriever] for path in glob.glob(os.path.join("cache", pattern)))
+    return {"build_s": build_time, "build_peak_rss_mb": peak_rss, "index_mb": index_size / 2**20}, reference
+
+
+def suite_query(workdir, retriever, queries, limit):
+    """Runs in a fresh process from `workdir`: load one retriever like its CLI
+    does and time every query."""
+    os.chdir(workdir)
+
+    def load():
+        searcher = suite_searcher(retriever)
+        match retriever:
+            case "keyword":
+                searcher.load()
+            case "semantic":
+                searcher.load_embeddings(MovieStream())
+            case "chunked":
+                searcher.load_chunk_embeddings(MovieStream())
+        # every query is measured, not a cache lookup
+        searcher.result_cache = QueryCache(0)
+        return searcher
+
+    searcher, load_time = timed(load)
+    latencies = []
+    results = []
+    for query in queries:
+        found, elapsed = timed(suite_ranking, retriever, searcher, query, limit)
+        results.append(found)
+        latencies.append(elapsed)
+    return {"load_s": load_time, **latency_percentiles(latencies), "peak_rss_mb": peak_rss_mb()}, results
+
+
+def suite(docs, movies_path, query_count, limit, retrievers, output, baseline, tolerance):
+    movies = list(MovieStream(movies_path)) if movies_path else synthetic_movies(docs)
+    queries = synthetic_queries(movies, query_count)
+    report = {
+        "config": {"docs": len(movies), "queries": query_count, "limit": limit, "corpus": movies_path or "synthetic"},
+        "retrievers": {},
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # the retrievers run from `workdir` as if it were the project directory
+        os.makedirs(os.path.join(workdir, "data"))
+        with open(os.path.join(workdir, "data", "movies.json"), "w") as f:
+            json.dump({"movies": movies}, f)
+        stop_words = os.path.join("data", "stopwords.txt")
+        if os.path.exists(stop_words):
+            shutil.copy(stop_words, os.path.join(workdir, "data"))
+        else:
+            open(os.path.join(workdir, "data", "stopwords.txt"), "w").close()
+        del movies
+
+        context = multiprocessing.get_context("spawn")
+        for retriever in retrievers:
+            # separate processes, so each peak RSS belongs to one stage
+            with context.Pool(1) as pool:
+                build_measurements, reference = pool.apply(suite_build, (workdir, retriever, queries, limit))
+            with context.Pool(1) as pool:
+                query_measurements, results = pool.apply(suite_query, (workdir, retriever, queries, limit))
+            report["retrievers"][retriever] = {
+                **build_measurements, **query_measurements, "top_k_overlap": top_k_overlap(results, reference),
+            }
+
+    config = report["config"]
+    print(f"{config["docs"]} documents ({config["corpus"]}), {query_count} queries, top {limit}")
+    print(f"{'retriever':<10} {'build (s)':>10} {'build RSS (MB)':>15} {'index (MB)':>11} {'load (s)':>9} "
+          f"{'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'RSS (MB)':>9} {'overlap':>8}")
+    for retriever, m in report["retrievers"].items():
+        print(f"{retriever:<10} {m["build_s"]:>10.2f} {m["build_peak_rss_mb"]:>15.1f} {m["index_mb"]:>11.1f} {m["load_s"]:>9.2f} "
+              f"{m["p50_ms"]:>9.2f} {m["p95_ms"]:>9.2f} {m["p99_ms"]:>9.2f} {m["peak_rss_mb"]:>9.1f} {m["top_k_overlap"]:>8.3f}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """Print how every measurement moved since `baseline` and return the
+    regressions: costs that grew by more than `tolerance`, or any drop in
+    top-k overlap."""
+    if report["config"] != baseline["config"]:
+        print(f"warning: baseline was measured with {baseline["config"]}")
+
+    regressions = []
+    print(f"\n{'retriever':<10} {'measurement':<18} {'baseline':>10} {'current':>10} {'change':>8}")
+    for retriever, measurements in report["retrievers"].items():
+        previous = baseline["retrievers"].get(retriever)
+        if previous is None:
+            continue
+        for name, value in measurements.items():
+            old = previous.get(name)
+            if old is None:
+                continue
+            change = (value - old) / old if old else 0.0
+            if name in SUITE_COSTS:
+                regressed = change > tolerance
+            else:
+                regressed = value < old - 1e-9
+            if regressed:
+                regressions.append((retriever, name))
+            print(f"{retriever:<10} {name:<18} {old:>10.3f} {value:>10.3f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+
+    print(f"{len(regressions)} regressions (tolerance {tolerance:.0%})")
+    return regressions
+
+
+def shards(docs, query_count, limit, shard_counts, semantic):
+    movies = synthetic_movies(docs)
+    queries = synthetic_queries(movies, query_count)
+    kinds = ["keyword", "semantic"] if semantic else ["keyword"]
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # the shards are built and searched from `workdir` as if it were the project directory
+        os.makedirs(os.path.join(workdir, "data"))
+        os.makedirs(os.path.join(workdir, "cache"))
+        with open(os.path.join(workdir, "data", "movies.json"), "w") as f:
+            json.dump({"movies": movies}, f)
+        stop_words = os.path.join("data", "stopwords.txt")
+        if os.path.exists(stop_words):
+            shutil.copy(stop_words, os.path.join(workdir, "data"))
+        else:
+            open(os.path.join(workdir, "data", "stopwords.txt"), "w").close()
+        os.chdir(workdir)
+        try:
+            tokenizer = Tokenizer()
+            tokenizer.load_stop_words(os.path.join("data", "stopwords.txt"))
+            index = InvertedIndex(tokenizer)
+            index.build(movies)
+            reference = {"keyword": [[(doc["id"], score) for doc, score in index.bm25_search(query, limit)] for query in queries]}
+            del index
+            if semantic:
+                from data.semantic_search import SemanticSearch
+                searcher = SemanticSearch(storage="float32")
+                searcher.load_or_create_embeddings(movies)
+                reference["semantic"] = [[result["title"] for result in searcher.search(query, limit)] for query in queries]
+                del searcher
+
+            print(f"{docs} documents, {query_count} queries, top {limit}, {os.cpu_count()} CPUs")
+            print(f"{'retriever':<10} {'shards':>7} {'build (s)':>10} {'load (s)':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'identical':>10}")
+            for shard_count in shard_counts:
+                _, build_time = timed(build_keyword_shards, movies, shard_count, tokenizer)
+                if semantic:
+                    _, semantic_build_time = timed(build_semantic_shards, movies, storage="float32")
+                for kind in kinds:
+                    sharded, load_time = timed(ShardedSearch, kind, storage="float32")
+                    try:
+                        if kind == "keyword":
+                            search = lambda query: [(doc["id"], score) for doc, score in sharded.bm25_search(query, limit)]
+                        else:
+                            sharded.search(queries[0], limit)  # loads the model outside the timings
+                            search = lambda query: [result["title"] for result in sharded.search(query, limit)]
+                        results, latencies = [], []
+                        for query in queries:
+                            found, elapsed = timed(search, query)
+                            results.append(found)
+                            latencies.append(elapsed)
+                    finally:
+                        sharded.close()
+                    percentiles = latency_percentiles(latencies)
+                    kind_build_time = build_time if kind == "keyword" else semantic_build_time
+                    print(f"{kind:<10} {shard_count:>7} {kind_build_time:>10.2f} {load_time:>9.2f} {percentiles["p50_ms"]:>9.2f} "
+                          f"{percentiles["p95_ms"]:>9.2f} {str(results == reference[kind]):>10}")
+        finally:
+            os.chdir(cwd)
+
+
+def encode_concurrently(encode, queries, concurrency):
+    """Encode `queries` from `concurrency` threads, each taking every
+    concurrency-th query in turn; returns the embeddings, per-query latencies
+    and wall time."""
+    embeddings, latencies = [None] * len(queries), [None] * len(queries)
+
+    def client(first):
+        for i in range(first, len(queries), concurrency):
+            embeddings[i], latencies[i] = timed(encode, queries[i])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        _, wall = timed(lambda: list(clients.map(client, range(concurrency))))
+    return np.array(embeddings), latencies, wall
+
+
+def query_encoding(query_count, concurrencies, precisions, wait_ms, max_batch):
+    # only this benchmark needs the model
+    from sentence_transformers import SentenceTransformer
+    from data.query_encoder import QueryEncoder, check_quantized_model, quantize_model
+
+    queries = synthetic_queries(synthetic_movies(2000), query_count)
+    model = SentenceTransformer(SEMANTIC_MODEL)
+    reference = model.encode(queries)
+
+    print(f"{query_count} queries, batches of up to {max_batch} within {wait_ms} ms, {os.cpu_count()} CPUs")
+    print(f"{'precision':<10} {'encoder':<11} {'clients':>8} {'queries/s':>10} {'p50 (ms)':>9} {'p95 (ms)':>9} {'batch':>6} {'cosine':>7}")
+    for precision in precisions:
+        precision_model = model
+        if precision == "int8":
+            precision_model = quantize_model(model)
+            print(f"int8 agreement with float32 on calibration queries: {check_quantized_model(model, precision_model):.4f}")
+        for concurrency in concurrencies:
+            one_by_one = lambda query: precision_model.encode([query])[0]
+            encoder = QueryEncoder(precision_model, precision, wait_ms, max_batch)
+            try:
+                for name, encode in (("one by one", one_by_one), ("batched", encoder.encode)):
+                    embeddings, latencies, wall = encode_concurrently(encode, queries, concurrency)
+                    percentiles = latency_percentiles(latencies)
+                    batch = f"{encoder.encoded / encoder.batches:.1f}" if name == "batched" else "1"
+                    agreement = np.min(np.sum(normalize_rows(embeddings) * normalize_rows(reference), axis=1))
+                    print(f"{precision:<10} {name:<11} {concurrency:>8} {query_count / wall:>10.0f} {percentiles["p50_ms"]:>9.2f} "
+                          f"{percentiles["p95_ms"]:>9.2f} {batch:>6} {agreement:>7.4f}")
+            finally:
+                encoder.close()
+
+
+STARTUP_TEXT = "A heist goes wrong. The crew scatters across the city! Who talked? Nobody knows."
+# packages whose import dominates a cold start
+STARTUP_HEAVY = ("numpy", "nltk", "sentence_transformers", "torch")
+# command name: (CLI, arguments, packages it must start without)
+STARTUP_COMMANDS = {
+    "keyword_help": ("keyword_search_cli.py", ["--help"], STARTUP_HEAVY),
+    "semantic_help": ("semantic_search_cli.py", ["--help"], STARTUP_HEAVY),
+    "hybrid_help": ("hybrid_search_cli.py", ["--help"], STARTUP_HEAVY),
+    "chunk": ("semantic_search_cli.py", ["chunk", STARTUP_TEXT, "--chunk-size", "4"], STARTUP_HEAVY),
+    "semantic_chunk": ("semantic_search_cli.py", ["semantic_chunk", STARTUP_TEXT, "--max-chunk-size", "2"], STARTUP_HEAVY),
+    # needs an index built in the current directory
+    "keyword_search": ("keyword_search_cli.py", ["--local", "search", "space adventure"], ("sentence_transformers", "torch")),
+}
+
+
+def import_times(stderr):
+    """Self time in microseconds of every module in `python -X importtime` output."""
+    times = {}
+    for line in stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            times[fields[2].strip()] = int(fields[0])
+    return times
+
+
+def startup(commands, runs, budget_ms):
+    cli_dir = os.path.dirname(os.path.abspath(__file__))
+    regressions = []
+    print(f"{'command':<16} {'wall (ms)':>10} {'imports (ms)':>13}  heaviest packages (ms)")
+    for name in commands:
+        cli, cli_args, forbidden = STARTUP_COMMANDS[name]
+        argv = [os.path.join(cli_dir, cli), *cli_args]
+        # the first run warms the page cache and is not counted
+        walls = [timed(subprocess.run, [sys.executable, *argv], capture_output=True)[1] for _ in range(runs + 1)][1:]
+        traced = subprocess.run([sys.executable, "-X", "importtime", *argv], capture_output=True, text=True)
+        if traced.returncode != 0:
+            print(f"{name:<16} failed: {traced.stderr.strip().splitlines()[-1]}")
+            regressions.append(f"{name} exited with {traced.returncode}")
+            continue
+
+        modules = import_times(traced.stderr)
+        packages = Counter()
+        for module, microseconds in modules.items():
+            packages[module.split(".")[0]] += microseconds
+        wall = float(np.median(walls)) * 1000
+        heaviest = ", ".join(f"{package} {microseconds / 1000:.0f}" for package, microseconds in packages.most_common(3))
+        print(f"{name:<16} {wall:>10.1f} {sum(modules.values()) / 1000:>13.1f}  {heaviest}")
+
+        loaded = [package for package in forbidden if package in packages]
+        if loaded:
+            regressions.append(f"{name} imports {", ".join(loaded)}")
+        if budget_ms is not None and wall > budget_ms:
+            regressions.append(f"{name} took {wall:.0f} ms, over the {budget_ms:.0f} ms budget")
+
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    index_load_parser = subparsers.add_parser("index_load", help="Compare load time and memory of the pickle and binary index formats")
+    index_load_parser.add_argument("--docs", type=int, default=50000, help="Number of synthetic documents")
+    index_load_parser.add_argument("--queries", type=int, default=100, help="Number of BM25 queries run after loading")
+
+    build_parser = subparsers.add_parser("build", help="Measure how the index build scales with worker processes")
+    build_parser.add_argument("--docs", type=int, default=50000, help="Number of synthetic documents")
+    build_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Worker counts to measure; the first is the reference")
+
+    bm25_pruning_parser = subparsers.add_parser("bm25_pruning", help="Compare exhaustive and block-max MaxScore BM25 top-k retrieval")
+    bm25_pruning_parser.add_argument("--docs", type=int, default=50000, help="Number of synthetic documents")
+    bm25_pruning_parser.add_argument("--queries", type=int, default=200, help="Number of short and of long queries")
+    bm25_pruning_parser.add_argument("--limit", type=int, default=5, help="Number of results per query")
+    bm25_pruning_parser.add_argument("--window", type=int, default=BM25_WINDOW, help="Rows per pruning window")
+
+    keyword_search_parser = subparsers.add_parser("keyword_search", help="Compare the original keyword search with sorted-posting first, AND and OR retrieval")
+    keyword_search_parser.add_argument("--docs", type=int, default=20000, help="Number of synthetic documents")
+    keyword_search_parser.add_argument("--queries", type=int, default=50, help="Number of short and of long queries")
+    keyword_search_parser.add_argument("--limit", type=int, default=5, help="Number of results per query")
+
+    semantic_search_parser = subparsers.add_parser("semantic_search", help="Compare per-query latency of the semantic search scoring paths")
+    semantic_search_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Numbers of synthetic document embeddings")
+    semantic_search_parser.add_argument("--dimensions", type=int, default=384, help="Embedding dimensions")
+    semantic_search_parser.add_argument("--queries", type=int, default=64, help="Number of queries")
+    semantic_search_parser.add_argument("--limit", type=int, default=5, help="Number of results per query")
+    semantic_search_parser.add_argument("--loop-max", type=int, default=100000, help="Largest size the reference per-row loop is run on")
+
+    ann_parser = subparsers.add_parser("ann", help="Compare recall and latency of the IVF index against exact search")
+    ann_parser.add_argument("--docs", type=int, default=200000, help="Number of synthetic document embeddings")
+    ann_parser.add_argument("--dimensions", type=int, default=384, help="Embedding dimensions")
+    ann_parser.add_argument("--queries", type=int, default=100, help="Number of queries")
+    ann_parser.add_argument("--limit", type=int, default=10, help="Number of results per query (the k of recall@k)")
+    ann_parser.add_argument("--nlist", type=int, default=None, help="Number of IVF lists (default: sqrt of the document count)")
+    ann_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="nprobe values to measure")
+
+    quantization_parser = subparsers.add_parser("quantization", help="Compare memory, latency and recall of the embedding storage modes")
+    quantization_parser.add_argument("--docs", type=int, default=200000, help="Number of synthetic document embeddings")
+    quantization_parser.add_argument("--dimensions", type=int, default=384, help="Embedding dimensions")
+    quantization_parser.add_argument("--queries", type=int, default=100, help="Number of queries")
+    quantization_parser.add_argument("--limit", type=int, default=10, help="Number of results per query (the k of recall@k)")
+    quantization_parser.add_argument("--rescore", type=int, default=RESCORE_CANDIDATES, help="Approximate matches rescored in float32")
+
+    chunk_encoding_parser = subparsers.add_parser("chunk_encoding", help="Compare chunk encoding throughput before and after deduplication, length sorting and worker processes")
+    chunk_encoding_parser.add_argument("--docs", type=int, default=2000, help="Number of synthetic documents")
+    chunk_encoding_parser.add_argument("--duplicates", type=float, default=0.2, help="Fraction of documents sharing another one's description")
+    chunk_encoding_parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Chunks per model call")
+    chunk_encoding_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Process counts to measure")
+
+    documents_parser = subparsers.add_parser("documents", help="Compare load time and memory of the catalog as dicts and as a memory-mapped document store")
+    documents_parser.add_argument("--docs", type=int, default=200000, help="Number of synthetic documents")
+    documents_parser.add_argument("--queries", type=int, default=1000, help="Number of queries")
+    documents_parser.add_argument("--limit", type=int, default=10, help="Documents fetched per query")
+
+    suite_parser = subparsers.add_parser("suite", help="Measure build, load, latency, memory, size and ranking overlap of every retriever")
+    suite_parser.add_argument("--docs", type=int, default=10000, help="Number of synthetic documents")
+    suite_parser.add_argument("--movies", type=str, default=None, help="Use this movies.json or .jsonl instead of a synthetic corpus")
+    suite_parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+    suite_parser.add_argument("--limit", type=int, default=10, help="Number of results per query (the k of the top-k overlap)")
+    suite_parser.add_argument("--retrievers", choices=SUITE_RETRIEVERS, nargs="+", default=list(SUITE_RETRIEVERS), help="Retrievers to measure")
+    suite_parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    suite_parser.add_argument("--baseline", type=str, default=None, help="Compare with the results in this JSON file and exit with 1 on a regression")
+    suite_parser.add_argument("--tolerance", type=float, default=0.1, help="Relative growth of a cost tolerated by --baseline")
+
+    shards_parser = subparsers.add_parser("shards", help="Measure scatter-gather query latency against the number of shards")
+    shards_parser.add_argument("--docs", type=int, default=50000, help="Number of synthetic documents")
+    shards_parser.add_argument("--queries", type=int, default=100, help="Number of queries")
+    shards_parser.add_argument("--limit", type=int, default=10, help="Number of results per query")
+    shards_parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8], help="Shard counts to measure")
+    shards_parser.add_argument("--semantic", action="store_true", help="Also shard and search the movie embeddings (encodes the corpus with the model)")
+
+    query_encoding_parser = subparsers.add_parser("query_encoding", help="Compare query encoding throughput and latency one by one and in batches, per client count")
+    query_encoding_parser.add_argument("--queries", type=int, default=512, help="Number of queries")
+    query_encoding_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64], help="Numbers of concurrent clients")
+    query_encoding_parser.add_argument("--precision", choices=QUERY_PRECISIONS, nargs="+", default=list(QUERY_PRECISIONS), help="Query model precisions to measure")
+    query_encoding_parser.add_argument("--wait-ms", type=float, default=QUERY_BATCH_WAIT_MS, help="How long a batch waits for more queries")
+    query_encoding_parser.add_argument("--max-batch", type=int, default=QUERY_BATCH_SIZE, help="Most queries per model call")
+
+    startup_parser = subparsers.add_parser("startup", help="Measure the cold start of the CLI commands and check which packages they import")
+    startup_parser.add_argument("--commands", choices=STARTUP_COMMANDS, nargs="+", default=[name for name in STARTUP_COMMANDS if name != "keyword_search"], help="Commands to start; keyword_search needs an index in the current directory")
+    startup_parser.add_argument("--runs", type=int, default=5, help="Timed runs per command, after one warm-up run")
+    startup_parser.add_argument("--budget-ms", type=float, default=None, help="Exit with 1 if a command's median start takes longer")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "index_load":
+            index_load(args.docs, args.queries)
+
+        case "build":
+            build(args.docs, args.workers)
+
+        case "bm25_pruning":
+            bm25_pruning(args.docs, args.queries, args.limit, args.window)
+
+        case "keyword_search":
+            keyword_search(args.docs, args.queries, args.limit)
+
+        case "semantic_search":
+            semantic_search(args.sizes, args.dimensions, args.queries, args.limit, args.loop_max)
+
+        case "ann":
+            ann(args.docs, args.dimensions, args.queries, args.limit, args.nlist, args.nprobe)
+
+        case "quantization":
+            quantization(args.docs, args.dimensions, args.queries, args.limit, args.rescore)
+
+        case "chunk_encoding":
+            chunk_encoding(args.docs, args.duplicates, args.batch_size, args.workers)
+
+        case "documents":
+            documents(args.docs, args.queries, args.limit)
+
+        case "suite":
+            suite(args.docs, args.movies, args.queries, args.limit, args.retrievers, args.output, args.baseline, args.tolerance)
+
+        case "shards":
+            shards(args.docs, args.queries, args.limit, args.shards, args.semantic)
+
+        case "query_encoding":
+            query_encoding(args.queries, args.concurrency, args.precision, args.wait_ms, args.max_batch)
+
+        case "startup":
+            startup(args.commands, args.runs, args.budget_ms)
+
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
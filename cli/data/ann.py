@@ -0,0 +1,109 @@
+import numpy as np
+
+from data.definitions import ANN_NPROBE
+from data.ranking import top_k
+from data.vectors import normalize_rows
+
+ASSIGN_BATCH_SIZE = 16384
+
+class IVFIndex:
+  """Inverted-file approximate nearest neighbour index over unit vectors.
+
+  Vectors are clustered with spherical k-means; a query is only compared to
+  the vectors of its `nprobe` closest clusters.
+  """
+  def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_rows: np.ndarray, nprobe: int = ANN_NPROBE) -> None:
+    # the rows of list i are list_rows[list_offsets[i]:list_offsets[i + 1]]
+    self.centroids = centroids
+    self.list_offsets = list_offsets
+    self.list_rows = list_rows
+    self.nprobe = nprobe
+    # identifies the vectors the index was trained on
+    self.fingerprint = ""
+
+  @property
+  def count(self) -> int:
+    return len(self.list_rows)
+
+  @classmethod
+  def train(cls, normalized: np.ndarray, nlist: int | None = None, iterations: int = 10, seed: int = 0) -> "IVFIndex":
+    """Cluster `normalized` (rows from `normalize_rows`) into `nlist` lists.
+
+    Centroids are fitted on a sample of at most 256 vectors per list, then
+    every vector is assigned to its closest centroid.
+    """
+    if len(normalized) == 0:
+      raise ValueError("Cannot train an IVF index without vectors. Embed some documents first.")
+    rng = np.random.default_rng(seed)
+    if nlist is None:
+      nlist = int(np.sqrt(len(normalized)))
+    nlist = max(1, min(nlist, len(normalized)))
+
+    sample_size = min(len(normalized), 256 * nlist)
+    sample = normalized[np.sort(rng.choice(len(normalized), sample_size, replace=False))]
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+
+    for _ in range(iterations):
+      assignment = _assign(sample, centroids)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, assignment, sample)
+      counts = np.bincount(assignment, minlength=nlist)
+
+      # re-seed empty lists with random sample vectors
+      empty = np.flatnonzero(counts == 0)
+      sums[empty] = sample[rng.choice(sample_size, len(empty))]
+      centroids = normalize_rows(sums)
+
+    assignment = _assign(normalized, centroids)
+    list_rows = np.argsort(assignment, kind="stable").astype(np.int32)
+    list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=nlist)))).astype(np.int64)
+    return cls(centroids, list_offsets, list_rows)
+
+  def candidates(self, query: np.ndarray, nprobe: int | None = None) -> np.ndarray:
+    """Return the sorted rows stored in the lists closest to `query`."""
+    nprobe = nprobe or self.nprobe
+    probes = top_k(self.centroids @ normalize_rows(query), nprobe)
+    rows = [self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probes.tolist()]
+    return np.sort(np.concatenate(rows))
+
+  def search(self, normalized: np.ndarray, query: np.ndarray, limit: int, nprobe: int | None = None):
+    """Approximate `cosine_top_k`: only the probed lists are scored."""
+    rows = self.candidates(query, nprobe)
+    scores = normalized[rows] @ normalize_rows(query)
+    best = top_k(scores, limit)
+    return rows[best], scores[best]
+
+  def save(self, path: str) -> None:
+    with open(path, "bw") as f:
+      np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, list_rows=self.list_rows,
+               fingerprint=np.array(self.fingerprint))
+
+  @classmethod
+  def load(cls, path: str, nprobe: int = ANN_NPROBE) -> "IVFIndex":
+    with np.load(path) as data:
+      index = cls(data["centroids"], data["list_offsets"], data["list_rows"], nprobe)
+      index.fingerprint = str(data["fingerprint"]) if "fingerprint" in data else ""
+      return index
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+  assignment = np.empty(len(vectors), dtype=np.int64)
+  for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+    batch = vectors[start:start + ASSIGN_BATCH_SIZE]
+    assignment[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+  return assignment
+
+def load_or_train_ivf(path: str, normalized: np.ndarray, nprobe: int = ANN_NPROBE, fingerprint: str = "") -> IVFIndex:
+  """Load the index cached at `path`, retraining it when it was built from
+  other vectors, as told by their count and `fingerprint`."""
+  try:
+    index = IVFIndex.load(path, nprobe)
+    if index.count == len(normalized) and index.fingerprint == fingerprint:
+      return index
+  except FileNotFoundError:
+    pass
+
+  index = IVFIndex.train(normalized)
+  index.nprobe = nprobe
+  index.fingerprint = fingerprint
+  index.save(path)
+  return index
@@ -0,0 +1,96 @@
+import random
+import resource
+import sys
+import time
+
+from itertools import accumulate
+
+import numpy as np
+
+SYLLABLES = ["ka", "lo", "mi", "ren", "sto", "va", "dun", "el", "pra", "quo", "tis", "zar", "bel", "cor", "fi", "ga"]
+
+def synthetic_movies(count: int, seed: int = 0, vocabulary_size: int = 20000) -> list[dict]:
+  """Generate a deterministic movie corpus with a Zipf-like word distribution."""
+  rng = random.Random(seed)
+  vocabulary = list(dict.fromkeys(
+    "".join(rng.choices(SYLLABLES, k=rng.randint(1, 4))) for _ in range(vocabulary_size)))
+  cum_weights = list(accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+
+  def words(n):
+    return rng.choices(vocabulary, cum_weights=cum_weights, k=n)
+
+  movies = []
+  for doc_id in range(1, count + 1):
+    sentences = [" ".join(words(rng.randint(6, 16))).capitalize() + "." for _ in range(rng.randint(3, 8))]
+    movies.append({
+      "id": doc_id,
+      "title": " ".join(words(rng.randint(1, 4))).title(),
+      "description": " ".join(sentences),
+    })
+  return movies
+
+def synthetic_queries(movies: list[dict], count: int, seed: int = 0) -> list[str]:
+  """Pick query strings made of words taken from random movie descriptions."""
+  rng = random.Random(seed)
+  queries = []
+  for _ in range(count):
+    words = rng.choice(movies)["description"].rstrip(".").split()
+    length = rng.randint(1, min(6, len(words)))
+    start = rng.randint(0, len(words) - length)
+    queries.append(" ".join(words[start:start + length]))
+  return queries
+
+def synthetic_embeddings(count: int, dimensions: int, seed: int = 0, clusters: int = 256) -> np.ndarray:
+  """Generate float32 vectors scattered around random cluster centres, like topical text embeddings."""
+  rng = np.random.default_rng(seed)
+  centres = rng.standard_normal((clusters, dimensions), dtype=np.float32)
+  vectors = rng.standard_normal((count, dimensions), dtype=np.float32)
+  vectors += 2 * centres[rng.integers(clusters, size=count)]
+  return vectors
+
+def rss_mb() -> float:
+  """Current resident set size, falling back to the peak where /proc is missing."""
+  try:
+    with open("/proc/self/statm") as f:
+      resident_pages = int(f.read().split()[1])
+    return resident_pages * resource.getpagesize() / (1024 * 1024)
+  except OSError:
+    return peak_rss_mb()
+
+def private_rss_mb() -> float:
+  """Resident memory that is not file backed: mapped files are left out, as
+  their pages are shared through the page cache and can be dropped."""
+  try:
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("RssAnon:"):
+          return int(line.split()[1]) / 1024
+  except OSError:
+    pass
+  return rss_mb()
+
+def peak_rss_mb() -> float:
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+  return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def timed(fn, *args, **kwargs):
+  """Call `fn` and return (result, elapsed seconds)."""
+  start = time.perf_counter()
+  result = fn(*args, **kwargs)
+  return result, time.perf_counter() - start
+
+def latency_percentiles(seconds: list[float]) -> dict:
+  """p50, p95 and p99 of per-query latencies, in milliseconds."""
+  if not seconds:
+    return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+  p50, p95, p99 = np.percentile(np.asarray(seconds) * 1000, [50, 95, 99]).tolist()
+  return {"p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+
+def top_k_overlap(results: list[list], reference: list[list]) -> float:
+  """Mean fraction of the reference top-k found in the results, per query."""
+  overlaps = [
+    len(set(found) & set(expected)) / len(expected) if expected else float(not found)
+    for found, expected in zip(results, reference)
+  ]
+  return float(np.mean(overlaps)) if overlaps else 1.0
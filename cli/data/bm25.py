@@ -0,0 +1,194 @@
+import math
+
+from collections import Counter
+
+import numpy as np
+
+from data.definitions import BM25_K1, BM25_B, BM25_BLOCK_SIZE, BM25_WINDOW
+from data.ranking import top_k
+
+# relative slack on summed upper bounds, far above float rounding errors
+BOUND_MARGIN = 1e-9
+
+def bm25_idf(doc_count: int, term_doc_count: int) -> float:
+  return math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+
+def posting_blocks(rows, tfs, doc_lengths, block_size: int = BM25_BLOCK_SIZE):
+  """Summarize postings in blocks of `block_size`: the last row, the highest
+  tf and the shortest document length of each block.
+
+  A block's BM25 contribution is bounded by scoring its highest tf against
+  its shortest length, whatever k1, b, IDF and average length are.
+  """
+  starts = np.arange(0, len(rows), block_size)
+  last_rows = rows[np.minimum(starts + block_size, len(rows)) - 1]
+  max_tfs = np.maximum.reduceat(tfs, starts) if len(rows) else tfs[:0]
+  min_lengths = np.minimum.reduceat(doc_lengths[rows], starts) if len(rows) else doc_lengths[:0]
+  return last_rows, max_tfs, min_lengths
+
+class BM25Scorer:
+  """Array-backed BM25 scoring.
+
+  Documents are addressed by row, rows being sorted by document id. Per-term
+  IDF and per-document length norms are computed once so that scoring a query
+  only touches the postings of its tokens.
+  """
+  def __init__(self, doc_ids, doc_lengths, postings, idf, k1: float = BM25_K1, b: float = BM25_B, blocks=None,
+               avg_doc_length: float | None = None) -> None:
+    # `postings` maps a term to a (rows, tfs) pair of arrays sorted by row,
+    # `idf` maps a term to its BM25 IDF and `blocks`, if given, a term to
+    # its `posting_blocks`. `avg_doc_length` defaults to the average of
+    # `doc_lengths`; a shard passes the one of the whole corpus.
+    self.doc_ids = doc_ids
+    self.doc_lengths = doc_lengths
+    self.postings = postings
+    self.idf = idf
+    self.blocks = {} if blocks is None else blocks
+    self.computed_blocks = {}
+    self.k1 = k1
+    self.b = b
+
+    if avg_doc_length is None:
+      avg_doc_length = doc_lengths.sum() / len(doc_lengths) if len(doc_lengths) else 0.0
+    self.avg_doc_length = avg_doc_length
+    self.length_norms = self.__length_norms(doc_lengths)
+
+  def __length_norms(self, doc_lengths):
+    if self.avg_doc_length:
+      return self.k1 * (1 - self.b + self.b * (doc_lengths / self.avg_doc_length))
+    return np.full(len(doc_lengths), self.k1 * (1 - self.b))
+
+  @classmethod
+  def from_index(cls, index, k1: float = BM25_K1, b: float = BM25_B) -> "BM25Scorer":
+    doc_ids = np.array(sorted(index.doc_lengths), dtype=np.int64)
+    rows = {doc_id: row for row, doc_id in enumerate(doc_ids.tolist())}
+    doc_lengths = np.array([index.doc_lengths[doc_id] for doc_id in doc_ids.tolist()], dtype=np.int64)
+
+    postings = {}
+    idf = {}
+    for term, ids in index.index.items():
+      ids = sorted(ids)
+      postings[term] = (
+        np.array([rows[doc_id] for doc_id in ids], dtype=np.int32),
+        np.array([index.term_frequencies[doc_id][term] for doc_id in ids], dtype=np.int32),
+      )
+      idf[term] = bm25_idf(len(doc_ids), len(ids))
+
+    return cls(doc_ids, doc_lengths, postings, idf, k1, b)
+
+  def term_scores(self, token: str):
+    """Return the rows containing `token` and their BM25 contribution."""
+    rows, tfs = self.postings[token]
+    return rows, self.__contributions(rows, tfs, self.idf[token])
+
+  def __contributions(self, rows, tfs, idf):
+    return tfs * (self.k1 + 1) / (tfs + self.length_norms[rows]) * idf
+
+  def score(self, tokens: list[str], limit: int):
+    """Return the `limit` best (rows, scores) for the given query tokens.
+
+    Scores are bit-identical to summing `InvertedIndex.bm25` over the
+    postings; documents with equal scores come out by ascending id.
+    """
+    scores = np.zeros(len(self.doc_ids))
+    matched = np.zeros(len(self.doc_ids), dtype=bool)
+    for token in tokens:
+      if token not in self.postings:
+        continue
+      rows, term_scores = self.term_scores(token)
+      scores[rows] += term_scores
+      matched[rows] = True
+
+    candidates = np.flatnonzero(matched)
+    candidate_scores = scores[candidates]
+    best = top_k(candidate_scores, limit)
+    return candidates[best], candidate_scores[best]
+
+  def score_pruned(self, tokens: list[str], limit: int, window: int = BM25_WINDOW):
+    """Same results as `score`, skipping documents that cannot make the top.
+
+    Rows are visited in windows of `window` rows. Per-block upper bounds of
+    each term (see `posting_blocks`) give every window a bound: windows
+    that cannot beat the current `limit`-th score are skipped, and within a
+    window the terms whose bounds add up to less than that score are only
+    looked up for documents that the other terms make competitive
+    (MaxScore). Returns (rows, scores, number of documents scored).
+    """
+    tokens = [token for token in tokens if token in self.postings]
+    if not tokens or limit <= 0:
+      return np.empty(0, dtype=np.int64), np.empty(0), 0
+
+    counts = Counter(tokens)
+    terms = list(counts)
+    postings = [self.postings[term] for term in terms]
+    idfs = [self.idf[term] for term in terms]
+    window_count = -(-len(self.doc_ids) // window)
+    bounds = np.array([
+      counts[term] * self.__window_bounds(term, rows, tfs, idf, window, window_count)
+      for term, (rows, tfs), idf in zip(terms, postings, idfs)
+    ])
+
+    best_rows = np.empty(0, dtype=np.int64)
+    best_scores = np.empty(0)
+    threshold = -math.inf
+    scored = 0
+    for w in range(window_count):
+      window_bounds = bounds[:, w]
+      if window_bounds.sum() * (1 + BOUND_MARGIN) <= threshold:
+        continue
+
+      slices = [np.searchsorted(rows, (w * window, (w + 1) * window)) for rows, _ in postings]
+      # terms whose bounds together cannot reach the threshold only
+      # refine candidates found through the other, essential, terms
+      order = np.argsort(window_bounds, kind="stable")
+      prefix = np.cumsum(window_bounds[order]) * (1 + BOUND_MARGIN)
+      optional = order[:np.searchsorted(prefix, threshold, side="right")]
+      essential = np.setdiff1d(np.arange(len(terms)), optional)
+      if len(essential) == 0:
+        continue
+
+      candidates = np.unique(np.concatenate([postings[i][0][slice(*slices[i])] for i in essential]))
+      if len(optional) and len(candidates):
+        partial = np.zeros(len(candidates))
+        for i in essential:
+          rows, tfs = (array[slice(*slices[i])] for array in postings[i])
+          partial[np.searchsorted(candidates, rows)] += counts[terms[i]] * self.__contributions(rows, tfs, idfs[i])
+        candidates = candidates[(partial + window_bounds[optional].sum()) * (1 + BOUND_MARGIN) > threshold]
+
+      # exact scores, added in query order like `score` does
+      candidate_scores = np.zeros(len(candidates))
+      for token in tokens:
+        i = terms.index(token)
+        rows, tfs = (array[slice(*slices[i])] for array in postings[i])
+        found = np.minimum(np.searchsorted(rows, candidates), max(len(rows) - 1, 0))
+        hit = (rows[found] == candidates) if len(rows) else np.zeros(len(candidates), dtype=bool)
+        candidate_scores[hit] += self.__contributions(rows[found[hit]], tfs[found[hit]], idfs[i])
+      scored += len(candidates)
+
+      # earlier windows hold lower rows and come first, so ties still
+      # resolve by ascending id
+      rows = np.concatenate((best_rows, candidates))
+      scores = np.concatenate((best_scores, candidate_scores))
+      best = top_k(scores, limit)
+      best_rows, best_scores = rows[best], scores[best]
+      if len(best_rows) == limit:
+        threshold = best_scores[-1]
+
+    return best_rows, best_scores, scored
+
+  def __window_bounds(self, term, rows, tfs, idf, window, window_count):
+    """Upper bound of the contribution of `term` in every row window."""
+    blocks = self.blocks.get(term) or self.computed_blocks.get(term)
+    if blocks is None:
+      blocks = self.computed_blocks[term] = posting_blocks(rows, tfs, self.doc_lengths)
+    last_rows, max_tfs, min_lengths = blocks
+    block_bounds = max_tfs * (self.k1 + 1) / (max_tfs + self.__length_norms(min_lengths)) * idf
+
+    # a block spans the rows after the previous block up to its last row
+    first_rows = np.concatenate((rows[:1], last_rows[:-1] + 1))
+    first_windows, last_windows = first_rows // window, last_rows // window
+    spans = last_windows - first_windows + 1
+    windows = np.repeat(first_windows, spans) + np.arange(spans.sum()) - np.repeat(np.cumsum(spans) - spans, spans)
+    bounds = np.zeros(window_count)
+    np.maximum.at(bounds, windows, np.repeat(block_bounds, spans))
+    return bounds
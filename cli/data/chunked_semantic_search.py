@@ -2,55 +2,223 @@ import os
 import json
 import numpy as np
 
-from data.semantic_search import SemanticSearch
-from data.utils import get_semantic_chunks_from_str
+from data.ann import load_or_train_ivf
+from data.definitions import SEMANTIC_MODEL, SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP, ANN_NPROBE, EMBEDDING_STORAGE, RESCORE_CANDIDATES
+from data.embedding_table import EmbeddingTable
+from data.profiling import span, traced
+from data.quantization import load_or_quantize
+from data.ranking import top_k
+from data.semantic_search import SemanticSearch, ann_setting
+from data.utils import content_hash, get_semantic_chunks_from_str
 
 class ChunkedSemantticSearch(SemanticSearch):
-  def __init__(self, model_name="all-MiniLM-L6-v2") -> None:
-    super().__init__(model_name)
+  def __init__(self, model_name=SEMANTIC_MODEL, storage=EMBEDDING_STORAGE, rescore=RESCORE_CANDIDATES, cache_dir="cache") -> None:
+    super().__init__(model_name, storage, rescore, cache_dir)
+    self.chunk_table = EmbeddingTable(cache_dir, "chunk_embeddings")
     self.chunk_embeddings = None
-    self.chunk_metadata = None
+    self.normalized_chunk_embeddings = None
+    self.chunk_ann_index = None
+    # Parallel int32 arrays, one entry per chunk: the row of the movie in
+    # `self.documents` and the position of the chunk within that movie.
+    # Chunks of a movie are contiguous.
+    self.chunk_movie_idx = None
+    self.chunk_idx = None
+    self.chunk_version = None
 
+  @traced("chunks.build")
   def build_chunk_embeddings(self, documents):
-    # self.build_embeddings(documents)
-    
-    self.chunk_embeddings = []
-    self.chunk_metadata = []
-
-    chunks = []
-    for doc_idx, doc in enumerate(self.documents):
-      if not doc["description"]:
-        continue
-      doc_chunks = get_semantic_chunks_from_str(doc["description"], 4, 1)
-
-      for chunk in doc_chunks:
-        chunk_idx = len(chunks)
-        chunks.append(chunk)
-        self.chunk_metadata.append({
-          "movie_idx": doc_idx,
-          "chunk_idx": chunk_idx,
-          "total_chunks": len(doc_chunks)
-        })
-    
-    self.chunk_embeddings = self.model.encode(chunks, show_progress_bar=True)
-
-    np.save(os.path.join("cache", "chunk_embeddings.npy"), self.chunk_embeddings)
-    with open(os.path.join("cache", "chunk_metadata.json"), "w") as f:
-      json.dump({"chunks": self.chunk_metadata, "total_chunks": len(self.chunk_metadata)}, f)
+    """Encode every chunk from scratch, discarding the cached embeddings.
+
+    `documents` is read once and may be a `MovieStream`.
+    """
+    self.load_or_create_embeddings(documents)
+    return self.__build_chunks()
+
+  def __build_chunks(self):
+    # Identical chunks recur across movies: each distinct one is encoded
+    # once, up front and in length order, so the table build below only
+    # reads the store. Stored chunks are skipped, which resumes an
+    # interrupted build.
+    documents = self.document_store
+    self.store.encode_missing(
+      (chunk for _, _, chunks in self.__chunk_entries(documents) for chunk in chunks), self.encode_texts, self.encode_batch_size
+    )
+    self.chunk_table = EmbeddingTable(self.cache_dir, "chunk_embeddings")
+    self.chunk_table.build(lambda: self.__chunk_entries(documents), self.__encode_chunks, self.encode_batch_size)
+    self.__save_chunk_table(False)
 
     return self.chunk_embeddings
 
+  @traced("chunks.open")
+  def load_chunk_embeddings(self, documents) -> np.ndarray:
+    """Open the saved movie and chunk embeddings for searching, like
+    `load_embeddings`; `documents` is only read to create or repair them."""
+    self.load_embeddings(documents)
+    if self.chunk_table.embeddings is None and not self.chunk_table.load():
+      return self.load_or_create_chunk_embeddings(documents)
+    try:
+      self.__save_chunk_table(False)
+    except KeyError:
+      # the movies were updated without their chunks
+      return self.load_or_create_chunk_embeddings(documents)
+    return self.chunk_embeddings
+
+  @traced("chunks.load")
   def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
+    """Load the cached chunk embeddings, re-chunking and encoding only the
+    movies whose description changed."""
     self.load_or_create_embeddings(documents)
-    embedding_cache_name = os.path.join("cache", "chunk_embeddings.npy")
-    metadata_cache_name = os.path.join("cache", "chunk_metadata.json")
-
-    if os.path.exists(embedding_cache_name) and os.path.exists(metadata_cache_name):
-      self.chunk_embeddings = np.load(embedding_cache_name)
-      
-      with open(metadata_cache_name) as f:
-        self.chunk_metadata = json.load(f)
-      
-      return self.chunk_embeddings
-
-    return self.build_chunk_embeddings(documents)
\ No newline at end of file
+    documents = self.document_store.view()
+    if self.chunk_table.embeddings is None and not self.chunk_table.load():
+      self.__convert_legacy_chunks(documents)
+      if self.chunk_table.embeddings is None:
+        return self.__build_chunks()
+
+    with span("chunks.sync"):
+      encoded, deleted = self.chunk_table.sync(self.__chunk_entries(documents), self.__encode_chunks)
+    self.__save_chunk_table(encoded or deleted)
+    return self.chunk_embeddings
+
+  def load_embeddings_to_update(self, documents):
+    """Open the movie embeddings, and the chunk embeddings when they were
+    built, for `upsert_documents` and `delete_documents`."""
+    if self.chunk_table.exists():
+      self.load_chunk_embeddings(documents)
+    else:
+      self.load_embeddings(documents)
+
+  def upsert_documents(self, documents):
+    # without chunk embeddings loaded, only the movie embeddings change
+    documents = super().upsert_documents(documents)
+    if self.chunk_embeddings is not None:
+      self.__save_chunk_table(self.chunk_table.upsert(self.__chunk_entries(documents), self.__encode_chunks))
+    return documents
+
+  def delete_documents(self, doc_ids):
+    removed = super().delete_documents(doc_ids)
+    if self.chunk_embeddings is not None:
+      self.__save_chunk_table(self.chunk_table.delete(removed))
+    return removed
+
+  @traced("ann.load")
+  def load_or_create_chunk_ann_index(self, nprobe=ANN_NPROBE):
+    """Use an IVF index for `search_chunks` instead of scanning every chunk."""
+    if self.chunk_embeddings is None:
+      raise ValueError("No chunk embeddings loaded. Call `load_chunk_embeddings` first.")
+
+    self.chunk_ann_index = load_or_train_ivf(
+      os.path.join(self.cache_dir, f"chunk_embeddings.{self.storage}.ivf.npz"), self.normalized_chunk_embeddings, nprobe, self.chunk_table.fingerprint()
+    )
+    return self.chunk_ann_index
+
+  @traced("chunks.search")
+  def search_chunks(self, query: str, limit: int) -> list[dict]:
+    """Rank movies by the similarity of their best matching chunk."""
+    if self.chunk_embeddings is None:
+      raise ValueError("No chunk embeddings loaded. Call `load_chunk_embeddings` first.")
+
+    return self.result_cache.cached(
+      ("search_chunks", " ".join(query.split()), limit, self.query_setting(), ann_setting(self.chunk_ann_index), self.storage_setting()),
+      self.chunk_version,
+      lambda: self.__search_chunks(query, limit),
+    )
+
+  def __search_chunks(self, query, limit):
+    query_embedding = self.generate_embedding(query)
+    vectors = self.normalized_chunk_embeddings
+    if self.chunk_ann_index is None:
+      rows = np.arange(len(self.chunk_movie_idx))
+      scores = vectors.scores(query_embedding)
+    else:
+      rows = self.chunk_ann_index.candidates(query_embedding)
+      scores = vectors.scores(query_embedding, rows)
+    if len(rows) == 0:
+      return []
+    if self.rescore > 0 and not vectors.exact:
+      # every chunk of the best movies is scored again in float32
+      starts = np.flatnonzero(np.diff(self.chunk_movie_idx[rows], prepend=-1))
+      best = np.zeros(len(starts), dtype=bool)
+      best[top_k(np.maximum.reduceat(scores, starts), max(limit, self.rescore))] = True
+      rows = rows[np.repeat(best, np.diff(np.append(starts, len(rows))))]
+      scores = vectors.exact_scores(query_embedding, rows)
+
+    # rows are sorted and chunks of a movie are contiguous, so a max-reduction
+    # over each run of equal movie_idx gives the movie score
+    starts = np.flatnonzero(np.diff(self.chunk_movie_idx[rows], prepend=-1))
+    ends = np.append(starts[1:], len(scores))
+    movie_scores = np.maximum.reduceat(scores, starts)
+
+    results = []
+    for segment in top_k(movie_scores, limit).tolist():
+      best_chunk = rows[starts[segment] + int(np.argmax(scores[starts[segment]:ends[segment]]))]
+      doc = self.documents[self.chunk_movie_idx[best_chunk]]
+      chunks = get_semantic_chunks_from_str(doc["description"], SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP)
+      results.append({
+        "score": float(movie_scores[segment]),
+        "title": doc["title"],
+        "description": doc["description"],
+        "chunk": chunks[self.chunk_idx[best_chunk]],
+      })
+    return results
+
+  def __chunk_entries(self, documents):
+    for doc in documents:
+      chunks = []
+      if doc["description"]:
+        chunks = get_semantic_chunks_from_str(doc["description"], SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP)
+      yield doc["id"], self.__chunks_hash(doc), chunks
+
+  def __chunks_hash(self, doc):
+    # the chunks depend on the chunking parameters, their rows on the model
+    return content_hash(f"{self.model_name}\n{SEMANTIC_CHUNK_SIZE}\n{SEMANTIC_CHUNK_OVERLAP}\n{doc["description"]}")
+
+  def __encode_chunks(self, chunks):
+    return self.store.encode(chunks, self.encode_texts, self.encode_batch_size)
+
+  def __save_chunk_table(self, changed):
+    if changed:
+      self.chunk_table.compact_if_needed()
+      self.chunk_table.save()
+
+    # the rows of a movie are appended together and dropped together, so the
+    # live chunks of a movie stay contiguous
+    live = self.chunk_table.live_rows()
+    self.chunk_embeddings = self.chunk_table.embeddings if len(live) == len(self.chunk_table.live) else self.chunk_table.embeddings[live]
+    self.chunk_movie_idx = self.documents.positions(self.chunk_table.keys[live]).astype(np.int32)
+    self.chunk_idx = self.chunk_table.parts[live]
+    # chunk rows point into `documents`, so both tables version the results
+    self.chunk_version = (self.version, self.chunk_table.fingerprint())
+    self.normalized_chunk_embeddings = load_or_quantize(
+      os.path.join(self.cache_dir, f"chunk_embeddings.{self.storage}.npz"), self.chunk_embeddings, self.storage, self.chunk_version[1]
+    )
+
+  def __convert_legacy_chunks(self, documents):
+    # earlier versions saved the row of each chunk's movie in `documents`,
+    # either as .npy arrays or in chunk_metadata.json
+    cache_name = os.path.join(self.cache_dir, "chunk_embeddings.npy")
+    if not os.path.exists(cache_name):
+      return
+
+    names = [os.path.join(self.cache_dir, f"{name}.npy") for name in ("chunk_movie_idx", "chunk_idx")]
+    legacy_name = os.path.join(self.cache_dir, "chunk_metadata.json")
+    if all(map(os.path.exists, names)):
+      movie_idx, chunk_idx = map(np.load, names)
+    elif os.path.exists(legacy_name):
+      with open(legacy_name) as f:
+        chunks = json.load(f)["chunks"]
+      movie_idx = np.array([chunk["movie_idx"] for chunk in chunks], dtype=np.int32)
+      starts = np.flatnonzero(np.diff(movie_idx, prepend=-1))
+      chunk_idx = np.arange(len(chunks)) - np.repeat(starts, np.diff(np.append(starts, len(chunks))))
+    else:
+      return
+
+    embeddings = np.load(cache_name, mmap_mode="r")
+    if len(embeddings) != len(movie_idx) or (len(movie_idx) and movie_idx.max() >= len(documents)):
+      return
+    docs = [documents[row] for row in movie_idx.tolist()]
+    self.chunk_table.reset(
+      embeddings,
+      [doc["id"] for doc in docs],
+      [self.__chunks_hash(doc) for doc in docs],
+      chunk_idx,
+    )
@@ -0,0 +1,34 @@
+import json
+import socket
+
+from data.definitions import SERVER_SOCKET
+
+def request(command: str, path: str = SERVER_SOCKET, **params):
+  """Forward a command to a running query server.
+
+  Parameters left as None are not sent, so the server uses its own. Returns
+  the server results, or None when no server is listening on `path` or it
+  cannot answer with the settings asked for, so the caller can answer the
+  query locally.
+  """
+  params = {name: value for name, value in params.items() if value is not None}
+  if not hasattr(socket, "AF_UNIX"):
+    return None
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except (FileNotFoundError, ConnectionRefusedError):
+    sock.close()
+    return None
+
+  with sock, sock.makefile("rwb") as f:
+    f.write(json.dumps({"command": command, **params}).encode() + b"\n")
+    f.flush()
+    response = json.loads(f.readline())
+
+  if "unsupported" in response:
+    return None
+  if "error" in response:
+    raise RuntimeError(f"server error: {response["error"]}")
+  return response["results"]
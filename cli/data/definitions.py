@@ -1,2 +1,57 @@
+import os
+
+# words whose stem the tokenizer remembers
+STEM_CACHE_SIZE = 100_000
+
 BM25_K1 = 1.5
-BM25_B = 0.75
\ No newline at end of file
+BM25_B = 0.75
+# postings per block summarized in the index, and rows per window visited
+# by pruned top-k retrieval
+BM25_BLOCK_SIZE = 128
+BM25_WINDOW = 4096
+# decoded terms an index keeps: a query looks each of its terms up several
+# times (membership, postings, IDF, blocks) and decodes it once
+TERM_CACHE_SIZE = 64
+
+SEMANTIC_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CHUNK_SIZE = 4
+SEMANTIC_CHUNK_OVERLAP = 1
+
+ANN_NPROBE = 8
+
+# precision of the embeddings searched in memory (float32, float16, int8 or
+# binary), and how many of their best rows are rescored with the float32 file.
+# Only float32 ranks exactly; the others are opt-in with --storage
+EMBEDDING_STORAGE = "float32"
+STORAGE_MODES = ("float32", "float16", "int8", "binary")
+RESCORE_CANDIDATES = 100
+
+SERVER_SOCKET = os.path.join("cache", "hoopla.sock")
+
+HYBRID_CANDIDATES = 100
+HYBRID_ALPHA = 0.5
+RRF_K = 60
+
+# fraction of dead rows or documents above which incremental updates are
+# folded back into a fresh index or embedding file
+COMPACTION_RATIO = 0.1
+
+# query results kept per process (or per cache file) and for how many seconds
+QUERY_CACHE_SIZE = 10_000
+QUERY_CACHE_TTL = 3600
+
+# texts per model call, each batch committed to the embedding store as it is done
+EMBED_BATCH_SIZE = 1024
+
+# least recently used embeddings are dropped from the store past this size
+EMBEDDING_STORE_MAX_ENTRIES = 200_000
+
+# queries the query encoder coalesces into one model call, and how long it
+# waits for more after the first one; with no wait, a batch is whatever
+# queued up while the model was busy
+QUERY_BATCH_SIZE = 32
+QUERY_BATCH_WAIT_MS = 0
+# precision of the model encoding queries; int8 is dynamically quantized and
+# must keep this cosine similarity with float32 on calibration queries
+QUERY_PRECISIONS = ("float32", "int8")
+QUANTIZED_MIN_COSINE = 0.99
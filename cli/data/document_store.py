@@ -0,0 +1,219 @@
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from collections.abc import Sequence
+from contextlib import ExitStack
+from itertools import batched
+
+import numpy as np
+
+# Document store layout (little endian):
+#
+#   header              magic, format version, section count, row count, doc count
+#   section table       (offset, length) of every section below, in this order
+#   row_ids             int64[row_count], document id of every row
+#   ids                 int64[doc_count], ascending and distinct
+#   id_rows             uint32[doc_count], row holding each of `ids`
+#   title_offsets       uint64[row_count + 1] into `titles`
+#   titles              UTF-8 titles, one after the other
+#   description_offsets uint64[row_count + 1] into `descriptions`
+#   descriptions        UTF-8 descriptions
+#
+# Rows are in the order the documents were written; a document written
+# twice keeps its last row. Every section starts on an 8-byte boundary.
+
+# the movies of a cache directory, as seen by the last load of its embeddings
+DOCUMENTS_FILE = "documents.bin"
+
+MAGIC = b"HOOPLADS"
+FORMAT_VERSION = 1
+# documents encoded per write by `write_document_store`
+WRITE_BATCH_SIZE = 1024
+# text fields of a document, each stored as an offsets section and a blob
+FIELDS = ("title", "description")
+SECTIONS = ("row_ids", "ids", "id_rows", *(name for field in FIELDS for name in (f"{field}_offsets", f"{field}s")))
+
+_HEADER = struct.Struct("<8sIIQQ")
+_SECTION = struct.Struct("<QQ")
+
+def field_sections(documents) -> dict[str, bytes]:
+  """The offsets and blob section of every field of `documents`, in order."""
+  blobs = {field: [] for field in FIELDS}
+  for doc in documents:
+    for field in FIELDS:
+      blobs[field].append(doc[field].encode())
+  sections = {}
+  for field in FIELDS:
+    sections[f"{field}_offsets"] = np.cumsum([0] + [len(blob) for blob in blobs[field]], dtype="<u8").tobytes()
+    sections[f"{field}s"] = b"".join(blobs[field])
+  return sections
+
+class DocumentFields:
+  """The text fields of every row, sliced out of their blobs in `buffer`.
+
+  `sections` maps a section name to its (offset, length) in `buffer`. Only
+  the rows asked for are read and decoded.
+  """
+  def __init__(self, buffer, sections: dict) -> None:
+    self.buffer = buffer
+    self.blobs = {field: sections[f"{field}s"][0] for field in FIELDS}
+    self.offsets = {}
+    for field in FIELDS:
+      offset, length = sections[f"{field}_offsets"]
+      self.offsets[field] = np.frombuffer(buffer, dtype="<u8", count=length // 8, offset=offset)
+
+  def field(self, field: str, row: int) -> str:
+    start, offsets = self.blobs[field], self.offsets[field]
+    return self.buffer[start + int(offsets[row]):start + int(offsets[row + 1])].decode()
+
+  def document(self, doc_id: int, row: int) -> dict:
+    return {"id": doc_id, **{field: self.field(field, row) for field in FIELDS}}
+
+def write_document_store(path: str, documents) -> int:
+  """Write `documents` to a store at `path`, reading them once. Their text
+  goes through temporary files rather than memory.
+
+  Returns the number of distinct documents.
+  """
+  row_ids = []
+  sizes = {field: [0] for field in FIELDS}
+  with ExitStack() as stack:
+    spools = {field: stack.enter_context(tempfile.TemporaryFile()) for field in FIELDS}
+    for batch in batched(documents, WRITE_BATCH_SIZE):
+      row_ids.extend(doc["id"] for doc in batch)
+      for field in FIELDS:
+        blobs = [doc[field].encode() for doc in batch]
+        spools[field].write(b"".join(blobs))
+        sizes[field].extend(map(len, blobs))
+
+    row_ids = np.array(row_ids, dtype=np.int64)
+    # stable, so the last row of an id written twice ends each run
+    order = np.argsort(row_ids, kind="stable")
+    last = np.append(row_ids[order][1:] != row_ids[order][:-1], True) if len(order) else np.empty(0, dtype=bool)
+    sections = {
+      "row_ids": row_ids.astype("<i8").tobytes(),
+      "ids": row_ids[order][last].astype("<i8").tobytes(),
+      "id_rows": order[last].astype("<u4").tobytes(),
+    }
+    for field in FIELDS:
+      sections[f"{field}_offsets"] = np.cumsum(sizes[field], dtype="<u8").tobytes()
+      sections[f"{field}s"] = spools[field]
+
+    position = _align(_HEADER.size + _SECTION.size * len(SECTIONS))
+    table = []
+    for name in SECTIONS:
+      table.append((position, _length(sections[name])))
+      position = _align(position + table[-1][1])
+
+    # written next to the target and renamed, like the index files; every
+    # process loading the embeddings rewrites the store, so each writes a
+    # file of its own
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "bw") as f:
+      f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(SECTIONS), len(row_ids), int(last.sum())))
+      for entry in table:
+        f.write(_SECTION.pack(*entry))
+      for name, (offset, _) in zip(SECTIONS, table):
+        f.write(b"\0" * (offset - f.tell()))
+        if isinstance(sections[name], bytes):
+          f.write(sections[name])
+        else:
+          sections[name].seek(0)
+          shutil.copyfileobj(sections[name], f)
+  os.replace(temporary, path)
+  return int(last.sum())
+
+def _align(position: int) -> int:
+  return (position + 7) & ~7
+
+def _length(section) -> int:
+  return len(section) if isinstance(section, bytes) else section.tell()
+
+def _find(sorted_ids, doc_ids):
+  # position of every id of `doc_ids` in `sorted_ids`
+  doc_ids = np.asarray(doc_ids, dtype=np.int64)
+  positions = np.searchsorted(sorted_ids, doc_ids)
+  found = positions < len(sorted_ids)
+  found[found] = sorted_ids[positions[found]] == doc_ids[found]
+  if not found.all():
+    raise KeyError(int(doc_ids[~found][0]))
+  return positions
+
+class DocumentStore:
+  """Read-only documents of a file written by `write_document_store`,
+  opened with `mmap`.
+
+  Opening parses the header and maps the id arrays; titles and
+  descriptions are read only for the rows a caller fetches. Iterating
+  yields every document, in the order they were written.
+  """
+  def __init__(self, path: str) -> None:
+    self.path = path
+    with open(path, "br") as f:
+      self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, section_count, self.row_count, self.doc_count = _HEADER.unpack_from(self.buffer)
+    if magic != MAGIC:
+      raise IOError(f"{path} is not a document store")
+    if version != FORMAT_VERSION:
+      raise IOError(f"{path} has document store version {version}, expected {FORMAT_VERSION}")
+
+    sections = {}
+    for i, name in enumerate(SECTIONS[:section_count]):
+      sections[name] = _SECTION.unpack_from(self.buffer, _HEADER.size + i * _SECTION.size)
+    self.row_ids = np.frombuffer(self.buffer, dtype="<i8", count=self.row_count, offset=sections["row_ids"][0])
+    self.ids = np.frombuffer(self.buffer, dtype="<i8", count=self.doc_count, offset=sections["ids"][0])
+    self.id_rows = np.frombuffer(self.buffer, dtype="<u4", count=self.doc_count, offset=sections["id_rows"][0])
+    self.fields = DocumentFields(self.buffer, sections)
+
+  def __len__(self) -> int:
+    return self.doc_count
+
+  def __iter__(self):
+    return iter(self.view())
+
+  def rows(self, doc_ids) -> np.ndarray:
+    """The row of every id in `doc_ids`; KeyError if one is missing."""
+    return self.id_rows[_find(self.ids, doc_ids)].astype(np.int64)
+
+  def document(self, row: int) -> dict:
+    return self.fields.document(int(self.row_ids[row]), row)
+
+  def view(self, rows=None) -> "DocumentRows":
+    """The documents at `rows`, or every document in the order they were written."""
+    return DocumentRows(self, np.sort(self.id_rows) if rows is None else rows)
+
+  def close(self) -> None:
+    self.buffer.close()
+
+class DocumentRows(Sequence):
+  """The documents at `rows` of a store, in that order: a list of documents
+  whose items are read when indexed."""
+  def __init__(self, store: DocumentStore, rows) -> None:
+    self.store = store
+    self.rows = np.asarray(rows, dtype=np.int64)
+    self.__by_id = None
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return DocumentRows(self.store, self.rows[i])
+    return self.store.document(int(self.rows[i]))
+
+  def __len__(self) -> int:
+    return len(self.rows)
+
+  def ids(self) -> np.ndarray:
+    return self.store.row_ids[self.rows]
+
+  def positions(self, doc_ids) -> np.ndarray:
+    """The position of every id in `doc_ids` within these documents; KeyError
+    if one is missing."""
+    if self.__by_id is None:
+      ids = self.ids()
+      order = np.argsort(ids, kind="stable")
+      self.__by_id = (ids[order], order)
+    ids, order = self.__by_id
+    return order[_find(ids, doc_ids)]
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import sqlite3
+
+from itertools import batched
+
+import numpy as np
+
+from data.definitions import EMBED_BATCH_SIZE, EMBEDDING_STORE_MAX_ENTRIES
+from data.profiling import count
+
+EMBEDDING_STORE_FILE = os.path.join("cache", "embeddings.sqlite")
+
+class EmbeddingStore:
+  """Persistent embeddings keyed by (model name, text hash).
+
+  Every text is encoded at most once per model, whichever index or query
+  asks for it. Entries are evicted least recently used first once there are
+  more than `max_entries`. `hits` and `misses` count lookups made through
+  this instance; `stats` also reports the totals of every run.
+  """
+  def __init__(self, model_name: str, path: str = EMBEDDING_STORE_FILE, max_entries: int = EMBEDDING_STORE_MAX_ENTRIES) -> None:
+    self.model_name = model_name
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # the query server encodes on a worker thread
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("""
+      CREATE TABLE IF NOT EXISTS embeddings (
+        model TEXT NOT NULL,
+        hash BLOB NOT NULL,
+        dim INTEGER NOT NULL,
+        vector BLOB NOT NULL,
+        last_used INTEGER NOT NULL,
+        PRIMARY KEY (model, hash)
+      ) WITHOUT ROWID
+    """)
+    self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+    self.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    self.db.commit()
+    self.clock = self.db.execute("SELECT COALESCE(MAX(last_used), 0) FROM embeddings").fetchone()[0]
+
+  def encode(self, texts: list[str], encode, batch_size: int = EMBED_BATCH_SIZE) -> np.ndarray:
+    """Embeddings of `texts`, calling `encode` only on texts not stored yet."""
+    keys = [text_hash(text) for text in texts]
+    vectors = self.__lookup(set(keys))
+
+    missing = {}
+    for key, text in zip(keys, texts):
+      if key not in vectors:
+        missing.setdefault(key, text)
+    hits = len(keys) - len(missing)
+    self.hits += hits
+    self.misses += len(missing)
+    count("embedding_store.hits", hits)
+    count("embedding_store.misses", len(missing))
+
+    self.clock += 1
+    self.db.executemany(
+      "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+      [(self.clock, self.model_name, key) for key in set(keys) - missing.keys()],
+    )
+    self.__count(hits, 0)
+    self.db.commit()
+    for batch, encoded in self.__encode_missing(missing, encode, batch_size):
+      vectors.update(zip(batch, encoded))
+
+    if not texts:
+      return np.empty((0, 0), dtype=np.float32)
+    return np.stack([vectors[key] for key in keys])
+
+  def encode_missing(self, texts, encode, batch_size: int = EMBED_BATCH_SIZE) -> int:
+    """Encode and store every distinct text of `texts` that is not stored yet.
+
+    `texts` may be any iterable. Nothing is returned but the number of texts
+    encoded; a later `encode` of the same texts only reads the store.
+    """
+    unique = {}
+    for text in texts:
+      unique.setdefault(text_hash(text), text)
+    stored = self.__stored(unique)
+    missing = {key: text for key, text in unique.items() if key not in stored}
+    self.misses += len(missing)
+    count("embedding_store.hits", len(unique) - len(missing))
+    count("embedding_store.misses", len(missing))
+
+    for _ in self.__encode_missing(missing, encode, batch_size):
+      pass
+    return len(missing)
+
+  def __encode_missing(self, missing, encode, batch_size):
+    # Shortest texts first, so every batch pads its texts to a similar length.
+    # Each batch is committed as soon as it is encoded: an interrupted build
+    # resumes after the last stored batch.
+    keys = sorted(missing, key=lambda key: len(missing[key]))
+    for batch in batched(keys, batch_size):
+      encoded = np.asarray(encode([missing[key] for key in batch]), dtype=np.float32)
+      self.clock += 1
+      self.db.executemany(
+        "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)",
+        [(self.model_name, key, len(vector), vector.tobytes(), self.clock) for key, vector in zip(batch, encoded)],
+      )
+      self.__count(0, len(batch))
+      self.__evict()
+      self.db.commit()
+      yield batch, encoded
+
+  def stats(self) -> dict:
+    entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+    counters = dict(self.db.execute("SELECT name, value FROM counters"))
+    return {
+      "entries": entries,
+      "bytes": size,
+      "max_entries": self.max_entries,
+      "hits": self.hits,
+      "misses": self.misses,
+      "total_hits": counters.get("hits", 0),
+      "total_misses": counters.get("misses", 0),
+    }
+
+  def close(self) -> None:
+    self.db.close()
+
+  def __lookup(self, keys):
+    return {key: np.frombuffer(vector, dtype=np.float32) for key, vector in self.__select("hash, vector", keys)}
+
+  def __stored(self, keys):
+    return {key for key, in self.__select("hash", keys)}
+
+  def __select(self, columns, keys):
+    keys = list(keys)
+    # stay below SQLite's limit on bound parameters
+    for start in range(0, len(keys), 500):
+      batch = keys[start:start + 500]
+      yield from self.db.execute(
+        f"SELECT {columns} FROM embeddings WHERE model = ? AND hash IN ({",".join("?" * len(batch))})",
+        [self.model_name, *batch],
+      )
+
+  def __count(self, hits, misses):
+    self.db.executemany(
+      "INSERT INTO counters VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+      [("hits", hits), ("misses", misses)],
+    )
+
+  def __evict(self):
+    excess = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+    if excess > 0:
+      self.db.execute(
+        "DELETE FROM embeddings WHERE (model, hash) IN (SELECT model, hash FROM embeddings ORDER BY last_used LIMIT ?)",
+        (excess,),
+      )
+
+def text_hash(text: str) -> bytes:
+  return hashlib.blake2b(text.encode(), digest_size=16).digest()
@@ -0,0 +1,224 @@
+import hashlib
+import io
+import os
+
+from itertools import batched
+
+import numpy as np
+
+from data.definitions import COMPACTION_RATIO, EMBED_BATCH_SIZE
+
+class EmbeddingTable:
+  """Embedding rows keyed by document id, with the content hash they were
+  encoded from.
+
+  A document may own several consecutive rows (one per chunk), numbered by
+  `parts`. Updating a document appends new rows to the .npy file in place
+  and tombstones the old ones in `live`; once dead rows exceed
+  COMPACTION_RATIO the table is rewritten with live rows only.
+  """
+  COLUMNS = ("keys", "hashes", "parts", "live")
+
+  def __init__(self, cache_dir: str, name: str) -> None:
+    self.path = os.path.join(cache_dir, name)
+    self.embeddings = None
+    self.keys = np.empty(0, dtype=np.int64)
+    self.hashes = np.empty(0, dtype=np.uint64)
+    self.parts = np.empty(0, dtype=np.int32)
+    self.live = np.empty(0, dtype=bool)
+    # leading rows of `embeddings` that are in the .npy file, which `save`
+    # leaves alone
+    self.saved_rows = 0
+
+  def __file(self, column: str | None = None) -> str:
+    return f"{self.path}.npy" if column is None else f"{self.path}.{column}.npy"
+
+  def exists(self) -> bool:
+    return all(os.path.exists(self.__file(column)) for column in (None, *self.COLUMNS))
+
+  def load(self) -> bool:
+    if not self.exists():
+      return False
+
+    # mapped, so only the rows that are used get read
+    self.embeddings = np.load(self.__file(), mmap_mode="r")
+    for column in self.COLUMNS:
+      setattr(self, column, np.load(self.__file(column)))
+    # the columns are saved last: rows appended past them belong to an
+    # update that never completed
+    self.embeddings = self.embeddings[:len(self.keys)]
+    self.saved_rows = len(self.keys)
+    return True
+
+  def save(self) -> None:
+    if self.saved_rows != len(self.embeddings):
+      self.__save_array(self.__file(), self.embeddings)
+      self.saved_rows = len(self.embeddings)
+    self.__save_columns()
+
+  def __save_columns(self):
+    for column in self.COLUMNS:
+      self.__save_array(self.__file(column), getattr(self, column))
+
+  def __save_array(self, path, array):
+    # never truncate a file that may still be mapped, by us or a reader
+    with open(f"{path}.tmp", "bw") as f:
+      np.save(f, array)
+    os.replace(f"{path}.tmp", path)
+
+  def build(self, entries, encode, batch_size: int = EMBED_BATCH_SIZE) -> int:
+    """Replace the table with the embeddings of `entries` and save it.
+
+    `entries()` yields (key, hash, texts) and is called twice: once to size
+    the table and once to encode the texts `batch_size` at a time straight
+    into a preallocated memory-mapped .npy, so neither the texts nor the
+    matrix are ever all in memory. Returns the number of rows.
+    """
+    keys, hashes, parts = [], [], []
+    for key, content_hash, texts in entries():
+      keys.extend([key] * len(texts))
+      hashes.extend([content_hash] * len(texts))
+      parts.extend(range(len(texts)))
+
+    path = f"{self.__file()}.tmp"
+    embeddings = None
+    row = 0
+    for batch in batched((text for _, _, texts in entries() for text in texts), batch_size):
+      vectors = np.asarray(encode(list(batch)))
+      if embeddings is None:
+        embeddings = np.lib.format.open_memmap(path, mode="w+", dtype=vectors.dtype, shape=(len(keys), vectors.shape[1]))
+      embeddings[row:row + len(vectors)] = vectors
+      row += len(vectors)
+
+    if embeddings is None:
+      with open(path, "bw") as f:
+        np.save(f, np.empty((0, 0), dtype=np.float32))
+    else:
+      embeddings.flush()
+      del embeddings
+    os.replace(path, self.__file())
+
+    self.reset(np.load(self.__file(), mmap_mode="r"), keys, hashes, parts)
+    self.saved_rows = len(keys)
+    self.__save_columns()
+    return len(keys)
+
+  def reset(self, embeddings, keys, hashes, parts) -> None:
+    self.embeddings = embeddings
+    self.keys = np.asarray(keys, dtype=np.int64)
+    self.hashes = np.asarray(hashes, dtype=np.uint64)
+    self.parts = np.asarray(parts, dtype=np.int32)
+    self.live = np.ones(len(self.keys), dtype=bool)
+    self.saved_rows = 0
+
+  def live_rows(self) -> np.ndarray:
+    return np.flatnonzero(self.live)
+
+  def fingerprint(self) -> str:
+    """Identify the live rows, so derived caches know when to rebuild."""
+    live = self.live_rows()
+    digest = hashlib.blake2b(digest_size=16)
+    for column in (self.keys, self.hashes, self.parts):
+      digest.update(column[live].tobytes())
+    return digest.hexdigest()
+
+  def upsert(self, entries, encode) -> int:
+    """Encode the documents whose content changed and append their rows.
+
+    `entries` yields (key, hash, texts); `encode` turns a list of texts into
+    embeddings. Returns the number of encoded texts.
+    """
+    current = dict(zip(self.keys[self.live].tolist(), self.hashes[self.live].tolist()))
+
+    texts, keys, hashes, parts, stale = [], [], [], [], []
+    for key, content_hash, key_texts in entries:
+      if current.get(key) == content_hash:
+        continue
+      if key in current:
+        stale.append(key)
+      for part, text in enumerate(key_texts):
+        texts.append(text)
+        keys.append(key)
+        hashes.append(content_hash)
+        parts.append(part)
+
+    self.delete(stale)
+    if texts:
+      self.__append(np.asarray(encode(texts)))
+      self.keys = np.concatenate((self.keys, np.array(keys, dtype=np.int64)))
+      self.hashes = np.concatenate((self.hashes, np.array(hashes, dtype=np.uint64)))
+      self.parts = np.concatenate((self.parts, np.array(parts, dtype=np.int32)))
+      self.live = np.concatenate((self.live, np.ones(len(texts), dtype=bool)))
+    return len(texts)
+
+  def __append(self, embeddings):
+    # Rows go straight to the end of the saved file, which stays mapped:
+    # neither the matrix nor the file are copied. A table not saved yet,
+    # or just compacted, is extended in memory until `save`.
+    if self.embeddings is None:
+      self.embeddings = embeddings
+    elif self.saved_rows == len(self.embeddings) and _append_rows(self.__file(), self.saved_rows, embeddings):
+      self.saved_rows += len(embeddings)
+      self.embeddings = np.load(self.__file(), mmap_mode="r")[:self.saved_rows]
+    else:
+      self.embeddings = np.concatenate((self.embeddings, embeddings))
+
+  def delete(self, keys) -> int:
+    """Tombstone every row of the given keys; returns the number of rows removed."""
+    removed = self.live & np.isin(self.keys, np.asarray(list(keys), dtype=np.int64))
+    self.live &= ~removed
+    return int(removed.sum())
+
+  def sync(self, entries, encode) -> tuple[int, int]:
+    """Make the table match `entries` exactly: upsert them and delete every
+    other key. Returns (encoded texts, deleted rows)."""
+    present = set()
+    def recorded():
+      for entry in entries:
+        present.add(entry[0])
+        yield entry
+
+    encoded = self.upsert(recorded(), encode)
+    deleted = self.delete(set(self.keys[self.live].tolist()) - present)
+    return encoded, deleted
+
+  def compact_if_needed(self) -> bool:
+    if (~self.live).sum() <= COMPACTION_RATIO * len(self.live):
+      return False
+    self.compact()
+    return True
+
+  def compact(self) -> None:
+    live = self.live_rows()
+    self.reset(self.embeddings[live], self.keys[live], self.hashes[live], self.parts[live])
+
+def _append_rows(path: str, count: int, rows: np.ndarray) -> bool:
+  """Write `rows` after the first `count` rows of the .npy file at `path` and
+  update its shape, in place. False if the file cannot take them that way.
+
+  The rows are written before the header, so a reader never sees a shape
+  the file does not hold; readers that mapped the file before keep their
+  rows. np.save pads the header for the first axis to grow, so its length
+  does not change.
+  """
+  with open(path, "r+b") as f:
+    if np.lib.format.read_magic(f) != (1, 0):
+      return False
+    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    data_offset = f.tell()
+    if fortran_order or dtype != rows.dtype or len(shape) != 2 or shape[1:] != rows.shape[1:] or count > shape[0]:
+      return False
+
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+      "descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (count + len(rows), shape[1]),
+    })
+    if len(header.getvalue()) != data_offset:
+      return False
+
+    f.seek(data_offset + count * dtype.itemsize * shape[1])
+    f.write(np.ascontiguousarray(rows).tobytes())
+    f.flush()
+    f.seek(0)
+    f.write(header.getvalue())
+  return True
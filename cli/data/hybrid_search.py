@@ -0,0 +1,92 @@
+import time
+
+import numpy as np
+
+from data.definitions import HYBRID_CANDIDATES, HYBRID_ALPHA, RRF_K
+from data.inverted_index import InvertedIndex
+from data.ranking import top_k
+from data.semantic_search import SemanticSearch
+
+def normalize_scores(scores: list[float]) -> list[float]:
+  """Min-max normalize scores to [0, 1]; equal scores all become 1."""
+  if not scores:
+    return []
+  low, high = min(scores), max(scores)
+  if high == low:
+    return [1.0] * len(scores)
+  return [(score - low) / (high - low) for score in scores]
+
+class HybridSearch:
+  """Fuse BM25 and semantic rankings, either by reciprocal rank or by a
+  weighted sum of min-max normalized scores."""
+  def __init__(self, index: InvertedIndex, semantic: SemanticSearch) -> None:
+    self.index = index
+    self.semantic = semantic
+
+  def search(self, query: str, limit: int, method: str = "rrf", alpha: float = HYBRID_ALPHA,
+             k: int = RRF_K, candidates: int = HYBRID_CANDIDATES, rerank: bool = False):
+    """Return the fused results and the time spent in each stage.
+
+    Each retriever contributes its `candidates` best documents. With `rerank`
+    the semantic side only scores the BM25 candidates instead of every
+    embedding.
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    bm25 = self.index.bm25_search(query, candidates)
+    timings["bm25"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    embedding = self.semantic.generate_embedding(query)
+    timings["encode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if rerank:
+      # movies indexed since the embeddings were last updated have no
+      # semantic score and are fused on their BM25 rank alone
+      ids = np.array([doc["id"] for doc, _ in bm25], dtype=np.int64)
+      rows = self.semantic.documents.positions(ids[np.isin(ids, self.semantic.documents.ids())])
+      scores = self.semantic.score_rows(embedding, rows)
+      best = top_k(scores, candidates)
+      rows, scores = rows[best], scores[best]
+    else:
+      rows, scores = self.semantic.top_k_rows(embedding, candidates)
+    semantic = [(self.semantic.documents[row], score) for row, score in zip(rows.tolist(), scores.tolist())]
+    timings["semantic"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    match method:
+      case "rrf":
+        results = self.__fuse(bm25, semantic, lambda rank: 1 / (k + rank), lambda rank: 1 / (k + rank))
+      case "weighted":
+        bm25_norm = normalize_scores([score for _, score in bm25])
+        semantic_norm = normalize_scores([score for _, score in semantic])
+        results = self.__fuse(bm25, semantic,
+                              lambda rank: alpha * bm25_norm[rank - 1],
+                              lambda rank: (1 - alpha) * semantic_norm[rank - 1])
+      case _:
+        raise ValueError(f"unknown fusion method: {method}")
+    results = sorted(results.values(), key=lambda result: result["score"], reverse=True)[:limit]
+    timings["fusion"] = time.perf_counter() - start
+
+    return results, timings
+
+  def __fuse(self, bm25, semantic, bm25_contribution, semantic_contribution):
+    results = {}
+    for source, ranking, contribution in (("bm25", bm25, bm25_contribution), ("semantic", semantic, semantic_contribution)):
+      for rank, (doc, score) in enumerate(ranking, 1):
+        result = results.setdefault(doc["id"], {
+          "id": doc["id"],
+          "title": doc["title"],
+          "description": doc["description"],
+          "score": 0.0,
+          "bm25_rank": None,
+          "bm25_score": None,
+          "semantic_rank": None,
+          "semantic_score": None,
+        })
+        result["score"] += contribution(rank)
+        result[f"{source}_rank"] = rank
+        result[f"{source}_score"] = score
+    return results
@@ -0,0 +1,450 @@
+import heapq
+import mmap
+import os
+import struct
+
+from collections import OrderedDict
+from collections.abc import Mapping
+from itertools import groupby
+
+import numpy as np
+
+from data.bm25 import bm25_idf, posting_blocks
+from data.definitions import TERM_CACHE_SIZE
+from data.document_store import DocumentFields, field_sections
+
+# Binary inverted index layout (little endian):
+#
+#   header          magic, format version, section count, doc count, term count
+#   section table   (offset, length) of every section below, in this order
+#   doc_ids         int64[doc_count], ascending; a document's row is its position
+#   doc_lengths     uint32[doc_count]
+#   doc_hashes      uint64[doc_count], content hash of the indexed text
+#   title_offsets   uint64[doc_count + 1] into `titles`
+#   titles          UTF-8 titles
+#   description_offsets uint64[doc_count + 1] into `descriptions`
+#   descriptions    UTF-8 descriptions
+#   term_offsets    uint64[term_count + 1] into `terms`
+#   terms           UTF-8 terms, sorted by their encoded bytes
+#   term_dfs        uint32[term_count]
+#   term_idfs       float64[term_count], BM25 IDF
+#   posting_offsets uint64[term_count + 1] into `postings`
+#   postings        per term: varint row deltas followed by varint tfs
+#   block_offsets   uint64[term_count + 1] into the block sections below
+#   block_last_rows uint32[block_count], last row of each block of postings
+#   block_max_tfs   uint32[block_count], highest tf in the block
+#   block_min_lengths uint32[block_count], shortest document in the block
+#
+# Documents are stored a field at a time, as in a document store (see
+# `document_store`), so a result reads its own title and description only.
+# Blocks summarize BM25_BLOCK_SIZE consecutive postings of a term, for
+# pruned top-k retrieval (see `posting_blocks`).
+# Every section starts on an 8-byte boundary so arrays can be viewed straight
+# from the memory map.
+
+MAGIC = b"HOOPLAIX"
+FORMAT_VERSION = 4
+SECTIONS = (
+  "doc_ids", "doc_lengths", "doc_hashes", "title_offsets", "titles", "description_offsets", "descriptions",
+  "term_offsets", "terms", "term_dfs", "term_idfs",
+  "posting_offsets", "postings",
+  "block_offsets", "block_last_rows", "block_max_tfs", "block_min_lengths",
+)
+
+_HEADER = struct.Struct("<8sIIQQ")
+_SECTION = struct.Struct("<QQ")
+
+def encode_varints(values: np.ndarray) -> bytes:
+  """LEB128-encode non-negative integers, 7 bits per byte."""
+  values = np.asarray(values, dtype=np.uint64)
+  if len(values) == 0:
+    return b""
+
+  sizes = np.ones(len(values), dtype=np.int64)
+  for shift in range(7, 64, 7):
+    sizes += values >= np.uint64(1 << shift)
+
+  owner = np.repeat(np.arange(len(values)), sizes)
+  position = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+  out = (values[owner] >> (7 * position).astype(np.uint64)) & np.uint64(0x7F)
+  out[position < sizes[owner] - 1] |= np.uint64(0x80)
+  return out.astype(np.uint8).tobytes()
+
+def decode_varints(data) -> np.ndarray:
+  """Decode a buffer produced by `encode_varints`."""
+  data = np.frombuffer(data, dtype=np.uint8)
+  if len(data) == 0:
+    return np.empty(0, dtype=np.int64)
+
+  ends = np.flatnonzero(data < 0x80)
+  starts = np.concatenate(([0], ends[:-1] + 1))
+  owner = np.repeat(np.arange(len(ends)), ends - starts + 1)
+  shifts = (7 * (np.arange(len(data)) - starts[owner])).astype(np.uint64)
+  payload = (data & 0x7F).astype(np.uint64) << shifts
+  return np.add.reduceat(payload, starts).astype(np.int64)
+
+def write_index(path: str, doc_ids, doc_lengths, doc_hashes, documents, postings, idf) -> None:
+  """Write an index to `path`.
+
+  `documents` yields the document of every row, with its title and description,
+  `postings` maps a term to its (rows, tfs) arrays and `idf` a term to its
+  BM25 IDF.
+  """
+  terms = sorted(postings, key=lambda term: term.encode())
+
+  term_blobs = [term.encode() for term in terms]
+  posting_blobs = []
+  blocks = []
+  lengths = np.asarray(doc_lengths)
+  for term in terms:
+    rows, tfs = postings[term]
+    deltas = np.diff(np.asarray(rows, dtype=np.int64), prepend=0)
+    posting_blobs.append(encode_varints(np.concatenate((deltas, tfs))))
+    blocks.append(posting_blocks(np.asarray(rows), np.asarray(tfs), lengths))
+
+  sections = {
+    "doc_ids": np.asarray(doc_ids, dtype="<i8").tobytes(),
+    "doc_lengths": np.asarray(doc_lengths, dtype="<u4").tobytes(),
+    "doc_hashes": np.asarray(doc_hashes, dtype="<u8").tobytes(),
+    **field_sections(documents),
+    "term_offsets": _offsets(term_blobs),
+    "terms": b"".join(term_blobs),
+    "term_dfs": np.array([len(postings[term][0]) for term in terms], dtype="<u4").tobytes(),
+    "term_idfs": np.array([idf[term] for term in terms], dtype="<f8").tobytes(),
+    "posting_offsets": _offsets(posting_blobs),
+    "postings": b"".join(posting_blobs),
+    "block_offsets": np.cumsum([0] + [len(block[0]) for block in blocks], dtype="<u8").tobytes(),
+    "block_last_rows": _concatenate([block[0] for block in blocks], "<u4"),
+    "block_max_tfs": _concatenate([block[1] for block in blocks], "<u4"),
+    "block_min_lengths": _concatenate([block[2] for block in blocks], "<u4"),
+  }
+
+  position = _align(_HEADER.size + _SECTION.size * len(SECTIONS))
+  table = []
+  for name in SECTIONS:
+    table.append((position, len(sections[name])))
+    position = _align(position + len(sections[name]))
+
+  # Write next to the target and rename, so readers that still have the
+  # previous file mapped keep a consistent view.
+  with open(f"{path}.tmp", "bw") as f:
+    f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(SECTIONS), len(doc_ids), len(terms)))
+    for entry in table:
+      f.write(_SECTION.pack(*entry))
+    for name, (offset, _) in zip(SECTIONS, table):
+      f.write(b"\0" * (offset - f.tell()))
+      f.write(sections[name])
+  os.replace(f"{path}.tmp", path)
+
+def _align(position: int) -> int:
+  return (position + 7) & ~7
+
+def _concatenate(arrays: list[np.ndarray], dtype: str) -> bytes:
+  return np.concatenate(arrays).astype(dtype).tobytes() if arrays else b""
+
+def _offsets(blobs: list[bytes]) -> bytes:
+  return np.cumsum([0] + [len(blob) for blob in blobs], dtype="<u8").tobytes()
+
+class TermCache:
+  """The (rows, tfs, idf, blocks) of the last `size` terms looked up, None
+  for a term no document contains.
+
+  `decode` computes the entry of a term on a miss. The index files are
+  never modified in place, so entries stay valid as long as the index.
+  """
+  def __init__(self, decode, size: int = TERM_CACHE_SIZE) -> None:
+    self.decode = decode
+    self.size = size
+    self.entries = OrderedDict()
+
+  def get(self, term: str):
+    if term in self.entries:
+      self.entries.move_to_end(term)
+      return self.entries[term]
+    entry = self.entries[term] = self.decode(term)
+    if len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+    return entry
+
+class MappedIndex:
+  """Read-only view of an index file opened with `mmap`.
+
+  Opening only parses the header; postings and documents are decoded when a
+  query asks for them, so resident memory follows the terms actually used.
+  """
+  def __init__(self, path: str) -> None:
+    with open(path, "br") as f:
+      self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, section_count, self.doc_count, self.term_count = _HEADER.unpack_from(self.buffer)
+    if magic != MAGIC:
+      raise IOError(f"{path} is not an index file")
+    if version != FORMAT_VERSION:
+      raise IOError(f"{path} has index format version {version}, expected {FORMAT_VERSION}")
+
+    self.sections = {}
+    for i, name in enumerate(SECTIONS[:section_count]):
+      self.sections[name] = _SECTION.unpack_from(self.buffer, _HEADER.size + i * _SECTION.size)
+
+    self.doc_ids = self.__array("doc_ids", "<i8")
+    self.doc_lengths = self.__array("doc_lengths", "<u4")
+    self.doc_hashes = self.__array("doc_hashes", "<u8")
+    self.documents = DocumentFields(self.buffer, self.sections)
+    self.term_offsets = self.__array("term_offsets", "<u8")
+    self.term_dfs = self.__array("term_dfs", "<u4")
+    self.term_idfs = self.__array("term_idfs", "<f8")
+    self.posting_offsets = self.__array("posting_offsets", "<u8")
+    self.block_offsets = self.__array("block_offsets", "<u8")
+    self.block_last_rows = self.__array("block_last_rows", "<u4")
+    self.block_max_tfs = self.__array("block_max_tfs", "<u4")
+    self.block_min_lengths = self.__array("block_min_lengths", "<u4")
+    self.term_cache = TermCache(self.__entry)
+
+  def __array(self, name: str, dtype: str) -> np.ndarray:
+    offset, length = self.sections[name]
+    return np.frombuffer(self.buffer, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=offset)
+
+  def __bytes(self, name: str, start: int, end: int) -> bytes:
+    offset, _ = self.sections[name]
+    return self.buffer[offset + start:offset + end]
+
+  def __term(self, term_id: int) -> str:
+    return self.__bytes("terms", int(self.term_offsets[term_id]), int(self.term_offsets[term_id + 1])).decode()
+
+  def __term_id(self, term: str) -> int | None:
+    key = term.encode()
+    low, high = 0, self.term_count
+    while low < high:
+      mid = (low + high) // 2
+      current = self.__bytes("terms", int(self.term_offsets[mid]), int(self.term_offsets[mid + 1]))
+      if current < key:
+        low = mid + 1
+      else:
+        high = mid
+    if low < self.term_count and self.__term(low) == term:
+      return low
+    return None
+
+  def terms(self):
+    """Iterate over the terms in dictionary order."""
+    return (self.__term(i) for i in range(self.term_count))
+
+  def term_postings(self, term: str):
+    """Return the (rows, tfs) of `term`, or None if no document contains it.
+
+    The postings are decoded on every call; queries go through `lookup`.
+    """
+    term_id = self.__term_id(term)
+    if term_id is None:
+      return None
+    return self.__postings(term_id)
+
+  def document_frequency(self, term: str) -> int:
+    """Number of documents containing `term`, without decoding its postings."""
+    term_id = self.__term_id(term)
+    return 0 if term_id is None else int(self.term_dfs[term_id])
+
+  def __postings(self, term_id: int):
+    df = int(self.term_dfs[term_id])
+    values = decode_varints(self.__bytes(
+      "postings", int(self.posting_offsets[term_id]), int(self.posting_offsets[term_id + 1])))
+    return np.cumsum(values[:df]).astype(np.int32), values[df:].astype(np.int32)
+
+  def lookup(self, term: str):
+    """Return the (rows, tfs, idf, blocks) of `term`, or None if no document
+    contains it; `blocks` are its `posting_blocks`."""
+    return self.term_cache.get(term)
+
+  def __entry(self, term):
+    term_id = self.__term_id(term)
+    if term_id is None:
+      return None
+    start, end = int(self.block_offsets[term_id]), int(self.block_offsets[term_id + 1])
+    blocks = self.block_last_rows[start:end], self.block_max_tfs[start:end], self.block_min_lengths[start:end]
+    return *self.__postings(term_id), float(self.term_idfs[term_id]), blocks
+
+  def row(self, doc_id: int) -> int | None:
+    row = int(np.searchsorted(self.doc_ids, doc_id))
+    if row < self.doc_count and self.doc_ids[row] == doc_id:
+      return row
+    return None
+
+  def document(self, row: int) -> dict:
+    return self.documents.document(int(self.doc_ids[row]), row)
+
+  def close(self) -> None:
+    self.buffer.close()
+
+class MergedIndex:
+  """A base index overlaid with a delta segment and deleted document ids.
+
+  Documents of the delta segment replace base documents with the same id;
+  `deleted` ids are hidden from the base. Rows are renumbered by ascending
+  id across both segments, and IDF is recomputed from the live document
+  counts, so scores match an index rebuilt from scratch.
+  """
+  def __init__(self, base: MappedIndex, delta: MappedIndex, deleted: np.ndarray) -> None:
+    self.base = base
+    self.delta = delta
+
+    base_live = np.flatnonzero(~np.isin(base.doc_ids, deleted) & ~np.isin(base.doc_ids, delta.doc_ids))
+    doc_ids = np.concatenate((base.doc_ids[base_live], delta.doc_ids))
+    order = np.argsort(doc_ids, kind="stable")
+    self.doc_ids = doc_ids[order]
+    self.doc_lengths = np.concatenate((base.doc_lengths[base_live], delta.doc_lengths))[order]
+    self.doc_hashes = np.concatenate((base.doc_hashes[base_live], delta.doc_hashes))[order]
+    self.doc_count = len(self.doc_ids)
+
+    # segment row -> merged row (-1 when hidden) and back
+    merged_rows = np.empty(len(order), dtype=np.int32)
+    merged_rows[order] = np.arange(len(order), dtype=np.int32)
+    self.base_rows = np.full(base.doc_count, -1, dtype=np.int32)
+    self.base_rows[base_live] = merged_rows[:len(base_live)]
+    self.delta_rows = merged_rows[len(base_live):]
+    self.sources = np.concatenate((np.zeros(len(base_live), dtype=np.int8), np.ones(delta.doc_count, dtype=np.int8)))[order]
+    self.source_rows = np.concatenate((base_live, np.arange(delta.doc_count)))[order]
+    self.term_cache = TermCache(self.__entry)
+
+  def terms(self):
+    merged = heapq.merge(self.base.terms(), self.delta.terms(), key=str.encode)
+    return (term for term, _ in groupby(merged) if self.term_postings(term) is not None)
+
+  def term_postings(self, term: str):
+    rows, tfs = [], []
+    for segment, segment_rows in ((self.base, self.base_rows), (self.delta, self.delta_rows)):
+      postings = segment.term_postings(term)
+      if postings is None:
+        continue
+      merged = segment_rows[postings[0]]
+      live = merged >= 0
+      rows.append(merged[live])
+      tfs.append(postings[1][live])
+
+    if sum(map(len, rows)) == 0:
+      return None
+    rows, tfs = np.concatenate(rows), np.concatenate(tfs)
+    order = np.argsort(rows)
+    return rows[order], tfs[order]
+
+  def lookup(self, term: str):
+    return self.term_cache.get(term)
+
+  def document_frequency(self, term: str) -> int:
+    # tombstones hide documents, so the stored counts do not apply
+    entry = self.lookup(term)
+    return 0 if entry is None else len(entry[0])
+
+  def __entry(self, term):
+    postings = self.term_postings(term)
+    if postings is None:
+      return None
+    # rows are renumbered, so the stored blocks of the segments do not apply
+    idf = bm25_idf(self.doc_count, len(postings[0]))
+    return *postings, idf, posting_blocks(*postings, self.doc_lengths)
+
+  def row(self, doc_id: int) -> int | None:
+    row = int(np.searchsorted(self.doc_ids, doc_id))
+    if row < self.doc_count and self.doc_ids[row] == doc_id:
+      return row
+    return None
+
+  def document(self, row: int) -> dict:
+    segment = self.delta if self.sources[row] else self.base
+    return segment.document(int(self.source_rows[row]))
+
+  def close(self) -> None:
+    self.base.close()
+    self.delta.close()
+
+class TermPostings(Mapping):
+  """term -> (rows, tfs), decoded on access."""
+  def __init__(self, mapped) -> None:
+    self.mapped = mapped
+
+  def __getitem__(self, term):
+    return self.entry(term)[:2]
+
+  def entry(self, term):
+    entry = self.mapped.lookup(term)
+    if entry is None:
+      raise KeyError(term)
+    return entry
+
+  def __contains__(self, term):
+    return self.mapped.lookup(term) is not None
+
+  def __iter__(self):
+    return self.mapped.terms()
+
+  def __len__(self):
+    return sum(1 for _ in self.mapped.terms())
+
+class TermIdf(TermPostings):
+  """term -> BM25 IDF."""
+  def __getitem__(self, term):
+    return self.entry(term)[2]
+
+class TermBlocks(TermPostings):
+  """term -> `posting_blocks` of its postings."""
+  def __getitem__(self, term):
+    return self.entry(term)[3]
+
+class DocIdSets(TermPostings):
+  """term -> set of document ids, the shape of `InvertedIndex.index`."""
+  def __getitem__(self, term):
+    rows = self.entry(term)[0]
+    return set(self.mapped.doc_ids[rows].tolist())
+
+class DocumentMap(Mapping):
+  """document id -> document, the shape of `InvertedIndex.docmap`."""
+  def __init__(self, mapped) -> None:
+    self.mapped = mapped
+
+  def __getitem__(self, doc_id):
+    row = self.mapped.row(doc_id)
+    if row is None:
+      raise KeyError(doc_id)
+    return self.value(row)
+
+  def value(self, row: int):
+    return self.mapped.document(row)
+
+  def __iter__(self):
+    return iter(self.mapped.doc_ids.tolist())
+
+  def __len__(self):
+    return self.mapped.doc_count
+
+class DocLengths(DocumentMap):
+  """document id -> token count, the shape of `InvertedIndex.doc_lengths`."""
+  def value(self, row: int):
+    return int(self.mapped.doc_lengths[row])
+
+  def values(self):
+    return self.mapped.doc_lengths.tolist()
+
+class DocHashes(DocumentMap):
+  """document id -> content hash of its indexed text."""
+  def value(self, row: int):
+    return int(self.mapped.doc_hashes[row])
+
+class TermFrequencies(DocumentMap):
+  """document id -> term counts, the shape of `InvertedIndex.term_frequencies`."""
+  def value(self, row: int):
+    return DocumentTerms(self.mapped, row)
+
+class DocumentTerms:
+  """Term counts of a single document, looked up through the postings."""
+  def __init__(self, mapped, row: int) -> None:
+    self.mapped = mapped
+    self.row = row
+
+  def get(self, term: str, default: int = 0) -> int:
+    entry = self.mapped.lookup(term)
+    if entry is None:
+      return default
+    rows, tfs = entry[:2]
+    position = int(np.searchsorted(rows, self.row))
+    if position < len(rows) and rows[position] == self.row:
+      return int(tfs[position])
+    return default
@@ -1,22 +1,86 @@
+import multiprocessing
 import pickle
 import os
-import math
 
-from collections import Counter
+from collections import Counter, deque
+from itertools import batched
 
-from data.definitions import BM25_K1, BM25_B
+import numpy as np
+
+from data.definitions import BM25_K1, BM25_B, COMPACTION_RATIO
+from data.bm25 import BM25Scorer, bm25_idf
+from data.index_format import (
+  MappedIndex, MergedIndex, TermPostings, TermIdf, TermBlocks,
+  DocIdSets, DocumentMap, TermFrequencies, DocLengths, DocHashes, write_index,
+)
+from data.postings import first_rows, intersect, union
+from data.profiling import count, span, traced
+from data.query_cache import QueryCache
+from data.utils import content_hash
+
+INDEX_FILE = "index.bin"
+# documents added or replaced since the last full write, and deleted ids
+DELTA_FILE = "index.delta.bin"
+DELETED_FILE = "index.deleted.npy"
+# word -> stem cache of the tokenizer, so a server starts with it warm
+STEMS_FILE = "stems.json"
+
+# documents tokenized per batch, and per task handed to a build worker
+BUILD_SHARD_SIZE = 2000
+
+def document_text(movie: dict) -> str:
+  return f"{movie["title"]} {movie["description"]}"
+
+_worker_tokenizer = None
+
+def _init_build_worker(tokenizer):
+  global _worker_tokenizer
+  _worker_tokenizer = tokenizer
+
+def _index_shard(documents):
+  """Index (doc_id, text) pairs into partial index, term frequency, length
+  and hash maps, in the shapes `InvertedIndex` keeps them, plus the stems
+  the worker had not seen before."""
+  index = {}
+  term_frequencies = {}
+  doc_lengths = {}
+  doc_hashes = {}
+  stem_count = _worker_tokenizer.stem_count
+  for (doc_id, text), tokens in zip(documents, _worker_tokenizer.tokenize_many(text for _, text in documents)):
+    count = Counter(tokens)
+    for tok in count:
+      index.setdefault(tok, []).append(doc_id)
+    term_frequencies[doc_id] = count
+    doc_lengths[doc_id] = len(tokens)
+    doc_hashes[doc_id] = content_hash(text)
+  stems = _worker_tokenizer.recent_stems(_worker_tokenizer.stem_count - stem_count)
+  return index, term_frequencies, doc_lengths, doc_hashes, stems
 
 class InvertedIndex:
-  def __init__(self, tokenizer):
+  def __init__(self, tokenizer, cache_dir="cache"):
     self.index = {}
     self.docmap = {}
     self.term_frequencies = {}
     self.doc_lengths = {}
+    self.doc_hashes = {}
+    self.scorer = None
+    self.mapped = None
+    # identifies the files the index was loaded from; None when built in memory
+    self.version = None
+    self.result_cache = QueryCache()
 
     self.tokenizer = tokenizer
+    self.cache_dir = cache_dir
 
-  def __add_document(self, doc_id, text):
-    tokens = self.tokenizer.tokenize_str(text)
+  def __add_movie(self, movie, tokens=None):
+    text = document_text(movie)
+    self.docmap[movie["id"]] = movie
+    self.doc_hashes[movie["id"]] = content_hash(text)
+    self.__add_document(movie["id"], text, tokens)
+
+  def __add_document(self, doc_id, text, tokens=None):
+    if tokens is None:
+      tokens = self.tokenizer.tokenize_str(text)
     count = Counter()
 
     for tok in tokens:
@@ -26,16 +90,70 @@ class InvertedIndex:
     self.term_frequencies[doc_id] = count
     self.doc_lengths[doc_id] = len(tokens)
 
+  def __remove_document(self, doc_id):
+    for tok in self.term_frequencies.pop(doc_id):
+      self.index[tok].discard(doc_id)
+      if not self.index[tok]:
+        del self.index[tok]
+
+    del self.docmap[doc_id]
+    del self.doc_lengths[doc_id]
+    del self.doc_hashes[doc_id]
+
+  def __copy_segment(self, segment):
+    for row, doc_id in enumerate(segment.doc_ids.tolist()):
+      self.docmap[doc_id] = segment.document(row)
+      self.term_frequencies[doc_id] = Counter()
+      self.doc_lengths[doc_id] = int(segment.doc_lengths[row])
+      self.doc_hashes[doc_id] = int(segment.doc_hashes[row])
+
+    for term in segment.terms():
+      rows, tfs = segment.term_postings(term)
+      for doc_id, tf in zip(segment.doc_ids[rows].tolist(), tfs.tolist()):
+        self.index.setdefault(term, set()).add(doc_id)
+        self.term_frequencies[doc_id][term] = tf
+
   def __get_avg_doc_length(self) -> float:
     avg = sum(self.doc_lengths.values())
     if self.doc_lengths:
       avg /= len(self.doc_lengths)
     return avg
 
+  def get_document_frequency(self, term: str) -> int:
+    """Number of documents containing the token `term`; a loaded index reads
+    it from the index file instead of looking the documents up."""
+    if self.mapped is not None:
+      return self.mapped.document_frequency(term)
+    return len(self.index.get(term, ()))
+
   def get_documents(self, term):
     docs = sorted(map(lambda id: self.docmap[id], self.index.get(term, set())), key=lambda elt: elt["id"])
     return docs
 
+  @traced("keyword.search")
+  def search(self, query, limit=5, mode="first"):
+    """The first `limit` documents, by id, matching the query tokens.
+
+    "first" takes the documents of each token in turn, "and" those
+    containing every token and "or" those containing any. Only the rows
+    returned are looked up in `docmap`.
+    """
+    if self.scorer is None or limit <= 0:
+      return []
+    tokens = self.tokenizer.tokenize_str(query)
+    postings = [self.scorer.postings.get(token) for token in tokens]
+    found = [rows for rows, _ in filter(None, postings)]
+    match mode:
+      case "first":
+        rows = first_rows(found, limit)
+      case "and":
+        rows = intersect(found, limit) if len(found) == len(postings) else []
+      case "or":
+        rows = union(found, limit)
+      case _:
+        raise ValueError(f"unknown keyword search mode: {mode}")
+    return [self.docmap[doc_id] for doc_id in self.scorer.doc_ids[rows].tolist()]
+
   def get_tf(self, doc_id: int, term: str) -> int:
     tokens = self.tokenizer.tokenize_str(term)
     
@@ -55,8 +173,7 @@ class InvertedIndex:
     except:
       raise Exception("ill-formed query: either empty or more than one word")
 
-    term_doc_count = len(self.get_documents(token))
-    return math.log((len(self.docmap) - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+    return bm25_idf(len(self.docmap), self.get_document_frequency(token))
 
   def get_bm25_tf(self, doc_id: int, term: str, k1: float = BM25_K1, b: float = BM25_B) -> float:
     doc_length = self.doc_lengths[doc_id]
@@ -70,7 +187,30 @@ class InvertedIndex:
   def bm25(self, doc_id, term):
     return self.get_bm25_tf(doc_id, term) * self.get_bm25_idf(term)
 
-  def bm25_search(self, query, limit):
+  def use_corpus_stats(self, doc_count: int, total_length: int, dfs: dict) -> None:
+    """Score with the document count, total length and document frequencies
+    of the whole corpus this index is a shard of, so that "array" and
+    "pruned" scores match those of an unsharded index exactly."""
+    self.scorer = BM25Scorer(
+      self.scorer.doc_ids, self.scorer.doc_lengths, self.scorer.postings,
+      {term: bm25_idf(doc_count, df) for term, df in dfs.items()},
+      blocks=self.scorer.blocks, avg_doc_length=total_length / doc_count if doc_count else 0.0,
+    )
+    self.result_cache = QueryCache()
+
+  @traced("bm25.search")
+  def bm25_search(self, query, limit, mode="array"):
+    match mode:
+      case "array":
+        return self.__bm25_search_array(query, limit)
+      case "naive":
+        return self.__bm25_search_naive(query, limit)
+      case "pruned":
+        return self.__bm25_search_array(query, limit, pruned=True)
+      case _:
+        raise ValueError(f"unknown BM25 search mode: {mode}")
+
+  def __bm25_search_naive(self, query, limit):
     tokens = self.tokenizer.tokenize_str(query)
     scores = {}
     for token in tokens:
@@ -79,39 +219,235 @@ class InvertedIndex:
         scores[id] += self.bm25(id, token)
 
     result = sorted(scores.items(), key=lambda t: t[1], reverse=True)
-    return map(lambda t: (self.docmap[t[0]], t[1]),
-               result[:limit])
+    return list(map(lambda t: (self.docmap[t[0]], t[1]),
+               result[:limit]))
+
+  def __bm25_search_array(self, query, limit, pruned=False):
+    # both engines return the same results, so they share cache entries
+    with span("bm25.tokenize"):
+      tokens = self.tokenizer.tokenize_str(query)
+    count("bm25.query_tokens", len(tokens))
+    return self.result_cache.cached(
+      ("bm25", tuple(tokens), limit, self.scorer.k1, self.scorer.b),
+      self.version,
+      lambda: self.__score_tokens(tokens, limit, pruned),
+    )
+
+  def __score_tokens(self, tokens, limit, pruned):
+    with span("bm25.score"):
+      if pruned:
+        rows, scores, scored = self.scorer.score_pruned(tokens, limit)
+        count("bm25.documents_scored", scored)
+      else:
+        rows, scores = self.scorer.score(tokens, limit)
+    with span("bm25.documents"):
+      doc_ids = self.scorer.doc_ids[rows]
+      return [(self.docmap[doc_id], score) for doc_id, score in zip(doc_ids.tolist(), scores.tolist())]
+
+  @traced("index.build")
+  def build(self, movies, workers=1):
+    """Index `movies`, tokenizing them on `workers` processes.
+
+    `movies` may be any iterable, such as a `MovieStream`; it is consumed in
+    shards of BUILD_SHARD_SIZE. Workers index the shards and the partial
+    maps are merged in shard order, so the saved index is the same for any
+    number of workers.
+    """
+    if workers <= 1:
+      for shard in batched(movies, BUILD_SHARD_SIZE):
+        for mov, tokens in zip(shard, self.tokenizer.tokenize_many(map(document_text, shard))):
+          self.__add_movie(mov, tokens)
+    else:
+      with multiprocessing.Pool(workers, _init_build_worker, (self.tokenizer,)) as pool:
+        # bound the shards held in memory while the workers catch up
+        pending = deque()
+        for shard in batched(movies, BUILD_SHARD_SIZE):
+          for mov in shard:
+            self.docmap[mov["id"]] = mov
+          pending.append(pool.apply_async(_index_shard, ([(mov["id"], document_text(mov)) for mov in shard],)))
+          if len(pending) > 2 * workers:
+            self.__merge_shard(*pending.popleft().get())
+        while pending:
+          self.__merge_shard(*pending.popleft().get())
+
+    self.scorer = BM25Scorer.from_index(self)
+    self.version = None
+
+  def __merge_shard(self, index, term_frequencies, doc_lengths, doc_hashes, stems):
+    for tok, doc_ids in index.items():
+      self.index.setdefault(tok, set()).update(doc_ids)
+    self.term_frequencies.update(term_frequencies)
+    self.doc_lengths.update(doc_lengths)
+    self.doc_hashes.update(doc_hashes)
+    self.tokenizer.add_stems(stems)
+
+  def upsert(self, movies):
+    """Add new movies and replace changed ones, keyed by id."""
+    self.update(movies, [])
+
+  def delete(self, doc_ids):
+    """Remove movies by id; returns the ids that were in the index."""
+    return self.update([], doc_ids)
 
-  def build(self, movies):
+  @traced("index.sync")
+  def sync(self, movies):
+    """Update the index to match `movies`, re-tokenizing only the documents
+    whose content changed. Returns the (changed, deleted) document ids."""
+    changed = []
+    present = set()
     for mov in movies:
-      self.docmap[mov["id"]] = mov
-      self.__add_document(mov["id"], f"{mov["title"]} {mov["description"]}")
-  
+      present.add(mov["id"])
+      if self.doc_hashes.get(mov["id"]) != content_hash(document_text(mov)):
+        changed.append(mov)
+    deleted = [doc_id for doc_id in self.docmap if doc_id not in present]
+
+    self.update(changed, deleted)
+    return [mov["id"] for mov in changed], deleted
+
+  def update(self, movies, deleted_ids):
+    """Apply changes to a loaded index without rebuilding it.
+
+    New and changed movies go to a small delta segment saved next to the
+    base index, and their previous versions as well as `deleted_ids` are
+    tombstoned in the base. When the delta and tombstones outgrow
+    COMPACTION_RATIO of the base, everything is compacted into a new base.
+
+    Returns the ids of `deleted_ids` that were in the index.
+    """
+    if self.mapped is None:
+      raise ValueError("No index loaded. Call `load` first.")
+
+    delta = InvertedIndex(self.tokenizer, self.cache_dir)
+    if isinstance(self.mapped, MergedIndex):
+      base = self.mapped.base
+      delta.__copy_segment(self.mapped.delta)
+      deleted = set(np.load(os.path.join(self.cache_dir, DELETED_FILE)).tolist())
+    else:
+      base = self.mapped
+      deleted = set()
+    removed = [
+      doc_id for doc_id in dict.fromkeys(deleted_ids)
+      if doc_id in delta.docmap or (base.row(doc_id) is not None and doc_id not in deleted)
+    ]
+
+    for doc_id in {mov["id"] for mov in movies} | set(deleted_ids):
+      if doc_id in delta.docmap:
+        delta.__remove_document(doc_id)
+      if base.row(doc_id) is not None:
+        deleted.add(doc_id)
+    for mov in movies:
+      delta.__add_movie(mov)
+    delta.scorer = BM25Scorer.from_index(delta)
+
+    delta.__write(os.path.join(self.cache_dir, DELTA_FILE))
+    np.save(os.path.join(self.cache_dir, DELETED_FILE), np.array(sorted(deleted), dtype=np.int64))
+    self.load()
+
+    if len(delta.docmap) + len(deleted) > COMPACTION_RATIO * base.doc_count:
+      self.compact()
+    return removed
+
+  def compact(self):
+    """Fold the delta segment and tombstones into a new base index."""
+    self.save()
+    self.load()
+
+  @traced("index.save")
   def save(self):
-    try: os.mkdir("cache")
+    try: os.mkdir(self.cache_dir)
+    except FileExistsError: pass
+
+    self.__write(os.path.join(self.cache_dir, INDEX_FILE))
+    self.tokenizer.save_stem_cache(os.path.join(self.cache_dir, STEMS_FILE))
+
+    # the base now holds every live document
+    for name in (DELTA_FILE, DELETED_FILE):
+      try: os.remove(os.path.join(self.cache_dir, name))
+      except FileNotFoundError: pass
+
+  def __write(self, path):
+    doc_ids = self.scorer.doc_ids.tolist()
+    write_index(
+      path,
+      self.scorer.doc_ids,
+      self.scorer.doc_lengths,
+      [self.doc_hashes[doc_id] for doc_id in doc_ids],
+      map(lambda doc_id: self.docmap[doc_id], doc_ids),
+      self.scorer.postings,
+      self.scorer.idf,
+    )
+
+  @traced("index.load")
+  def load(self):
+    self.mapped = MappedIndex(os.path.join(self.cache_dir, INDEX_FILE))
+    if os.path.exists(os.path.join(self.cache_dir, DELTA_FILE)):
+      self.mapped = MergedIndex(
+        self.mapped,
+        MappedIndex(os.path.join(self.cache_dir, DELTA_FILE)),
+        np.load(os.path.join(self.cache_dir, DELETED_FILE)),
+      )
+
+    self.index = DocIdSets(self.mapped)
+    self.docmap = DocumentMap(self.mapped)
+    self.term_frequencies = TermFrequencies(self.mapped)
+    self.doc_lengths = DocLengths(self.mapped)
+    self.doc_hashes = DocHashes(self.mapped)
+    self.scorer = BM25Scorer(
+      self.mapped.doc_ids, self.mapped.doc_lengths, TermPostings(self.mapped), TermIdf(self.mapped), blocks=TermBlocks(self.mapped)
+    )
+    self.version = tuple(
+      (name, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+      for name in (INDEX_FILE, DELTA_FILE, DELETED_FILE)
+      if (stat := self.__stat(name)) is not None
+    )
+
+  def __stat(self, name):
+    try:
+      return os.stat(os.path.join(self.cache_dir, name))
+    except FileNotFoundError:
+      return None
+
+  def load_stem_cache(self):
+    """Warm the tokenizer with the stems seen while building the index.
+
+    Long-running processes stem faster with it, and a single query whose
+    words were all seen while building skips importing the stemmer, which
+    takes longer than loading the cache.
+    """
+    if os.path.exists(os.path.join(self.cache_dir, STEMS_FILE)):
+      self.tokenizer.load_stem_cache(os.path.join(self.cache_dir, STEMS_FILE))
+
+  def save_pickle(self):
+    """Write the legacy pickle cache (kept for benchmarks and conversion)."""
+    try: os.mkdir(self.cache_dir)
     except FileExistsError: pass
 
-    with open(os.path.join("cache", "index.pkl"), "bw") as f:
+    with open(os.path.join(self.cache_dir, "index.pkl"), "bw") as f:
       pickle.dump(self.index, f)
 
-    with open(os.path.join("cache", "docmap.pkl"), "bw") as f:
+    with open(os.path.join(self.cache_dir, "docmap.pkl"), "bw") as f:
       pickle.dump(self.docmap, f)
 
-    with open(os.path.join("cache", "term_frequencies.pkl"), "bw") as f:
+    with open(os.path.join(self.cache_dir, "term_frequencies.pkl"), "bw") as f:
       pickle.dump(self.term_frequencies, f)
 
-    with open(os.path.join("cache", "doc_lengths.pkl"), "bw") as f:
+    with open(os.path.join(self.cache_dir, "doc_lengths.pkl"), "bw") as f:
       pickle.dump(self.doc_lengths, f)
-  
-  def load(self):
-    with open(os.path.join("cache", "index.pkl"), "br") as f:
+
+  @traced("index.load_pickle")
+  def load_pickle(self):
+    """Read the legacy pickle cache written by earlier versions."""
+    with open(os.path.join(self.cache_dir, "index.pkl"), "br") as f:
       self.index = pickle.load(f)
 
-    with open(os.path.join("cache", "docmap.pkl"), "br") as f:
+    with open(os.path.join(self.cache_dir, "docmap.pkl"), "br") as f:
       self.docmap = pickle.load(f)
 
-    with open(os.path.join("cache", "term_frequencies.pkl"), "br") as f:
+    with open(os.path.join(self.cache_dir, "term_frequencies.pkl"), "br") as f:
       self.term_frequencies = pickle.load(f)
 
-    with open(os.path.join("cache", "doc_lengths.pkl"), "br") as f:
-      self.doc_lengths = pickle.load(f)
\ No newline at end of file
+    with open(os.path.join(self.cache_dir, "doc_lengths.pkl"), "br") as f:
+      self.doc_lengths = pickle.load(f)
+
+    self.doc_hashes = {doc_id: content_hash(document_text(mov)) for doc_id, mov in self.docmap.items()}
+    self.scorer = BM25Scorer.from_index(self)
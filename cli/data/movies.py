@@ -0,0 +1,101 @@
+import json
+import os
+import re
+
+READ_SIZE = 1 << 20
+WHITESPACE = re.compile(r"\s*")
+
+def movies_path() -> str:
+  """data/movies.json, or data/movies.jsonl when only that one exists."""
+  path = os.path.join("data", "movies.json")
+  jsonl_path = os.path.join("data", "movies.jsonl")
+  if not os.path.exists(path) and os.path.exists(jsonl_path):
+    return jsonl_path
+  return path
+
+class MovieStream:
+  """The movies of a catalog file, parsed one at a time.
+
+  Reads either a JSON object whose "movies" key holds the list of movies,
+  or JSONL with one movie per line. Memory use does not grow with the size
+  of the file, and every iteration reads the file again.
+  """
+  def __init__(self, path: str | None = None, read_size: int = READ_SIZE) -> None:
+    self.path = path or movies_path()
+    self.read_size = read_size
+
+  def __iter__(self):
+    with open(self.path, encoding="utf-8") as f:
+      if self.path.endswith(".jsonl"):
+        for line in f:
+          if line.strip():
+            yield json.loads(line)
+      else:
+        yield from _JsonReader(f, self.read_size).movies()
+
+class _JsonReader:
+  """Incremental reader over the top-level object of a movies.json file."""
+  def __init__(self, f, read_size: int) -> None:
+    self.f = f
+    self.read_size = read_size
+    self.decoder = json.JSONDecoder()
+    self.buffer = ""
+    self.pos = 0
+
+  def movies(self):
+    self.__expect("{")
+    if self.__peek() == "}":
+      return
+    while True:
+      key = self.__value()
+      self.__expect(":")
+      if key != "movies":
+        self.__value()
+      elif self.__expect("[") and self.__peek() == "]":
+        self.pos += 1
+      else:
+        while True:
+          yield self.__value()
+          if self.__expect(",]") == "]":
+            break
+      if self.__expect(",}") == "}":
+        return
+
+  def __read(self) -> bool:
+    data = self.f.read(self.read_size)
+    if not data:
+      return False
+    self.buffer = self.buffer[self.pos:] + data
+    self.pos = 0
+    return True
+
+  def __peek(self) -> str:
+    while True:
+      self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+      if self.pos < len(self.buffer):
+        return self.buffer[self.pos]
+      if not self.__read():
+        raise ValueError(f"unexpected end of {self.f.name}")
+
+  def __expect(self, chars: str) -> str:
+    char = self.__peek()
+    if char not in chars:
+      raise ValueError(f"expected one of {chars!r} at {char!r} in {self.f.name}")
+    self.pos += 1
+    return char
+
+  def __value(self):
+    self.__peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.pos)
+      except json.JSONDecodeError:
+        # most likely a value cut by the end of the buffer
+        if self.__read():
+          continue
+        raise
+      # a number ending the buffer may continue in the next read
+      if end == len(self.buffer) and self.__read():
+        continue
+      self.pos = end
+      return value
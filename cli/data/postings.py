@@ -0,0 +1,76 @@
+import heapq
+
+import numpy as np
+
+# rows of the shortest posting list looked up at once by `intersect`
+INTERSECT_WINDOW = 256
+
+def first_rows(postings: list[np.ndarray], limit: int) -> list[int]:
+  """The first `limit` distinct rows of the posting lists taken one after
+  the other, each list in ascending order.
+
+  Only the rows kept so far can be skipped in a list, so none is read past
+  its first `limit + len(kept)` rows.
+  """
+  kept = {}
+  for rows in postings:
+    for row in rows[:limit + len(kept)].tolist():
+      if row not in kept:
+        kept[row] = None
+        if len(kept) == limit:
+          return list(kept)
+  return list(kept)
+
+def union(postings: list[np.ndarray], limit: int) -> list[int]:
+  """The `limit` lowest rows found in any of the sorted posting lists, by a
+  k-way merge of their heads."""
+  merged = []
+  # no list can contribute more than its first `limit` rows
+  for row in heapq.merge(*(rows[:limit].tolist() for rows in postings)):
+    if not merged or merged[-1] != row:
+      merged.append(row)
+      if len(merged) == limit:
+        break
+  return merged
+
+def intersect(postings: list[np.ndarray], limit: int) -> list[int]:
+  """The `limit` lowest rows found in every sorted posting list.
+
+  The shortest list drives: its rows are looked up a window at a time in
+  the longer lists, each search starting where the previous window ended
+  and galloping ahead to bound the range bisected. The walk stops once
+  `limit` rows are found.
+  """
+  if not postings or limit <= 0:
+    return []
+  postings = sorted(postings, key=len)
+  shortest, others = postings[0], postings[1:]
+  positions = [0] * len(others)
+  found = []
+  for start in range(0, len(shortest), INTERSECT_WINDOW):
+    window = shortest[start:start + INTERSECT_WINDOW]
+    for i, rows in enumerate(others):
+      end = _gallop(rows, positions[i], int(window[-1]))
+      candidates = rows[positions[i]:end]
+      at = np.searchsorted(candidates, window)
+      window = window[(at < len(candidates)) & (candidates[np.minimum(at, len(candidates) - 1)] == window)] if len(candidates) else window[:0]
+      positions[i] = end
+      if len(window) == 0:
+        break
+    found.extend(window[:limit - len(found)].tolist())
+    if len(found) == limit:
+      break
+    if any(position == len(rows) for position, rows in zip(positions, others)):
+      break
+  return found
+
+def _gallop(rows, start, value):
+  # first position from `start` on whose row is above `value`: steps double
+  # until they overshoot, then the last step is bisected
+  low, step = start, 1
+  high = start
+  while high < len(rows) and rows[high] <= value:
+    low = high
+    high += step
+    step *= 2
+  return low + int(np.searchsorted(rows[low:high], value, side="right"))
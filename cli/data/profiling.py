@@ -0,0 +1,129 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# the no-op span handed out while profiling is off
+NO_SPAN = nullcontext()
+
+class Profiler:
+  """Timed spans and counters for the stages of a command.
+
+  Off by default: `span` then returns a shared no-op context manager and
+  `count` returns at once, so instrumented code pays one function call.
+  Spans nest; the time before `enable` is reported as startup, which is
+  mostly imports.
+  """
+  def __init__(self) -> None:
+    self.enabled = False
+    self.origin = time.perf_counter()
+    # (name, start, duration, depth, thread id), in the order spans end
+    self.spans = []
+    self.counters = Counter()
+    self.local = threading.local()
+
+  def enable(self) -> None:
+    self.enabled = True
+    self.spans.append(("startup", self.origin, time.perf_counter() - self.origin, 0, threading.get_ident()))
+
+  def span(self, name: str):
+    if not self.enabled:
+      return NO_SPAN
+    return self.__span(name)
+
+  @contextmanager
+  def __span(self, name):
+    depth = getattr(self.local, "depth", 0)
+    self.local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.spans.append((name, start, time.perf_counter() - start, depth, threading.get_ident()))
+      self.local.depth = depth
+
+  def count(self, name: str, n: int = 1) -> None:
+    if self.enabled:
+      self.counters[name] += n
+
+  def report(self) -> str:
+    """Total time and calls per span name, nested and in the order the
+    spans started, followed by the counters."""
+    stages = {}
+    for name, start, duration, depth, _ in sorted(self.spans, key=lambda span: span[1]):
+      key = (depth, name)
+      first, calls, total = stages.get(key, (start, 0, 0.0))
+      stages[key] = (first, calls + 1, total + duration)
+
+    lines = [f"{'stage':<40} {'calls':>7} {'total (ms)':>11}"]
+    for (depth, name), (_, calls, total) in sorted(stages.items(), key=lambda stage: stage[1][0]):
+      lines.append(f"{'  ' * depth + name:<40} {calls:>7} {total * 1000:>11.2f}")
+    lines.append(f"{'total':<40} {'':>7} {(time.perf_counter() - self.origin) * 1000:>11.2f}")
+    for name, value in sorted(self.counters.items()):
+      lines.append(f"{name:<40} {value:>7}")
+    return "\n".join(lines)
+
+  def chrome_trace(self) -> dict:
+    """The spans as complete events and the counters as a final counter
+    event, for chrome://tracing or Perfetto."""
+    pid = os.getpid()
+    events = [
+      {"name": name, "ph": "X", "ts": (start - self.origin) * 1e6, "dur": duration * 1e6, "pid": pid, "tid": tid}
+      for name, start, duration, _, tid in self.spans
+    ]
+    if self.counters:
+      events.append({
+        "name": "counters", "ph": "C", "ts": (time.perf_counter() - self.origin) * 1e6, "pid": pid, "tid": 0,
+        "args": dict(self.counters),
+      })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+PROFILER = Profiler()
+span = PROFILER.span
+count = PROFILER.count
+
+def traced(name: str):
+  """Decorator running every call of the function in the span `name`."""
+  def decorate(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not PROFILER.enabled:
+        return fn(*args, **kwargs)
+      with PROFILER.span(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorate
+
+@contextmanager
+def profiled(enabled: bool, output: str | None = None):
+  """Profile the body when `enabled` and print the breakdown to stderr.
+
+  `output` also saves the run: a Chrome trace when it ends in .json, a
+  cProfile dump (for pstats or snakeviz) otherwise.
+  """
+  if not enabled:
+    yield
+    return
+
+  PROFILER.enable()
+  profile = None
+  if output is not None and not output.endswith(".json"):
+    profile = cProfile.Profile()
+    profile.enable()
+  try:
+    with span("command"):
+      yield
+  finally:
+    if profile is not None:
+      profile.disable()
+      profile.dump_stats(output)
+    elif output is not None:
+      with open(output, "w") as f:
+        json.dump(PROFILER.chrome_trace(), f)
+    print(PROFILER.report(), file=sys.stderr)
@@ -0,0 +1,172 @@
+import os
+
+import numpy as np
+
+from data.definitions import EMBED_BATCH_SIZE, STORAGE_MODES
+from data.ranking import top_k
+from data.vectors import normalize_rows
+
+SCORE_BATCH_SIZE = 16384
+# set bits of every byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+class QuantizedVectors:
+  """Unit-normalized embedding rows stored at reduced precision.
+
+  float16 halves the memory of float32, int8 quarters it with a scale per
+  dimension, and binary keeps one sign bit per dimension, scored by Hamming
+  distance. Indexing returns float32 approximations of the rows, so the
+  vectors can stand in for a `normalize_rows` matrix. With the float32
+  `originals` attached, `rescore` ranks candidates by their exact cosine.
+  """
+  def __init__(self, mode: str, codes: np.ndarray, scale: np.ndarray | None = None, dimensions: int | None = None) -> None:
+    check_storage_mode(mode)
+    self.mode = mode
+    self.codes = codes
+    self.scale = scale
+    self.dimensions = codes.shape[1] if dimensions is None else dimensions
+    self.originals = None
+    # identifies the embeddings the codes were computed from
+    self.fingerprint = ""
+
+  @property
+  def exact(self) -> bool:
+    return self.mode == "float32"
+
+  @property
+  def nbytes(self) -> int:
+    return self.codes.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+  def __len__(self) -> int:
+    return len(self.codes)
+
+  @classmethod
+  def encode(cls, embeddings: np.ndarray, mode: str, batch_size: int = EMBED_BATCH_SIZE) -> "QuantizedVectors":
+    """Normalize and quantize `embeddings`, `batch_size` rows at a time, so a
+    memory-mapped matrix is never loaded as a whole."""
+    check_storage_mode(mode)
+    def batches():
+      for start in range(0, len(embeddings), batch_size):
+        yield normalize_rows(embeddings[start:start + batch_size])
+
+    if mode == "float32":
+      vectors = cls(mode, normalize_rows(embeddings))
+    else:
+      dimensions = embeddings.shape[1] if embeddings.ndim == 2 else 0
+      match mode:
+        case "float16":
+          codes = [batch.astype(np.float16) for batch in batches()]
+          vectors = cls(mode, _stack(codes, (0, dimensions), np.float16))
+        case "int8":
+          scale = np.zeros(dimensions, dtype=np.float32)
+          for batch in batches():
+            scale = np.maximum(scale, np.abs(batch).max(axis=0))
+          scale[scale == 0] = 1
+          scale /= 127
+          codes = [np.clip(np.rint(batch / scale), -127, 127).astype(np.int8) for batch in batches()]
+          vectors = cls(mode, _stack(codes, (0, dimensions), np.int8), scale)
+        case "binary":
+          codes = [np.packbits(batch > 0, axis=1) for batch in batches()]
+          vectors = cls(mode, _stack(codes, (0, (dimensions + 7) // 8), np.uint8), dimensions=dimensions)
+    vectors.originals = embeddings
+    return vectors
+
+  def __getitem__(self, rows) -> np.ndarray:
+    codes = self.codes[rows]
+    match self.mode:
+      case "float32":
+        return codes
+      case "float16":
+        return codes.astype(np.float32)
+      case "int8":
+        return codes * self.scale
+      case "binary":
+        signs = np.unpackbits(codes, axis=-1, count=self.dimensions).astype(np.float32) * 2 - 1
+        return signs / np.sqrt(max(self.dimensions, 1), dtype=np.float32)
+
+  def scores(self, query: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+    """Approximate cosine similarity of `query` with `rows` (all by default).
+
+    Binary codes are scored by the angle their Hamming distance to the signs
+    of the query estimates.
+    """
+    query = normalize_rows(query)
+    codes = self.codes if rows is None else self.codes[rows]
+    match self.mode:
+      case "float32":
+        return codes @ query
+      case "binary":
+        query_code = np.packbits(query > 0)
+        distances = _batched(codes, lambda batch: POPCOUNT[batch ^ query_code].sum(axis=1, dtype=np.int32))
+        return np.cos(np.pi * distances / max(self.dimensions, 1)).astype(np.float32)
+      case "int8":
+        return _batched(codes, lambda batch: batch.astype(np.float32) @ (query * self.scale))
+      case _:
+        return _batched(codes, lambda batch: batch.astype(np.float32) @ query)
+
+  def top_k(self, query: np.ndarray, limit: int):
+    """Return the (rows, approximate scores) of the `limit` rows closest to `query`."""
+    scores = self.scores(query)
+    best = top_k(scores, limit)
+    return best, scores[best]
+
+  def exact_scores(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Cosine similarity of `query` with the float32 `originals` at `rows`."""
+    if self.originals is None:
+      raise ValueError("No float32 embeddings attached to rescore with")
+    return normalize_rows(self.originals[rows]) @ normalize_rows(query)
+
+  def rescore(self, query: np.ndarray, rows: np.ndarray, limit: int):
+    """Return the (rows, exact scores) of the best `limit` candidate `rows`."""
+    rows = np.sort(rows)
+    scores = self.exact_scores(query, rows)
+    best = top_k(scores, limit)
+    return rows[best], scores[best]
+
+  def save(self, path: str) -> None:
+    arrays = {} if self.scale is None else {"scale": self.scale}
+    with open(f"{path}.tmp", "bw") as f:
+      np.savez(f, codes=self.codes, mode=np.array(self.mode), dimensions=np.array(self.dimensions),
+               fingerprint=np.array(self.fingerprint), **arrays)
+    os.replace(f"{path}.tmp", path)
+
+  @classmethod
+  def load(cls, path: str) -> "QuantizedVectors":
+    with np.load(path) as data:
+      vectors = cls(str(data["mode"]), data["codes"], data["scale"] if "scale" in data else None, int(data["dimensions"]))
+      vectors.fingerprint = str(data["fingerprint"])
+      return vectors
+
+def check_storage_mode(mode: str) -> None:
+  if mode not in STORAGE_MODES:
+    raise ValueError(f"Unknown storage mode {mode!r}, expected one of {", ".join(STORAGE_MODES)}")
+
+def _stack(batches: list[np.ndarray], empty_shape: tuple, dtype) -> np.ndarray:
+  return np.concatenate(batches) if batches else np.empty(empty_shape, dtype=dtype)
+
+def _batched(codes: np.ndarray, score) -> np.ndarray:
+  # decoding every row at once would briefly need the float32 matrix again
+  if len(codes) <= SCORE_BATCH_SIZE:
+    return score(codes)
+  return np.concatenate([score(codes[start:start + SCORE_BATCH_SIZE]) for start in range(0, len(codes), SCORE_BATCH_SIZE)])
+
+def load_or_quantize(path: str, embeddings: np.ndarray, mode: str, fingerprint: str = "") -> QuantizedVectors:
+  """Load the `mode` codes cached at `path`, quantizing `embeddings` again
+  when they were computed from other rows, as told by `fingerprint`.
+
+  float32 vectors are normalized in memory and never cached.
+  """
+  if mode != "float32":
+    try:
+      vectors = QuantizedVectors.load(path)
+      if vectors.mode == mode and len(vectors) == len(embeddings) and vectors.fingerprint == fingerprint:
+        vectors.originals = embeddings
+        return vectors
+    except (FileNotFoundError, KeyError, ValueError):
+      pass
+
+  vectors = QuantizedVectors.encode(embeddings, mode)
+  vectors.fingerprint = fingerprint
+  if mode != "float32":
+    vectors.save(path)
+  return vectors
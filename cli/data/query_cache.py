@@ -0,0 +1,96 @@
+import os
+import pickle
+import time
+
+from collections import OrderedDict
+
+from data.definitions import QUERY_CACHE_SIZE, QUERY_CACHE_TTL
+from data.profiling import count
+
+class QueryCache:
+  """LRU cache of query results that expire after `ttl` seconds.
+
+  Every entry is stored with the version of the index or embeddings it was
+  computed from; a lookup with another version is a miss, so rebuilding
+  invalidates old results without any bookkeeping. With a `path` the cache
+  can be saved and reloaded, for processes that answer a single query.
+  """
+  def __init__(self, max_entries: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL, path: str | None = None) -> None:
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.path = path
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, version):
+    """The cached value, or None on a miss."""
+    entry = self.entries.get(key)
+    if entry is None or entry[0] != version or entry[1] < time.time():
+      if entry is not None:
+        del self.entries[key]
+      self.misses += 1
+      count("query_cache.misses")
+      return None
+
+    self.entries.move_to_end(key)
+    self.hits += 1
+    count("query_cache.hits")
+    return entry[2]
+
+  def put(self, key, version, value) -> None:
+    self.entries[key] = (version, time.time() + self.ttl, value)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+  def cached(self, key, version, compute):
+    """Return the cached value of `key`, computing and storing it on a miss.
+
+    A `version` of None means the source cannot be versioned (for example an
+    index that was never saved) and bypasses the cache.
+    """
+    if version is None:
+      return compute()
+    value = self.get(key, version)
+    if value is None:
+      value = compute()
+      self.put(key, version, value)
+    return value
+
+  def stats(self) -> dict:
+    lookups = self.hits + self.misses
+    return {
+      "entries": len(self.entries),
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / lookups if lookups else 0.0,
+    }
+
+  def load(self) -> None:
+    if self.path is None or not os.path.exists(self.path):
+      return
+    try:
+      with open(self.path, "br") as f:
+        self.entries, self.hits, self.misses = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+      # a corrupt or outdated cache is only a cold start
+      self.entries = OrderedDict()
+
+  def save(self) -> None:
+    if self.path is None:
+      return
+    now = time.time()
+    for key in [key for key, entry in self.entries.items() if entry[1] < now]:
+      del self.entries[key]
+
+    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+    with open(f"{self.path}.tmp", "bw") as f:
+      pickle.dump((self.entries, self.hits, self.misses), f)
+    os.replace(f"{self.path}.tmp", self.path)
+
+def persistent_cache(name: str) -> QueryCache:
+  """The on-disk cache `name` under cache/, loaded and ready to use."""
+  cache = QueryCache(path=os.path.join("cache", f"{name}_queries.pkl"))
+  cache.load()
+  return cache
@@ -0,0 +1,132 @@
+import copy
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+import numpy as np
+
+from data.definitions import QUANTIZED_MIN_COSINE, QUERY_BATCH_SIZE, QUERY_BATCH_WAIT_MS, QUERY_PRECISIONS
+from data.profiling import count, span
+from data.vectors import normalize_rows
+
+# queries the int8 model has to agree on with the float32 one, along with
+# whatever documents the caller adds
+CALIBRATION_QUERIES = (
+  "space adventure",
+  "a detective hunts a serial killer in a rainy city",
+  "romantic comedy set in paris",
+  "animated movie about talking animals",
+  "World War II submarine thriller",
+  "a family moves into a haunted house and strange things start to happen",
+  "superhero origin story",
+  "high school students plan one last party before graduation",
+)
+
+class QueryEncoder:
+  """Encodes queries for any number of threads, coalescing those that
+  arrive close together into one model call.
+
+  A background thread takes the first waiting query, then keeps collecting
+  for up to `wait_ms` or until `max_batch` queries are in, and encodes them
+  together. Callers block on their own query only.
+  """
+  def __init__(self, model, precision: str = "float32", wait_ms: float = QUERY_BATCH_WAIT_MS, max_batch: int = QUERY_BATCH_SIZE) -> None:
+    if precision not in QUERY_PRECISIONS:
+      raise ValueError(f"Unknown query precision {precision!r}, expected one of {", ".join(QUERY_PRECISIONS)}")
+    if max_batch < 1:
+      raise ValueError(f"Batch size needs to be strictly positive: (actual {max_batch})")
+    self.model = model
+    self.precision = precision
+    self.wait = wait_ms / 1000
+    self.max_batch = max_batch
+    # model calls made and queries encoded, for the mean batch size
+    self.batches = 0
+    self.encoded = 0
+    self.queue = queue.SimpleQueue()
+    self.thread = threading.Thread(target=self.__run, name="query-encoder", daemon=True)
+    self.thread.start()
+
+  def submit(self, text: str) -> Future:
+    """The future embedding of `text`."""
+    future = Future()
+    self.queue.put((text, future))
+    return future
+
+  def encode(self, text: str) -> np.ndarray:
+    return self.submit(text).result()
+
+  def encode_many(self, texts) -> np.ndarray:
+    """Embeddings of `texts` in order, queued together so they share batches."""
+    futures = [self.submit(text) for text in texts]
+    return np.array([future.result() for future in futures], dtype=np.float32)
+
+  def close(self) -> None:
+    """Encode the queries already queued, then stop the thread."""
+    self.queue.put(None)
+    self.thread.join()
+
+  def __run(self):
+    running = True
+    while running:
+      request = self.queue.get()
+      if request is None:
+        break
+      batch = [request]
+      deadline = time.perf_counter() + self.wait
+      while len(batch) < self.max_batch:
+        try:
+          request = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+        except queue.Empty:
+          break
+        if request is None:
+          running = False
+          break
+        batch.append(request)
+      self.__encode(batch)
+
+  def __encode(self, batch):
+    # queries whose caller cancelled in the meantime are dropped
+    batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+    if not batch:
+      return
+    texts = [text for text, _ in batch]
+    futures = [future for _, future in batch]
+    count("query_encoder.batches")
+    count("query_encoder.queries", len(texts))
+    try:
+      with span("query_encoder.encode"):
+        embeddings = self.model.encode(texts, batch_size=len(texts))
+    except Exception as e:
+      for future in futures:
+        future.set_exception(e)
+      return
+    self.batches += 1
+    self.encoded += len(texts)
+    for future, embedding in zip(futures, embeddings):
+      future.set_result(embedding)
+
+def quantize_model(model):
+  """A copy of `model` whose linear layers run in int8: weights quantized
+  once, activations as they come (dynamic quantization). CPU only."""
+  import torch
+
+  with span("model.quantize"):
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8)
+
+def model_agreement(reference, candidate, texts) -> float:
+  """The lowest cosine similarity between the embeddings two models give
+  the same texts."""
+  texts = list(texts)
+  expected = normalize_rows(reference.encode(texts))
+  actual = normalize_rows(candidate.encode(texts))
+  return float(np.min(np.sum(expected * actual, axis=1)))
+
+def check_quantized_model(reference, quantized, texts=CALIBRATION_QUERIES, min_cosine: float = QUANTIZED_MIN_COSINE) -> float:
+  """Raise if `quantized` strays from `reference` on any of `texts`; return
+  the lowest cosine similarity otherwise."""
+  agreement = model_agreement(reference, quantized, texts)
+  if agreement < min_cosine:
+    raise ValueError(f"int8 query model agrees with float32 down to cosine {agreement:.4f}, under the {min_cosine} threshold")
+  return agreement
@@ -0,0 +1,21 @@
+import numpy as np
+
+def top_k(scores: np.ndarray, limit: int) -> np.ndarray:
+  """Return the indices of the `limit` highest scores, best first.
+
+  Equal scores keep ascending index order, exactly like a stable descending
+  sort over the whole array would, but only the selected rows get sorted.
+  """
+  if limit <= 0 or len(scores) == 0:
+    return np.empty(0, dtype=np.intp)
+
+  if limit < len(scores):
+    kth = scores[np.argpartition(-scores, limit - 1)[limit - 1]]
+    above = np.flatnonzero(scores > kth)
+    tied = np.flatnonzero(scores == kth)[:limit - len(above)]
+    candidates = np.concatenate((above, tied))
+  else:
+    candidates = np.arange(len(scores))
+
+  order = np.lexsort((candidates, -scores[candidates]))
+  return candidates[order]
@@ -1,82 +1,334 @@
-import json
 import os
 
-from sentence_transformers import SentenceTransformer
+from itertools import chain
+
 import numpy as np
 
+from data.ann import load_or_train_ivf
+from data.definitions import (
+  ANN_NPROBE, EMBED_BATCH_SIZE, EMBEDDING_STORAGE, QUERY_BATCH_SIZE, QUERY_BATCH_WAIT_MS, RESCORE_CANDIDATES, SEMANTIC_MODEL
+)
+from data.document_store import DOCUMENTS_FILE, DocumentStore, write_document_store
+from data.embedding_store import EmbeddingStore
+from data.embedding_table import EmbeddingTable
+from data.movies import MovieStream
+from data.profiling import count, span, traced
+from data.quantization import check_storage_mode, load_or_quantize
+from data.query_cache import QueryCache, persistent_cache
+from data.utils import content_hash
+from data.vectors import cosine_top_k_many
+
 class SemanticSearch:
-  def __init__(self, model_name="all-MiniLM-L6-v2"):
-    # Load the model (downloads automatically the first time)
-    self.model = SentenceTransformer(model_name)
+  def __init__(self, model_name=SEMANTIC_MODEL, storage=EMBEDDING_STORAGE, rescore=RESCORE_CANDIDATES, cache_dir="cache"):
+    self.__model = None
+    self.model_name = model_name
+    self.cache_dir = cache_dir
+    self.store = EmbeddingStore(model_name)
+    # texts per model call, and per batch committed to the store
+    self.encode_batch_size = EMBED_BATCH_SIZE
+    self.encode_pool = None
+    # QueryEncoder batching the queries, once `start_query_encoder` was called
+    self.query_encoder = None
+
+    check_storage_mode(storage)
+    self.storage = storage
+    # best approximate rows rescored in float32, 0 to keep approximate scores
+    self.rescore = rescore
 
     self.embeddings = None
+    # QuantizedVectors at `storage` precision
+    self.normalized_embeddings = None
+    self.ann_index = None
+    self.table = EmbeddingTable(cache_dir, "movie_embeddings")
+    # every movie, memory-mapped from `cache_dir`/documents.bin, and the
+    # movies lined up with the embedding rows
+    self.document_store = None
     self.documents = None
-    self.document_map = {}
+    # fingerprint of the embedding rows searched, stamped on cached results
+    self.version = None
+    self.result_cache = QueryCache()
+    self.embedding_cache = QueryCache()
+
+  @property
+  def model(self):
+    # Loaded (and downloaded the first time) on first use: importing
+    # sentence-transformers pulls in torch, and a process searching
+    # embeddings that are up to date, like a shard worker, never needs it
+    if self.__model is None:
+      with span("model.load"):
+        from sentence_transformers import SentenceTransformer
+        self.__model = SentenceTransformer(self.model_name)
+    return self.__model
+
+  @model.setter
+  def model(self, model):
+    self.__model = model
 
   def generate_embedding(self, text: str):
     text = text.strip()
     if text == "":
       raise ValueError("Input text is blank")
-    return self.model.encode([text])[0]
+    with span("query.encode"):
+      return self.embedding_cache.cached(text, self.query_setting(), lambda: self.__encode_queries([text])[0])
+
+  def __encode_queries(self, texts):
+    if self.query_encoder is None:
+      return self.store.encode(texts, self.model.encode)
+    if self.query_encoder.precision != "float32":
+      # kept out of the store, which holds float32 embeddings only
+      return self.query_encoder.encode_many(texts)
+    return self.store.encode(texts, self.query_encoder.encode_many)
+
+  def remember_query_embedding(self, text: str, embedding) -> None:
+    """Take the embedding of `text` from a caller that encoded it through
+    `query_encoder` itself, so `generate_embedding` does not encode it again."""
+    self.embedding_cache.put(text.strip(), self.query_setting(), embedding)
 
+  def start_query_encoder(self, precision: str = "float32", wait_ms: float = QUERY_BATCH_WAIT_MS, max_batch: int = QUERY_BATCH_SIZE):
+    """Encode queries through a `QueryEncoder` until `stop_query_encoder`.
+
+    With `precision` int8 the queries go through a dynamically quantized
+    copy of the model, which has to agree with it on calibration queries
+    and the first documents. Returns that agreement, 1.0 for float32.
+    """
+    from data.query_encoder import CALIBRATION_QUERIES, QueryEncoder, check_quantized_model, quantize_model
+
+    self.stop_query_encoder()
+    model, agreement = self.model, 1.0
+    if precision == "int8":
+      model = quantize_model(self.model)
+      documents = [f"{doc['title']}: {doc['description']}" for doc in (self.documents or [])[:100]]
+      agreement = check_quantized_model(self.model, model, [*CALIBRATION_QUERIES, *documents])
+    self.query_encoder = QueryEncoder(model, precision, wait_ms, max_batch)
+    return agreement
+
+  def stop_query_encoder(self) -> None:
+    if self.query_encoder is not None:
+      self.query_encoder.close()
+      self.query_encoder = None
+
+  def query_setting(self):
+    """The part of a cache key that depends on how queries are encoded."""
+    if self.query_encoder is None or self.query_encoder.precision == "float32":
+      return self.model_name
+    return (self.model_name, self.query_encoder.precision)
+
+  @traced("embeddings.build")
   def build_embeddings(self, documents):
-    self.documents = documents
-    
-    doc_strings = []
-    for doc in self.documents:
-      self.document_map[doc["id"]] = doc
-      doc_strings.append(f"{doc['title']}: {doc['description']}")
+    """Encode every document from scratch, discarding the cached embeddings.
 
-    self.embeddings = self.model.encode(doc_strings, show_progress_bar=True)
-    np.save(os.path.join("cache", "movie_embeddings.npy"), self.embeddings)
+    `documents` is read once and may be a `MovieStream`.
+    """
+    self.__store_documents(documents)
+    return self.__build()
 
+  def __build(self):
+    self.table = EmbeddingTable(self.cache_dir, "movie_embeddings")
+    self.table.build(lambda: self.__entries(self.document_store), self.__encode, self.encode_batch_size)
+    self.__save_table(False)
     return self.embeddings
 
+  @traced("embeddings.open")
+  def load_embeddings(self, documents):
+    """Open the saved embeddings and documents for searching, without
+    reading the catalog or writing anything: they are as of the last build
+    or `load_or_create_embeddings`.
+
+    `documents` is only read when nothing usable is saved yet, to create them.
+    """
+    path = os.path.join(self.cache_dir, DOCUMENTS_FILE)
+    if os.path.exists(path) and (self.table.embeddings is not None or self.table.load()):
+      self.document_store = DocumentStore(path)
+      try:
+        self.__save_table(False)
+        return self.embeddings
+      except KeyError:
+        # the table has movies the store lacks: it was not saved with it
+        pass
+    return self.load_or_create_embeddings(documents)
+
+  @traced("embeddings.load")
   def load_or_create_embeddings(self, documents):
-    self.documents = documents
-    
-    self.document_map = {doc["id"]: doc for doc in self.documents}
-    cache_name = os.path.join("cache", "movie_embeddings.npy")
+    """Load the cached embeddings and bring them up to date with `documents`,
+    encoding only the movies that are new or whose text changed."""
+    with span("movies.read"):
+      self.__store_documents(documents)
+    documents = self.document_store
+    if self.table.embeddings is None and not self.table.load():
+      self.__convert_legacy_embeddings(documents)
+      if self.table.embeddings is None:
+        return self.__build()
+
+    with span("embeddings.sync"):
+      encoded, deleted = self.table.sync(self.__entries(documents), self.__encode)
+    self.__save_table(encoded or deleted)
+    return self.embeddings
+
+  def upsert_documents(self, documents):
+    """Add new movies and replace changed ones, keyed by id, encoding only
+    the changed texts. Returns the movies given."""
+    if self.embeddings is None:
+      raise ValueError("No embeddings loaded. Call `load_embeddings` first.")
+    documents = list(documents)
+    # a movie written again replaces its earlier row
+    self.__store_documents(chain(self.document_store, documents))
+    self.__save_table(self.table.upsert(self.__entries(documents), self.__encode))
+    return documents
+
+  def delete_documents(self, doc_ids):
+    """Remove movies by id; returns the ids that had embeddings."""
+    if self.embeddings is None:
+      raise ValueError("No embeddings loaded. Call `load_embeddings` first.")
+    present = set(self.table.keys[self.table.live].tolist())
+    removed = [doc_id for doc_id in dict.fromkeys(doc_ids) if doc_id in present]
+    gone = set(removed)
+    self.__store_documents(doc for doc in self.document_store if doc["id"] not in gone)
+    self.__save_table(self.table.delete(removed))
+    return removed
+
+  def __store_documents(self, documents):
+    # The movies are streamed once into the store, and read back from the
+    # map whenever needed: no process keeps the whole catalog in memory.
+    # Only builds and updates write it, and a store still mapped by a
+    # reader is replaced, never modified.
+    path = os.path.join(self.cache_dir, DOCUMENTS_FILE)
+    write_document_store(path, documents)
+    self.document_store = DocumentStore(path)
+
+  def __entries(self, documents):
+    for doc in documents:
+      text = f"{doc['title']}: {doc['description']}"
+      # a different model invalidates the row
+      yield doc["id"], content_hash(f"{self.model_name}\n{text}"), [text]
+
+  def __encode(self, texts):
+    return self.store.encode(texts, self.encode_texts, self.encode_batch_size)
+
+  def encode_texts(self, texts):
+    """Run the model on `texts`, on the worker processes once `start_encode_pool` was called."""
+    count("model.texts", len(texts))
+    with span("model.encode"):
+      if self.encode_pool is not None:
+        return self.model.encode_multi_process(texts, self.encode_pool)
+      return self.model.encode(texts, show_progress_bar=len(texts) > 1)
+
+  def start_encode_pool(self, workers: int) -> None:
+    """Encode on `workers` CPU processes until `stop_encode_pool`."""
+    if workers > 1 and self.encode_pool is None:
+      self.encode_pool = self.model.start_multi_process_pool(["cpu"] * workers)
+
+  def stop_encode_pool(self) -> None:
+    if self.encode_pool is not None:
+      self.model.stop_multi_process_pool(self.encode_pool)
+      self.encode_pool = None
+
+  def __save_table(self, changed):
+    if changed:
+      self.table.compact_if_needed()
+      self.table.save()
+
+    # rows of `embeddings` and `documents` line up; dead rows are skipped
+    live = self.table.live_rows()
+    self.embeddings = self.table.embeddings if len(live) == len(self.table.live) else self.table.embeddings[live]
+    self.version = self.table.fingerprint()
+    with span("embeddings.quantize"):
+      self.normalized_embeddings = load_or_quantize(
+        os.path.join(self.cache_dir, f"movie_embeddings.{self.storage}.npz"), self.embeddings, self.storage, self.version
+      )
+    self.documents = self.document_store.view(self.document_store.rows(self.table.keys[live]))
+
+  def __convert_legacy_embeddings(self, documents):
+    # earlier versions saved one row per document, in document order
+    cache_name = os.path.join(self.cache_dir, "movie_embeddings.npy")
     if os.path.exists(cache_name):
-      self.embeddings = np.load(cache_name)
-    
-      if len(self.embeddings) == len(self.documents):
-        return self.embeddings
-    
-    return self.build_embeddings(documents)
+      embeddings = np.load(cache_name, mmap_mode="r")
+      if len(embeddings) == len(documents):
+        entries = list(self.__entries(documents))
+        self.table.reset(embeddings, [key for key, _, _ in entries], [h for _, h, _ in entries], np.zeros(len(entries)))
+
+  @traced("ann.load")
+  def load_or_create_ann_index(self, nprobe=ANN_NPROBE):
+    """Use an IVF index for `search` instead of scanning every embedding."""
+    if self.embeddings is None:
+      raise ValueError("No embeddings loaded. Call `load_embeddings` first.")
+
+    # the lists cluster the vectors at `storage` precision, so every
+    # precision has its own index
+    self.ann_index = load_or_train_ivf(
+      os.path.join(self.cache_dir, f"movie_embeddings.{self.storage}.ivf.npz"), self.normalized_embeddings, nprobe, self.table.fingerprint()
+    )
+    return self.ann_index
 
+  @traced("semantic.search")
   def search(self, query, limit):
     if self.embeddings is None:
-      raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
-
-    embeddings = self.generate_embedding(query)
-    scores = []
-    for i, doc_embed in enumerate(self.embeddings):
-      score = cosine_similarity(embeddings, doc_embed)
-      scores.append((score, self.document_map[i + 1]))
-
-    scores.sort(key=lambda elt: elt[0], reverse=True)
-    return list(
-      map(
-        lambda s: {
-          "score": s[0],
-          "title": s[1]["title"],
-          "description": s[1]["description"]
-        },
-        scores[:limit])
-      )
-      
+      raise ValueError("No embeddings loaded. Call `load_embeddings` first.")
+
+    return self.result_cache.cached(
+      ("search", " ".join(query.split()), limit, self.query_setting(), ann_setting(self.ann_index), self.storage_setting()),
+      self.version,
+      lambda: self.__results(*self.top_k_rows(self.generate_embedding(query), limit)),
+    )
+
+  def search_many(self, queries, limit):
+    """Search several queries at once, scoring them with one matrix product."""
+    if self.embeddings is None:
+      raise ValueError("No embeddings loaded. Call `load_embeddings` first.")
+
+    queries = [query.strip() for query in queries]
+    if any(query == "" for query in queries):
+      raise ValueError("Input text is blank")
+
+    embeddings = self.__encode_queries(queries)
+    if self.ann_index is not None or not self.normalized_embeddings.exact:
+      return [self.__results(*self.top_k_rows(embedding, limit)) for embedding in embeddings]
 
+    return [
+      self.__results(rows, scores)
+      for rows, scores in cosine_top_k_many(self.normalized_embeddings.codes, embeddings, limit)
+    ]
 
-def cosine_similarity(vec1, vec2):
-  dot_product = np.dot(vec1, vec2)
-  norm1 = np.linalg.norm(vec1)
-  norm2 = np.linalg.norm(vec2)
+  def top_k_rows(self, embedding, limit):
+    """Return the (rows, scores) of the documents closest to `embedding`.
 
-  if norm1 == 0 or norm2 == 0:
-    return 0.0
+    Reduced precision rankings pick `rescore` candidates, which are ranked
+    again by their exact cosine similarity.
+    """
+    vectors = self.normalized_embeddings
+    rescore = self.rescore > 0 and not vectors.exact
+    candidates = max(limit, self.rescore) if rescore else limit
+    with span("semantic.score"):
+      if self.ann_index is not None:
+        rows, scores = self.ann_index.search(vectors, embedding, candidates)
+      else:
+        rows, scores = vectors.top_k(embedding, candidates)
+    if not rescore:
+      return rows, scores
+    with span("semantic.rescore"):
+      return vectors.rescore(embedding, rows, limit)
 
-  return dot_product / (norm1 * norm2)
+  def score_rows(self, embedding, rows):
+    """Cosine similarity of `embedding` with the documents at `rows` only."""
+    if self.rescore > 0:
+      return self.normalized_embeddings.exact_scores(embedding, rows)
+    return self.normalized_embeddings.scores(embedding, rows)
+
+  def storage_setting(self):
+    """The part of a cache key that depends on the embedding precision."""
+    return self.storage if self.normalized_embeddings.exact else (self.storage, self.rescore)
+
+  def __results(self, rows, scores):
+    # only the rows returned are read from the document store
+    results = []
+    for row, score in zip(rows.tolist(), scores.tolist()):
+      doc = self.documents[row]
+      results.append({"score": score, "title": doc["title"], "description": doc["description"]})
+    return results
+
+
+def ann_setting(ann_index):
+  """The part of a cache key that depends on approximate search."""
+  return None if ann_index is None else ("ivf", ann_index.nprobe)
 
 def verify_model():
   sem = SemanticSearch()
@@ -85,11 +337,9 @@ def verify_model():
 
 def verify_embeddings():
   sem = SemanticSearch()
-  with open(os.path.join("data", "movies.json")) as mov:
-    documents = json.load(mov)["movies"]
-  embeddings = sem.load_or_create_embeddings(documents)
+  embeddings = sem.load_or_create_embeddings(MovieStream())
 
-  print(f"Number of docs:   {len(documents)}")
+  print(f"Number of docs:   {len(sem.documents)}")
   print(f"Embeddings shape: {embeddings.shape[0]} vectors in {embeddings.shape[1]} dimensions")
     
 
@@ -102,13 +352,20 @@ def embed_text(text: str):
   print(f"Dimensions: {embedding.shape[0]}")
 
 
-def search_query(query: str, limit: int):
-  sem = SemanticSearch()
-  with open(os.path.join("data", "movies.json")) as mov:
-    documents = json.load(mov)["movies"]
-  sem.load_or_create_embeddings(documents)
+def search_query(query: str, limit: int, ann: bool = False, nprobe: int = ANN_NPROBE, persist_cache: bool = False,
+                 storage: str = EMBEDDING_STORAGE, rescore: int = RESCORE_CANDIDATES):
+  sem = SemanticSearch(storage=storage, rescore=rescore)
+  if persist_cache:
+    sem.result_cache = persistent_cache("semantic")
+  sem.load_embeddings(MovieStream())
+  if ann:
+    sem.load_or_create_ann_index(nprobe)
+
+  print_search_results(sem.search(query, limit))
+  sem.result_cache.save()
 
-  for i, result in enumerate(sem.search(query, limit)):
+def print_search_results(results: list[dict]):
+  for i, result in enumerate(results):
     print(f"{i + 1}. {result["title"]} (score: {result["score"]: .4f})\n\t{result["description"]}\n")
 
 def embed_query_text(query: str):
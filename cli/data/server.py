@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from data.chunked_semantic_search import ChunkedSemantticSearch
+from data.definitions import ANN_NPROBE, EMBEDDING_STORAGE, HYBRID_CANDIDATES, HYBRID_ALPHA, QUERY_BATCH_WAIT_MS, RRF_K
+from data.hybrid_search import HybridSearch
+from data.inverted_index import InvertedIndex
+from data.movies import MovieStream
+from data.utils import Tokenizer
+
+# commands whose query is encoded by the model
+SEMANTIC_COMMANDS = ("search", "search_chunked", "hybrid")
+
+class UnsupportedRequest(ValueError):
+  """A request for settings the server was not started with; the client
+  answers it locally instead."""
+
+class QueryServer:
+  """Keeps the index, model and embeddings in memory and answers queries.
+
+  Clients send one JSON request per line, {"command": ..., **params}, and get
+  one JSON line back: {"results": [...]}, {"error": "..."}, or
+  {"unsupported": "..."} when the request asks for other settings than the
+  server's. A request leaving out "storage" or "rescore" gets the server's.
+  """
+  def __init__(self, index: InvertedIndex, semantic: ChunkedSemantticSearch) -> None:
+    self.index = index
+    self.semantic = semantic
+    self.hybrid = HybridSearch(index, semantic)
+    self.ann_index = semantic.ann_index
+    self.chunk_ann_index = semantic.chunk_ann_index
+    self.rescore = semantic.rescore
+    # queries run one at a time off the event loop, so the model and the
+    # ANN switches below are never used concurrently
+    self.executor = ThreadPoolExecutor(max_workers=1)
+
+  def handle(self, request: dict, embedding=None):
+    if embedding is not None:
+      self.semantic.remember_query_embedding(request["query"], embedding)
+
+    match request.get("command"):
+      case "keyword_search":
+        docs = self.index.search(request["query"], request.get("limit", 5), request.get("mode", "first"))
+        return [{"id": doc["id"], "title": doc["title"]} for doc in docs]
+
+      case "bm25search":
+        docs = self.index.bm25_search(request["query"], request.get("limit", 5), request.get("mode", "array"))
+        return [{"id": doc["id"], "title": doc["title"], "description": doc["description"], "score": score} for doc, score in docs]
+
+      case "search":
+        self.semantic.ann_index = self.__ann(self.ann_index, request)
+        self.__storage(request)
+        return self.semantic.search(request["query"], request.get("limit", 5))
+
+      case "search_chunked":
+        self.semantic.chunk_ann_index = self.__ann(self.chunk_ann_index, request)
+        self.__storage(request)
+        return self.semantic.search_chunks(request["query"], request.get("limit", 5))
+
+      case "hybrid":
+        self.semantic.ann_index = self.__ann(self.ann_index, request)
+        self.__storage(request)
+        results, timings = self.hybrid.search(
+          request["query"],
+          request.get("limit", 5),
+          request.get("method", "rrf"),
+          request.get("alpha", HYBRID_ALPHA),
+          request.get("k", RRF_K),
+          request.get("candidates", HYBRID_CANDIDATES),
+          request.get("rerank", False),
+        )
+        return {"documents": results, "timings": timings}
+
+      case "cache_stats":
+        return {
+          "bm25 results": self.index.result_cache.stats(),
+          "semantic results": self.semantic.result_cache.stats(),
+          "query embeddings": self.semantic.embedding_cache.stats(),
+        }
+
+      case command:
+        raise ValueError(f"unknown command: {command}")
+
+  def __ann(self, ann_index, request):
+    if not request.get("ann"):
+      return None
+    if ann_index is None:
+      raise UnsupportedRequest("server was started without --ann")
+    ann_index.nprobe = request.get("nprobe", ANN_NPROBE)
+    return ann_index
+
+  def __storage(self, request):
+    storage = request.get("storage", self.semantic.storage)
+    if storage != self.semantic.storage:
+      raise UnsupportedRequest(f"server was started with --storage {self.semantic.storage}, not {storage}")
+    self.semantic.rescore = request.get("rescore", self.rescore)
+
+  async def __serve_client(self, reader, writer):
+    loop = asyncio.get_running_loop()
+    while line := await reader.readline():
+      try:
+        request = json.loads(line)
+        embedding = None
+        if self.semantic.query_encoder is not None and request.get("command") in SEMANTIC_COMMANDS and request.get("query", "").strip():
+          # encoded while other clients' queries run, in batches with them
+          embedding = await asyncio.wrap_future(self.semantic.query_encoder.submit(request["query"].strip()))
+        results = await loop.run_in_executor(self.executor, self.handle, request, embedding)
+        response = {"results": results}
+      except UnsupportedRequest as e:
+        response = {"unsupported": str(e)}
+      except Exception as e:
+        response = {"error": str(e)}
+      writer.write(json.dumps(response).encode() + b"\n")
+      await writer.drain()
+
+    writer.close()
+    await writer.wait_closed()
+
+  async def serve_forever(self, path: str):
+    if os.path.exists(path):
+      os.remove(path)
+
+    server = await asyncio.start_unix_server(self.__serve_client, path)
+    try:
+      async with server:
+        await server.serve_forever()
+    finally:
+      # closing the server may have removed it already
+      try: os.remove(path)
+      except FileNotFoundError: pass
+
+def serve(path: str, ann: bool = False, storage: str = EMBEDDING_STORAGE, query_precision: str | None = None,
+          query_wait_ms: float = QUERY_BATCH_WAIT_MS):
+  """Answer queries on `path` until interrupted. `query_precision` batches
+  the encoding of concurrent queries, with the model at that precision."""
+  tokenizer = Tokenizer()
+  tokenizer.load_stop_words(os.path.join("data", "stopwords.txt"))
+  index = InvertedIndex(tokenizer)
+  index.load()
+  index.load_stem_cache()
+
+  semantic = ChunkedSemantticSearch(storage=storage)
+  semantic.load_chunk_embeddings(MovieStream())
+  # loaded now rather than by the first query
+  semantic.model
+  if ann:
+    semantic.load_or_create_ann_index()
+    semantic.load_or_create_chunk_ann_index()
+  if query_precision is not None:
+    agreement = semantic.start_query_encoder(query_precision, query_wait_ms)
+    print(f"Encoding queries in {query_precision} batches within {query_wait_ms} ms (cosine agreement {agreement:.4f})")
+
+  print(f"Serving {len(index.docmap)} documents on {path}")
+  try:
+    asyncio.run(QueryServer(index, semantic).serve_forever(path))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    semantic.stop_query_encoder()
@@ -0,0 +1,189 @@
+import heapq
+import json
+import multiprocessing
+import os
+import tempfile
+
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from data.definitions import EMBEDDING_STORAGE, RESCORE_CANDIDATES
+from data.index_format import MappedIndex
+from data.inverted_index import InvertedIndex, INDEX_FILE
+from data.movies import MovieStream
+from data.profiling import span
+from data.utils import Tokenizer
+
+# shard count and corpus-wide BM25 statistics, next to the shard directories
+SHARDS_FILE = "shards.json"
+SHARD_KINDS = ("keyword", "semantic")
+
+def shard_of(doc_id: int, shard_count: int) -> int:
+  """The shard holding a movie: ids are spread by hash, the id modulo the count."""
+  return doc_id % shard_count
+
+def shard_dir(cache_dir: str, shard: int) -> str:
+  return os.path.join(cache_dir, f"shard-{shard}")
+
+@contextmanager
+def split_movies(movies, shard_count: int, cache_dir: str = "cache"):
+  """Route `movies` one at a time to a JSONL file per shard, in a temporary
+  directory under `cache_dir`, and yield the (streams, sizes) of the shards.
+
+  No shard is held in memory: each is read back as a `MovieStream`, and
+  the files are removed on exit.
+  """
+  sizes = [0] * shard_count
+  with tempfile.TemporaryDirectory(prefix="split-", dir=cache_dir) as spool:
+    paths = [os.path.join(spool, f"shard-{shard}.jsonl") for shard in range(shard_count)]
+    with ExitStack() as stack:
+      files = [stack.enter_context(open(path, "w", encoding="utf-8")) for path in paths]
+      for movie in movies:
+        shard = shard_of(movie["id"], shard_count)
+        files[shard].write(json.dumps(movie) + "\n")
+        sizes[shard] += 1
+    yield [MovieStream(path) for path in paths], sizes
+
+def load_shards_file(cache_dir: str = "cache") -> dict:
+  try:
+    with open(os.path.join(cache_dir, SHARDS_FILE)) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    raise IOError(f"No shards under {cache_dir}, build them with `keyword_search_cli.py build --shards N`")
+
+def build_keyword_shards(movies, shard_count: int, tokenizer, cache_dir: str = "cache", workers: int = 1) -> list[int]:
+  """Split `movies` into `shard_count` keyword indexes under
+  `cache_dir`/shard-*/, then collect the statistics shards score with.
+
+  Returns the number of documents of every shard.
+  """
+  if shard_count < 1:
+    raise ValueError(f"Shard count needs to be strictly positive: (actual {shard_count})")
+  os.makedirs(cache_dir, exist_ok=True)
+  # one shard index is in memory at a time
+  with split_movies(movies, shard_count, cache_dir) as (streams, sizes):
+    for shard, shard_movies in enumerate(streams):
+      os.makedirs(shard_dir(cache_dir, shard), exist_ok=True)
+      index = InvertedIndex(tokenizer, shard_dir(cache_dir, shard))
+      index.build(shard_movies, workers)
+      index.save()
+
+  # stats pass: a corpus-wide document count, total length and document
+  # frequencies make every shard score like the unsharded index
+  doc_count, total_length, dfs = 0, 0, Counter()
+  for shard in range(shard_count):
+    mapped = MappedIndex(os.path.join(shard_dir(cache_dir, shard), INDEX_FILE))
+    doc_count += mapped.doc_count
+    total_length += int(mapped.doc_lengths.sum())
+    dfs.update(dict(zip(mapped.terms(), mapped.term_dfs.tolist())))
+
+  with open(os.path.join(cache_dir, f"{SHARDS_FILE}.tmp"), "w") as f:
+    json.dump({"shard_count": shard_count, "doc_count": doc_count, "total_length": total_length, "dfs": dfs}, f)
+  os.replace(os.path.join(cache_dir, f"{SHARDS_FILE}.tmp"), os.path.join(cache_dir, SHARDS_FILE))
+  return sizes
+
+def build_semantic_shards(movies, cache_dir: str = "cache", storage: str = EMBEDDING_STORAGE) -> list[int]:
+  """Bring the movie embeddings of every shard up to date, for the shard
+  count the keyword shards were built with. One model encodes them all."""
+  from data.semantic_search import SemanticSearch
+
+  shard_count = load_shards_file(cache_dir)["shard_count"]
+  model = None
+  with split_movies(movies, shard_count, cache_dir) as (streams, sizes):
+    for shard, shard_movies in enumerate(streams):
+      semantic = SemanticSearch(storage=storage, cache_dir=shard_dir(cache_dir, shard))
+      if model is not None:
+        semantic.model = model
+      semantic.load_or_create_embeddings(shard_movies)
+      model = semantic.model
+  return sizes
+
+# the shard a worker process serves, loaded by its first task
+_shard = None
+
+def _load_shard(kind, cache_dir, shard, storage, rescore):
+  global _shard
+  if _shard is not None:
+    return
+  shards = load_shards_file(cache_dir)
+  match kind:
+    case "keyword":
+      tokenizer = Tokenizer()
+      tokenizer.load_stop_words(os.path.join("data", "stopwords.txt"))
+      _shard = InvertedIndex(tokenizer, shard_dir(cache_dir, shard))
+      _shard.load()
+      _shard.load_stem_cache()
+      _shard.use_corpus_stats(shards["doc_count"], shards["total_length"], shards["dfs"])
+    case "semantic":
+      from data.semantic_search import SemanticSearch
+      _shard = SemanticSearch(storage=storage, rescore=rescore, cache_dir=shard_dir(cache_dir, shard))
+      if not _shard.table.exists():
+        raise IOError(f"No embeddings in {shard_dir(cache_dir, shard)}, build them with `semantic_search_cli.py embed_shards`")
+      _shard.load_embeddings(
+        movie for movie in MovieStream() if shard_of(movie["id"], shards["shard_count"]) == shard)
+
+def _bm25_search(query, limit, mode):
+  return _shard.bm25_search(query, limit, mode)
+
+def _semantic_search(embedding, limit):
+  rows, scores = _shard.top_k_rows(embedding, limit)
+  return [(_shard.documents[row], score) for row, score in zip(rows.tolist(), scores.tolist())]
+
+class ShardedSearch:
+  """Scatter-gather search over the shards under `cache_dir`/shard-*/.
+
+  Each shard is served by a worker process of its own, which keeps the
+  shard's keyword index or embeddings loaded. A query goes to every shard
+  and the per-shard top-k are merged by score, ties by ascending id.
+  """
+  def __init__(self, kind: str, cache_dir: str = "cache", storage: str = EMBEDDING_STORAGE, rescore: int = RESCORE_CANDIDATES) -> None:
+    if kind not in SHARD_KINDS:
+      raise ValueError(f"Unknown shard kind {kind!r}, expected one of {", ".join(SHARD_KINDS)}")
+    self.kind = kind
+    self.shard_count = load_shards_file(cache_dir)["shard_count"]
+    self.encoder = None
+    context = multiprocessing.get_context("spawn")
+    self.pools = [context.Pool(1) for _ in range(self.shard_count)]
+    # every shard loads in parallel; a failure surfaces here
+    try:
+      with span("shards.load"):
+        loading = [pool.apply_async(_load_shard, (kind, cache_dir, shard, storage, rescore)) for shard, pool in enumerate(self.pools)]
+        for result in loading:
+          result.get()
+    except BaseException:
+      self.close()
+      raise
+
+  def bm25_search(self, query: str, limit: int, mode: str = "array"):
+    """The `limit` best (document, score) pairs over every shard."""
+    if self.kind != "keyword":
+      raise ValueError("BM25 search needs keyword shards")
+    if mode == "naive":
+      raise ValueError("naive BM25 scores with per-shard statistics, use array or pruned over shards")
+    return self.__merge(self.__scatter(_bm25_search, query, limit, mode), limit)
+
+  def search(self, query: str, limit: int):
+    """The `limit` movies closest to `query` over every shard, in the shape
+    of `SemanticSearch.search` results. The query is encoded once, here."""
+    if self.kind != "semantic":
+      raise ValueError("Semantic search needs semantic shards")
+    if self.encoder is None:
+      from data.semantic_search import SemanticSearch
+      self.encoder = SemanticSearch()
+    embedding = self.encoder.generate_embedding(query)
+    merged = self.__merge(self.__scatter(_semantic_search, embedding, limit), limit)
+    return [{"score": score, "title": doc["title"], "description": doc["description"]} for doc, score in merged]
+
+  def close(self) -> None:
+    for pool in self.pools:
+      pool.close()
+      pool.join()
+
+  def __scatter(self, task, *args):
+    with span("shards.scatter"):
+      pending = [pool.apply_async(task, args) for pool in self.pools]
+      return [result.get() for result in pending]
+
+  def __merge(self, results, limit):
+    with span("shards.merge"):
+      return heapq.nsmallest(limit, (found for shard in results for found in shard), key=lambda found: (-found[1], found[0]["id"]))
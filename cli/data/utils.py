@@ -1,27 +1,85 @@
+import hashlib
+import json
+import os
 import string
 import re
-from itertools import count, takewhile
+from itertools import count, islice, takewhile
 
-from nltk.stem import PorterStemmer
+from data.definitions import STEM_CACHE_SIZE
+from data import profiling
+
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
 
 class Tokenizer:
-  def __init__(self) -> None:
+  """Splits text into stemmed tokens, dropping punctuation and stopwords.
+
+  Stems are memoized per lowercased word in `stem_cache`, which holds at
+  most `stem_cache_size` words and forgets the oldest first. The NLTK
+  stemmer is only imported once a word misses the cache.
+  """
+  def __init__(self, stem_cache_size: int = STEM_CACHE_SIZE) -> None:
     self.stopwords = set()
-    self.stemmer = PorterStemmer()
+    self.stemmer = None
+    self.stem_cache = {}
+    self.stem_cache_size = stem_cache_size
+    # number of words stemmed so far, i.e. of insertions into stem_cache
+    self.stem_count = 0
 
   def load_stop_words(self, fname: str):
     with open(fname) as stop:
         self.stopwords = set(stop.read().splitlines())
 
   def tokenize_word(self, word: str):
-    return self.stemmer.stem(word.lower())
+    word = word.lower()
+    stem = self.stem_cache.get(word)
+    if stem is None:
+      if self.stemmer is None:
+        from nltk.stem import PorterStemmer
+        self.stemmer = PorterStemmer()
+      stem = self.stemmer.stem(word)
+      self.__cache_stem(word, stem)
+      profiling.count("tokenizer.stems")
+    return stem
 
   def tokenize_str(self, s: str):
-      table = str.maketrans("", "", string.punctuation)
-      new_s = s.translate(table)
-      return list(filter(
-         lambda w: w not in self.stopwords,
-         map(self.tokenize_word, new_s.split())))
+    # stopwords are matched against the stems, as they always have been
+    stopwords = self.stopwords
+    words = s.translate(PUNCTUATION_TABLE).split()
+    profiling.count("tokenizer.words", len(words))
+    return [stem for stem in map(self.tokenize_word, words) if stem not in stopwords]
+
+  def tokenize_many(self, texts):
+    """Yield the tokens of each text in turn."""
+    for text in texts:
+      yield self.tokenize_str(text)
+
+  def recent_stems(self, count: int) -> dict:
+    """The last `count` words added to the stem cache (fewer if evicted)."""
+    return dict(reversed(list(islice(reversed(self.stem_cache.items()), count))))
+
+  def add_stems(self, stems: dict):
+    for word, stem in stems.items():
+      if word not in self.stem_cache:
+        self.__cache_stem(word, stem)
+
+  def save_stem_cache(self, fname: str):
+    with open(f"{fname}.tmp", "w") as f:
+      json.dump(self.stem_cache, f)
+    os.replace(f"{fname}.tmp", fname)
+
+  def load_stem_cache(self, fname: str):
+    with open(fname) as f:
+      self.add_stems(json.load(f))
+
+  def __cache_stem(self, word, stem):
+    if len(self.stem_cache) >= self.stem_cache_size:
+      del self.stem_cache[next(iter(self.stem_cache))]
+    self.stem_cache[word] = stem
+    self.stem_count += 1
+
+def content_hash(text: str) -> int:
+  """Stable 64-bit hash of a document text, used to detect changed documents."""
+  return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
 
 def get_chunks_from_str(text: str, chunk_size: int, overlap: int=0) -> list[str]:
   if chunk_size <= 0:
@@ -0,0 +1,39 @@
+import numpy as np
+
+from data.ranking import top_k
+
+def cosine_similarity(vec1, vec2):
+  dot_product = np.dot(vec1, vec2)
+  norm1 = np.linalg.norm(vec1)
+  norm2 = np.linalg.norm(vec2)
+
+  if norm1 == 0 or norm2 == 0:
+    return 0.0
+
+  return dot_product / (norm1 * norm2)
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+  """Scale every row to unit L2 norm, leaving all-zero rows untouched."""
+  matrix = np.asarray(matrix, dtype=np.float32)
+  norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+  norms[norms == 0] = 1
+  return matrix / norms
+
+def cosine_top_k(normalized: np.ndarray, query: np.ndarray, limit: int):
+  """Return the (rows, scores) of the `limit` rows most similar to `query`.
+
+  `normalized` must come from `normalize_rows`, so scoring is a single
+  matrix-vector product.
+  """
+  scores = normalized @ normalize_rows(query)
+  best = top_k(scores, limit)
+  return best, scores[best]
+
+def cosine_top_k_many(normalized: np.ndarray, queries: np.ndarray, limit: int):
+  """Batched `cosine_top_k`: one matrix-matrix product for all queries."""
+  scores = normalize_rows(queries) @ normalized.T
+  results = []
+  for query_scores in scores:
+    best = top_k(query_scores, limit)
+    results.append((best, query_scores[best]))
+  return results
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+
+from data.client import request
+from data.definitions import HYBRID_CANDIDATES, HYBRID_ALPHA, RRF_K
+from data.movies import MovieStream
+from data.query_cache import persistent_cache
+from data.utils import Tokenizer
+
+def local_search(args):
+  # imported here, so a query answered by the server loads neither NumPy nor the model
+  from data.hybrid_search import HybridSearch
+  from data.inverted_index import InvertedIndex
+  from data.semantic_search import SemanticSearch
+
+  timings = {}
+
+  start = time.perf_counter()
+  tokenizer = Tokenizer()
+  tokenizer.load_stop_words(os.path.join("data", "stopwords.txt"))
+  index = InvertedIndex(tokenizer)
+  try:
+    index.load()
+  except IOError as e:
+    print(f"Error while loading index files: {e}")
+    sys.exit(1)
+  if args.persist_cache:
+    index.result_cache = persistent_cache("bm25")
+  timings["load index"] = time.perf_counter() - start
+
+  start = time.perf_counter()
+  semantic = SemanticSearch()
+  semantic.load_embeddings(MovieStream())
+  timings["load model and embeddings"] = time.perf_counter() - start
+
+  hybrid = HybridSearch(index, semantic)
+  results, search_timings = hybrid.search(args.query, args.limit, args.method, args.alpha, args.k, args.candidates, args.rerank)
+  index.result_cache.save()
+  return results, timings | search_timings
+
+def main():
+  parser = argparse.ArgumentParser(description="Hybrid Search CLI")
+  parser.add_argument("--local", action="store_true", help="Answer locally even if a query server is running")
+  parser.add_argument("--persist-cache", action="store_true", help="Keep BM25 results in a cache file shared by later runs")
+  subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+  search_parser = subparsers.add_parser("search", help="Search movies by fusing BM25 and semantic rankings")
+  search_parser.add_argument("query", type=str, help="The search query")
+  search_parser.add_argument("--limit", type=int, default=5, help="The maximum number of results")
+  search_parser.add_argument("--method", choices=["rrf", "weighted"], default="rrf", help="Reciprocal rank fusion or weighted sum of normalized scores")
+  search_parser.add_argument("--alpha", type=float, default=HYBRID_ALPHA, help="Weight of the BM25 score with --method weighted")
+  search_parser.add_argument("--k", type=int, default=RRF_K, help="RRF rank constant")
+  search_parser.add_argument("--candidates", type=int, default=HYBRID_CANDIDATES, help="Number of candidates taken from each retriever")
+  search_parser.add_argument("--rerank", action="store_true", help="Only score the BM25 candidates semantically instead of every embedding")
+  search_parser.add_argument("--timings", action="store_true", help="Print the time spent in each stage")
+
+  args = parser.parse_args()
+
+  match args.command:
+    case "search":
+      response = None if args.local else request(
+        "hybrid", query=args.query, limit=args.limit, method=args.method, alpha=args.alpha,
+        k=args.k, candidates=args.candidates, rerank=args.rerank)
+      if response is None:
+        results, timings = local_search(args)
+      else:
+        results, timings = response["documents"], response["timings"]
+
+      for i, result in enumerate(results):
+        ranks = ", ".join(
+          f"{source} #{result[f"{source}_rank"]}" for source in ("bm25", "semantic") if result[f"{source}_rank"] is not None)
+        print(f"{i + 1}. ({result["id"]}) {result["title"]} (score: {result["score"]:.4f}) [{ranks}]")
+
+      if args.timings:
+        print()
+        for stage, elapsed in timings.items():
+          print(f"{stage:<28} {elapsed * 1000:>9.2f} ms")
+
+    case _:
+      parser.print_help()
+
+if __name__ == "__main__":
+  main()
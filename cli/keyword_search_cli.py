@@ -2,19 +2,25 @@
 
 import argparse
 import os
-import json
 import math
 import sys
 
 
+from data.client import request
+from data.movies import MovieStream
+from data.profiling import profiled
+from data.query_cache import persistent_cache
 from data.utils import Tokenizer
-from data.inverted_index import InvertedIndex
 from data.definitions import BM25_K1, BM25_B
 
+# NumPy comes with the index, which is imported only by the commands that
+# open one: --help and queries answered by the server start without it
 def load_index(tokenizer):
+    from data.inverted_index import InvertedIndex
     index = InvertedIndex(tokenizer)
     try:
         index.load()
+        index.load_stem_cache()
         return index
     except IOError as e:
         print(f"Error while loading index files: {e}")
@@ -23,11 +29,23 @@ def load_index(tokenizer):
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
+    parser.add_argument("--local", action="store_true", help="Answer locally even if a query server is running")
+    parser.add_argument("--persist-cache", action="store_true", help="Keep BM25 results in a cache file shared by later runs")
+    parser.add_argument("--profile", action="store_true", help="Print the time spent in each stage and the hot-path counters to stderr")
+    parser.add_argument("--profile-output", type=str, help="With --profile, also save a Chrome trace (.json) or a cProfile dump (any other name)")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    subparsers.add_parser("build", help="Build index")
+    build_parser = subparsers.add_parser("build", help="Build index")
+    build_parser.add_argument("--workers", type=int, default=1, help="Number of processes tokenizing documents")
+    build_parser.add_argument("--shards", type=int, default=None, help="Build this many indexes, one per shard of the movies, under cache/shard-*/")
+    subparsers.add_parser("convert", help="Convert a legacy pickle cache into the binary index format")
+    subparsers.add_parser("update", help="Update the index to match data/movies.json, re-indexing only changed movies")
+    delete_parser = subparsers.add_parser("delete", help="Remove movies from the index")
+    delete_parser.add_argument("doc_ids", type=int, nargs="+", help="Document ids")
+    subparsers.add_parser("compact", help="Merge pending updates into the base index")
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
     search_parser.add_argument("query", type=str, help="Search query")
+    search_parser.add_argument("--mode", choices=["first", "and", "or"], default="first", help="Documents of each token in turn, documents containing every token, or any token")
 
     term_freq_parser = subparsers.add_parser("tf", help="get term frequency for give document id and term")
     term_freq_parser.add_argument("doc_id", type=int, help="Document id")
@@ -53,98 +71,131 @@ def main() -> None:
 
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
     bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("--mode", choices=["array", "pruned", "naive"], default="array", help="Scoring engine: precomputed arrays, block-max MaxScore pruning or per-posting reference scoring")
+    bm25search_parser.add_argument("--sharded", action="store_true", help="Search the shards built with build --shards, one process per shard")
 
     args = parser.parse_args()
 
-    with open(os.path.join("data", "movies.json")) as mov:
-        movies = json.load(mov)
-
-    tokenizer = Tokenizer()
-    tokenizer.load_stop_words(os.path.join("data", "stopwords.txt"))
-
-    match args.command:
-        case "search":
-            index = load_index(tokenizer)
-
-            print(f"Searching for: {args.query}")
-
-
-            curr = set()
-            result = []
-            for tok in tokenizer.tokenize_str(args.query):
-                docs = index.get_documents(tok)
-                result.extend(filter(lambda doc: doc["id"] not in curr, docs))
-                if len(result) > 5:
-                    result = result[:5]
-                    break
-
-                curr.update(map(lambda doc: doc["id"], docs))
-
-            for i, mov in enumerate(result):
-                print(f"{i + 1}. {mov["title"]}")
-
-        case "tf":
-            index = load_index(tokenizer)
-
-            print(f"Retrieve term frequency for '{args.term}' in document {args.doc_id}")
-            print(f"Count: {index.get_tf(args.doc_id, args.term)}")
-
-        case "idf":
-            index = load_index(tokenizer)
-
-            term = tokenizer.tokenize_word(args.term)
-            term_doc_count = len(index.get_documents(term))
-            idf = math.log((len(index.docmap) + 1) / (term_doc_count + 1))
-            print(idf)
-
-            print(f"Inverse document frequency of '{term}': {idf:.2f}")
-
-        case "tfidf":
-            index = load_index(tokenizer)
-
-            term = tokenizer.tokenize_word(args.term)
-            term_doc_count = len(index.get_documents(term))
-            idf = math.log((len(index.docmap) + 1) / (term_doc_count + 1))
-
-            tf = index.get_tf(args.doc_id, term)
-            tf_idf = tf * idf
-            print(tf_idf)
-            print(f"TF-IDF score of '{args.term}' in document '{args.doc_id}': {tf_idf:.2f}")
-
-        case "bm25idf":
-            index = load_index(tokenizer)
-
-            idf = index.get_bm25_idf(args.term)
-            print(idf)
-
-            print(f"Inverse document frequency of '{args.term}': {idf:.2f}")
-
-        case "bm25tf":
-            index = load_index(tokenizer)
-
-            bm25tf = index.get_bm25_tf(args.doc_id, args.term, args.k1, args.b)
-            print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}-{(bm25tf + 0.01):.2f}")
-
-        case "bm25search":
-            def get_scores(score):
-                sc_list = [score - 0.01 * i for i in range(10)]
-                return ",".join(map(lambda s: f"{s:.2f}", sc_list))
-
-
-            index = load_index(tokenizer)
-            docs = index.bm25_search(args.query, 5)
-            for i, res in enumerate(docs):
-                doc, score = res
-                print(f"{i + 1}. ({doc['id']}) {doc["title"]} - Score: ({get_scores(score)})")
-
-
-        case "build":
-            index = InvertedIndex(tokenizer)
-            index.build(movies["movies"])
-            index.save()
-
-        case _:
-            parser.print_help()
+    with profiled(args.profile, args.profile_output):
+        tokenizer = Tokenizer()
+        tokenizer.load_stop_words(os.path.join("data", "stopwords.txt"))
+
+        match args.command:
+            case "search":
+                result = None if args.local else request("keyword_search", query=args.query, limit=5, mode=args.mode)
+                if result is None:
+                    result = load_index(tokenizer).search(args.query, 5, args.mode)
+
+                print(f"Searching for: {args.query}")
+                for i, mov in enumerate(result):
+                    print(f"{i + 1}. {mov["title"]}")
+
+            case "tf":
+                index = load_index(tokenizer)
+
+                print(f"Retrieve term frequency for '{args.term}' in document {args.doc_id}")
+                print(f"Count: {index.get_tf(args.doc_id, args.term)}")
+
+            case "idf":
+                index = load_index(tokenizer)
+
+                term = tokenizer.tokenize_word(args.term)
+                term_doc_count = index.get_document_frequency(term)
+                idf = math.log((len(index.docmap) + 1) / (term_doc_count + 1))
+                print(idf)
+
+                print(f"Inverse document frequency of '{term}': {idf:.2f}")
+
+            case "tfidf":
+                index = load_index(tokenizer)
+
+                term = tokenizer.tokenize_word(args.term)
+                term_doc_count = index.get_document_frequency(term)
+                idf = math.log((len(index.docmap) + 1) / (term_doc_count + 1))
+
+                tf = index.get_tf(args.doc_id, term)
+                tf_idf = tf * idf
+                print(tf_idf)
+                print(f"TF-IDF score of '{args.term}' in document '{args.doc_id}': {tf_idf:.2f}")
+
+            case "bm25idf":
+                index = load_index(tokenizer)
+
+                idf = index.get_bm25_idf(args.term)
+                print(idf)
+
+                print(f"Inverse document frequency of '{args.term}': {idf:.2f}")
+
+            case "bm25tf":
+                index = load_index(tokenizer)
+
+                bm25tf = index.get_bm25_tf(args.doc_id, args.term, args.k1, args.b)
+                print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}-{(bm25tf + 0.01):.2f}")
+
+            case "bm25search":
+                def get_scores(score):
+                    sc_list = [score - 0.01 * i for i in range(10)]
+                    return ",".join(map(lambda s: f"{s:.2f}", sc_list))
+
+
+                docs = None if args.local or args.sharded else request("bm25search", query=args.query, limit=5, mode=args.mode)
+                if docs is None and args.sharded:
+                    from data.sharding import ShardedSearch
+                    sharded = ShardedSearch("keyword")
+                    try:
+                        docs = [{**doc, "score": score} for doc, score in sharded.bm25_search(args.query, 5, args.mode)]
+                    finally:
+                        sharded.close()
+                elif docs is None:
+                    index = load_index(tokenizer)
+                    if args.persist_cache:
+                        index.result_cache = persistent_cache("bm25")
+                    docs = [{**doc, "score": score} for doc, score in index.bm25_search(args.query, 5, args.mode)]
+                    index.result_cache.save()
+
+                for i, doc in enumerate(docs):
+                    print(f"{i + 1}. ({doc['id']}) {doc["title"]} - Score: ({get_scores(doc["score"])})")
+
+
+            case "build":
+                if args.shards is not None:
+                    from data.sharding import build_keyword_shards
+                    sizes = build_keyword_shards(MovieStream(), args.shards, tokenizer, workers=args.workers)
+                    print(f"Built {len(sizes)} shards of {min(sizes)} to {max(sizes)} documents")
+                else:
+                    from data.inverted_index import InvertedIndex
+                    index = InvertedIndex(tokenizer)
+                    index.build(MovieStream(), args.workers)
+                    index.save()
+
+            case "convert":
+                from data.inverted_index import InvertedIndex
+                index = InvertedIndex(tokenizer)
+                try:
+                    index.load_pickle()
+                except IOError as e:
+                    print(f"Error while loading pickle cache: {e}")
+                    sys.exit(1)
+                index.save()
+                print(f"Converted {len(index.docmap)} documents to the binary index format")
+
+            case "update":
+                index = load_index(tokenizer)
+                changed, deleted = index.sync(MovieStream())
+                print(f"Updated {len(changed)} and deleted {len(deleted)} documents")
+
+            case "delete":
+                index = load_index(tokenizer)
+                deleted = index.delete(args.doc_ids)
+                print(f"Deleted {len(deleted)} documents")
+
+            case "compact":
+                index = load_index(tokenizer)
+                index.compact()
+                print(f"Compacted {len(index.docmap)} documents into the base index")
+
+            case _:
+                parser.print_help()
 
 
 if __name__ == "__main__":
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
-import json
-
-from data.semantic_search import verify_model, verify_embeddings, embed_text, embed_query_text, search_query
-from data.chunked_semantic_search import ChunkedSemantticSearch
+import time
+
+from data.client import request
+from data.definitions import (
+  ANN_NPROBE, EMBED_BATCH_SIZE, EMBEDDING_STORAGE, QUERY_BATCH_WAIT_MS, QUERY_PRECISIONS, RESCORE_CANDIDATES, SEMANTIC_MODEL, SERVER_SOCKET,
+  STORAGE_MODES
+)
+from data.movies import MovieStream
+from data.profiling import profiled
+from data.query_cache import persistent_cache
 from data.utils import get_chunks_from_str, get_semantic_chunks_from_str
 
+# NumPy and the model are imported by the commands that use them, so the
+# chunking commands and --help start without them
+
 def main():
   parser = argparse.ArgumentParser(description="Semantic Search CLI")
+  parser.add_argument("--local", action="store_true", help="Answer locally even if a query server is running")
+  parser.add_argument("--persist-cache", action="store_true", help="Keep search results in a cache file shared by later runs")
+  parser.add_argument("--profile", action="store_true", help="Print the time spent in each stage and the hot-path counters to stderr")
+  parser.add_argument("--profile-output", type=str, help="With --profile, also save a Chrome trace (.json) or a cProfile dump (any other name)")
   subparsers = parser.add_subparsers(dest="command", help="Available commands")
   subparsers.add_parser("verify", help="verify model")
   subparsers.add_parser("verify_embeddings", help="verify embeddings for movie documents")
@@ -20,6 +32,11 @@ def main():
   search_parser = subparsers.add_parser("search", help="Get embeddings for given text using default model")
   search_parser.add_argument("query", type=str, help="The search query")
   search_parser.add_argument("--limit", type=int, default=5, help="The maximum number of results")
+  search_parser.add_argument("--ann", action="store_true", help="Use the approximate (IVF) index instead of scanning every embedding")
+  search_parser.add_argument("--nprobe", type=int, default=ANN_NPROBE, help="Number of IVF lists scanned per query with --ann")
+  search_parser.add_argument("--storage", choices=STORAGE_MODES, default=None, help=f"Precision of the embeddings searched in memory (default: the server's, else {EMBEDDING_STORAGE})")
+  search_parser.add_argument("--rescore", type=int, default=None, help=f"Best approximate matches rescored in float32, 0 to skip (default: the server's, else {RESCORE_CANDIDATES})")
+  search_parser.add_argument("--sharded", action="store_true", help="Search the embeddings built with embed_shards, one process per shard")
 
   embed_query_text_parser = subparsers.add_parser("embedquery", help="Get embeddings for given text using default model")
   embed_query_text_parser.add_argument("query", type=str, help="Input text for embeddings retrieval")
@@ -34,47 +51,178 @@ def main():
   semantic_chunk_text_parser.add_argument("--max-chunk-size", type=int, default=200, help="The maximum number of words for each chunk")
   semantic_chunk_text_parser.add_argument("--overlap", type=int, default=0, help="Number of words that should overlap over two adjacent chunks")
 
-  subparsers.add_parser("embed_chunks", help="Split input text into chunks")
+  embed_parser = subparsers.add_parser("embed", help="Bring the movie embeddings up to date with data/movies.json")
+  embed_parser.add_argument("--rebuild", action="store_true", help="Rebuild the movie embeddings instead of updating them")
 
-  args = parser.parse_args()
+  update_parser = subparsers.add_parser("update", help="Add or replace movies in the movie and chunk embeddings, encoding only changed texts")
+  update_parser.add_argument("movies", type=str, help="JSON file like data/movies.json, or JSONL with one movie per line")
+  delete_parser = subparsers.add_parser("delete", help="Remove movies from the movie and chunk embeddings")
+  delete_parser.add_argument("doc_ids", type=int, nargs="+", help="Document ids")
 
-  match args.command:
-    case "verify":
-      verify_model()
-    
-    case "verify_embeddings":
-      verify_embeddings()
+  embed_chunks_parser = subparsers.add_parser("embed_chunks", help="Split input text into chunks")
+  embed_chunks_parser.add_argument("--rebuild", action="store_true", help="Rebuild the chunk embeddings instead of updating them")
+  embed_chunks_parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Chunks per model call and per store checkpoint")
+  embed_chunks_parser.add_argument("--workers", type=int, default=1, help="Number of encoding processes")
 
-    case "embed_text":
-      embed_text(args.text)
+  embed_shards_parser = subparsers.add_parser("embed_shards", help="Embed the movies of every shard built with keyword_search_cli.py build --shards")
+  embed_shards_parser.add_argument("--storage", choices=STORAGE_MODES, default=EMBEDDING_STORAGE, help="Precision of the embeddings searched in memory")
 
-    case "search":
-      search_query(args.query, args.limit)
+  search_chunked_parser = subparsers.add_parser("search_chunked", help="Search movies by their best matching description chunk")
+  search_chunked_parser.add_argument("query", type=str, help="The search query")
+  search_chunked_parser.add_argument("--limit", type=int, default=5, help="The maximum number of results")
+  search_chunked_parser.add_argument("--ann", action="store_true", help="Use the approximate (IVF) index instead of scanning every chunk")
+  search_chunked_parser.add_argument("--nprobe", type=int, default=ANN_NPROBE, help="Number of IVF lists scanned per query with --ann")
+  search_chunked_parser.add_argument("--storage", choices=STORAGE_MODES, default=None, help=f"Precision of the chunks searched in memory (default: the server's, else {EMBEDDING_STORAGE})")
+  search_chunked_parser.add_argument("--rescore", type=int, default=None, help=f"Best approximate matches rescored in float32, 0 to skip (default: the server's, else {RESCORE_CANDIDATES})")
 
-    case "embedquery":
-      embed_query_text(args.query)
+  subparsers.add_parser("cache_stats", help="Show the size and hit rate of the embedding store and query caches")
 
-    case "chunk":
-      chunks = get_chunks_from_str(args.text, args.chunk_size, args.overlap)
-      print(f"Chunking {len(args.text)} characters")
-      for i, chunk in enumerate(chunks):
-        print(f"{i + 1}. {chunk}")
+  serve_parser = subparsers.add_parser("serve", help="Keep the indexes and the model loaded and answer queries from both CLIs")
+  serve_parser.add_argument("--socket", type=str, default=SERVER_SOCKET, help="Unix socket to listen on")
+  serve_parser.add_argument("--ann", action="store_true", help="Also load the IVF indexes so clients can use --ann")
+  serve_parser.add_argument("--storage", choices=STORAGE_MODES, default=EMBEDDING_STORAGE, help="Precision of the embeddings kept in memory")
+  serve_parser.add_argument("--query-precision", choices=QUERY_PRECISIONS, default=None, help="Encode concurrent queries in batches, with the model at this precision")
+  serve_parser.add_argument("--query-wait-ms", type=float, default=QUERY_BATCH_WAIT_MS, help="How long a batch waits for more queries with --query-precision")
 
-    case "semantic_chunk":
-      chunks = get_semantic_chunks_from_str(args.text, args.max_chunk_size, args.overlap)
-      print(f"Semantically chunking {len(args.text)} characters")
-      for i, chunk in enumerate(chunks):
-        print(f"{i + 1}. {chunk}")
+  args = parser.parse_args()
 
-    case "embed_chunks":
-      with open(os.path.join("data", "movies.json")) as f:
-        movies = json.load(f)
+  with profiled(args.profile, args.profile_output):
+    match args.command:
+      case "verify":
+        from data.semantic_search import verify_model
+        verify_model()
+    
+      case "verify_embeddings":
+        from data.semantic_search import verify_embeddings
+        verify_embeddings()
+
+      case "embed_text":
+        from data.semantic_search import embed_text
+        embed_text(args.text)
+
+      case "search":
+        from data.semantic_search import search_query, print_search_results
+        results = None if args.local or args.sharded else request(
+          "search", query=args.query, limit=args.limit, ann=args.ann, nprobe=args.nprobe, storage=args.storage, rescore=args.rescore
+        )
+        # settings left out follow the server, or else the defaults
+        storage = args.storage or EMBEDDING_STORAGE
+        rescore = RESCORE_CANDIDATES if args.rescore is None else args.rescore
+        if results is None and args.sharded:
+          from data.sharding import ShardedSearch
+          sharded = ShardedSearch("semantic", storage=storage, rescore=rescore)
+          try:
+            print_search_results(sharded.search(args.query, args.limit))
+          finally:
+            sharded.close()
+        elif results is None:
+          search_query(args.query, args.limit, args.ann, args.nprobe, args.persist_cache, storage, rescore)
+        else:
+          print_search_results(results)
+
+      case "embedquery":
+        from data.semantic_search import embed_query_text
+        embed_query_text(args.query)
+
+      case "chunk":
+        chunks = get_chunks_from_str(args.text, args.chunk_size, args.overlap)
+        print(f"Chunking {len(args.text)} characters")
+        for i, chunk in enumerate(chunks):
+          print(f"{i + 1}. {chunk}")
+
+      case "semantic_chunk":
+        chunks = get_semantic_chunks_from_str(args.text, args.max_chunk_size, args.overlap)
+        print(f"Semantically chunking {len(args.text)} characters")
+        for i, chunk in enumerate(chunks):
+          print(f"{i + 1}. {chunk}")
+
+      case "embed":
+        from data.semantic_search import SemanticSearch
+        semantic = SemanticSearch()
+        if args.rebuild:
+          embeddings = semantic.build_embeddings(MovieStream())
+        else:
+          embeddings = semantic.load_or_create_embeddings(MovieStream())
+        print(f"Embedded {len(embeddings)} movies, encoding {semantic.store.misses} new texts")
+
+      case "update":
+        from data.chunked_semantic_search import ChunkedSemantticSearch
+        semantic = ChunkedSemantticSearch()
+        semantic.load_embeddings_to_update(MovieStream())
+        updated = semantic.upsert_documents(MovieStream(args.movies))
+        print(f"Updated {len(updated)} movies, encoding {semantic.store.misses} new texts")
+
+      case "delete":
+        from data.chunked_semantic_search import ChunkedSemantticSearch
+        semantic = ChunkedSemantticSearch()
+        semantic.load_embeddings_to_update(MovieStream())
+        deleted = semantic.delete_documents(args.doc_ids)
+        print(f"Deleted {len(deleted)} documents")
+
+      case "embed_chunks":
+        from data.chunked_semantic_search import ChunkedSemantticSearch
         chunked_semantic = ChunkedSemantticSearch()
-        embeddings = chunked_semantic.load_or_create_chunk_embeddings(movies["movies"])
+        chunked_semantic.encode_batch_size = args.batch_size
+        chunked_semantic.start_encode_pool(args.workers)
+        start = time.perf_counter()
+        try:
+          if args.rebuild:
+            embeddings = chunked_semantic.build_chunk_embeddings(MovieStream())
+          else:
+            embeddings = chunked_semantic.load_or_create_chunk_embeddings(MovieStream())
+        finally:
+          chunked_semantic.stop_encode_pool()
+        elapsed = time.perf_counter() - start
+
+        encoded = chunked_semantic.store.misses
         print(f"Generated {len(embeddings)} chunked embeddings")
+        print(f"Encoded {encoded} new texts in {elapsed:.1f} s ({encoded / elapsed:.0f} texts/s, {len(embeddings) / elapsed:.0f} chunks/s)")
+
+      case "embed_shards":
+        from data.sharding import build_semantic_shards
+        sizes = build_semantic_shards(MovieStream(), storage=args.storage)
+        print(f"Embedded {len(sizes)} shards of {min(sizes)} to {max(sizes)} movies")
+
+      case "search_chunked":
+        results = None if args.local else request(
+          "search_chunked", query=args.query, limit=args.limit, ann=args.ann, nprobe=args.nprobe, storage=args.storage, rescore=args.rescore
+        )
+        if results is None:
+          from data.chunked_semantic_search import ChunkedSemantticSearch
+          chunked_semantic = ChunkedSemantticSearch(
+            storage=args.storage or EMBEDDING_STORAGE, rescore=RESCORE_CANDIDATES if args.rescore is None else args.rescore
+          )
+          if args.persist_cache:
+            chunked_semantic.result_cache = persistent_cache("semantic")
+          chunked_semantic.load_chunk_embeddings(MovieStream())
+          if args.ann:
+            chunked_semantic.load_or_create_chunk_ann_index(args.nprobe)
+          results = chunked_semantic.search_chunks(args.query, args.limit)
+          chunked_semantic.result_cache.save()
+
+        for i, result in enumerate(results):
+          print(f"{i + 1}. {result["title"]} (score: {result["score"]:.4f})\n\t{result["chunk"]}\n")
+
+      case "cache_stats":
+        from data.embedding_store import EmbeddingStore
+        stats = EmbeddingStore(SEMANTIC_MODEL).stats()
+        lookups = stats["total_hits"] + stats["total_misses"]
+        print(f"Embedding store: {stats["entries"]} of {stats["max_entries"]} entries ({stats["bytes"] / 2**20:.1f} MiB), "
+              f"{stats["total_hits"]} hits in {lookups} lookups ({stats["total_hits"] / max(lookups, 1):.1%})")
+
+        caches = None if args.local else request("cache_stats")
+        if caches is None:
+          caches = {f"{name} cache file": persistent_cache(name).stats() for name in ("bm25", "semantic")}
+        for name, stats in caches.items():
+          print(f"{name.capitalize()}: {stats["entries"]} entries, {stats["hits"]} hits, {stats["misses"]} misses ({stats["hit_rate"]:.1%})")
+
+      case "serve":
+        from data.server import serve
+        serve(args.socket, args.ann, args.storage, args.query_precision, args.query_wait_ms)
+
+      case _:
+          parser.print_help()
 
-    case _:
-        parser.print_help()
 
 if __name__ == "__main__":
   main()
\ No newline at end of file
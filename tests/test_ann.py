@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from data import ann
+from data.ann import IVFIndex, load_or_train_ivf
+from data.vectors import cosine_top_k, normalize_rows
+
+@pytest.fixture
+def normalized():
+  return normalize_rows(np.random.default_rng(0).standard_normal((2000, 16)))
+
+def test_lists_hold_every_row_once(normalized, monkeypatch):
+  monkeypatch.setattr(ann, "ASSIGN_BATCH_SIZE", 300)
+  index = IVFIndex.train(normalized, nlist=20)
+  assert len(index.centroids) == 20 and index.list_offsets[-1] == len(normalized)
+  assert sorted(index.list_rows.tolist()) == list(range(len(normalized)))
+  # every row is in the list of its closest centroid
+  lists = np.repeat(np.arange(20), np.diff(index.list_offsets))
+  closest = np.argmax(normalized[index.list_rows] @ index.centroids.T, axis=1)
+  np.testing.assert_array_equal(lists, closest)
+
+def test_search_approximates_the_exact_top_k(normalized):
+  index = IVFIndex.train(normalized, nlist=20)
+  queries = np.random.default_rng(1).standard_normal((20, 16))
+  found = 0
+  for query in queries:
+    expected_rows, expected_scores = cosine_top_k(normalized, query, 10)
+    # probing every list is an exact search
+    rows, scores = index.search(normalized, query, 10, nprobe=20)
+    np.testing.assert_array_equal(rows, expected_rows)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+    rows, _ = index.search(normalized, query, 10, nprobe=5)
+    found += len(set(rows.tolist()) & set(expected_rows.tolist()))
+  assert found / 200 >= 0.8
+
+def test_small_inputs():
+  assert IVFIndex.train(normalize_rows(np.ones((1, 4)))).count == 1
+  with pytest.raises(ValueError, match="without vectors"):
+    IVFIndex.train(np.empty((0, 4), dtype=np.float32))
+
+def test_load_or_train_reuses_the_saved_index(tmp_path, normalized, monkeypatch):
+  path = str(tmp_path / "vectors.ivf.npz")
+  index = load_or_train_ivf(path, normalized, nprobe=3, fingerprint="v1")
+  train = IVFIndex.train
+  trained = []
+  monkeypatch.setattr(IVFIndex, "train", lambda *args: trained.append(args) or train(*args))
+
+  loaded = load_or_train_ivf(path, normalized, nprobe=7, fingerprint="v1")
+  assert trained == [] and loaded.nprobe == 7
+  np.testing.assert_array_equal(loaded.list_rows, index.list_rows)
+  np.testing.assert_array_equal(loaded.centroids, index.centroids)
+
+  # other vectors are indexed again
+  load_or_train_ivf(path, normalized, fingerprint="v2")
+  assert load_or_train_ivf(path, normalized[:1000], fingerprint="v2").count == 1000
+  assert len(trained) == 2
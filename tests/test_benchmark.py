@@ -0,0 +1,38 @@
+import pytest
+
+from bench_cli import compare_to_baseline
+from data.benchmark import latency_percentiles, synthetic_embeddings, synthetic_movies, synthetic_queries, top_k_overlap
+
+def test_synthetic_data_is_deterministic():
+  movies = synthetic_movies(20, seed=3)
+  assert movies == synthetic_movies(20, seed=3) != synthetic_movies(20, seed=4)
+  assert [movie["id"] for movie in movies] == list(range(1, 21))
+  queries = synthetic_queries(movies, 10, seed=1)
+  assert queries == synthetic_queries(movies, 10, seed=1)
+  descriptions = " ".join(movie["description"].rstrip(".") for movie in movies)
+  assert all(query in descriptions for query in queries)
+  assert (synthetic_embeddings(50, 8, seed=2) == synthetic_embeddings(50, 8, seed=2)).all()
+
+def test_top_k_overlap():
+  assert top_k_overlap([[1, 2, 3], [4, 5]], [[3, 2, 1], [4, 6]]) == pytest.approx(0.75)
+  # an empty reference only matches empty results
+  assert top_k_overlap([[], [1]], [[], []]) == pytest.approx(0.5)
+  assert top_k_overlap([], []) == 1.0
+
+def test_latency_percentiles():
+  assert latency_percentiles([]) == {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+  percentiles = latency_percentiles([i / 1000 for i in range(1, 101)])
+  assert percentiles["p50_ms"] == pytest.approx(50.5)
+  assert percentiles["p99_ms"] == pytest.approx(99.01)
+
+def test_compare_to_baseline_flags_costs_and_overlap_drops():
+  baseline = {"config": {"movies": 10}, "retrievers": {
+    "keyword": {"p50_ms": 10.0, "index_mb": 4.0, "top_k_overlap": 1.0},
+    "semantic": {"p50_ms": 10.0, "top_k_overlap": 0.9},
+  }}
+  report = {"config": {"movies": 10}, "retrievers": {
+    "keyword": {"p50_ms": 10.9, "index_mb": 5.0, "top_k_overlap": 1.0},
+    "semantic": {"p50_ms": 2.0, "top_k_overlap": 0.8},
+    "chunked": {"p50_ms": 99.0},
+  }}
+  assert compare_to_baseline(report, baseline, 0.1) == [("keyword", "index_mb"), ("semantic", "top_k_overlap")]
@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import pytest
+
+from data.bm25 import BM25Scorer, bm25_idf, posting_blocks
+from data.definitions import BM25_K1, BM25_B
+
+def random_corpus(seed, doc_count=600, term_count=12):
+  """Postings of terms from very common to rare over `doc_count` documents."""
+  rng = np.random.default_rng(seed)
+  doc_ids = np.sort(rng.choice(10 * doc_count, doc_count, replace=False)).astype(np.int64)
+  doc_lengths = rng.integers(1, 60, doc_count)
+  postings, idf = {}, {}
+  for i in range(term_count):
+    rows = np.flatnonzero(rng.random(doc_count) < 0.8 / (i + 1)).astype(np.int32)
+    postings[f"t{i}"] = rows, rng.integers(1, 6, len(rows)).astype(np.int32)
+    idf[f"t{i}"] = bm25_idf(doc_count, len(rows))
+  return doc_ids, doc_lengths, postings, idf
+
+def naive_scores(doc_ids, doc_lengths, postings, idf, tokens):
+  # the BM25 formula one document at a time, as `InvertedIndex.bm25` does
+  avg = doc_lengths.sum() / len(doc_lengths)
+  scores = {}
+  for token in tokens:
+    if token not in postings:
+      continue
+    for row, tf in zip(*(array.tolist() for array in postings[token])):
+      norm = BM25_K1 * (1 - BM25_B + BM25_B * (doc_lengths[row] / avg))
+      scores[row] = scores.get(row, 0.0) + tf * (BM25_K1 + 1) / (tf + norm) * idf[token]
+  return scores
+
+QUERIES = [["t0"], ["t0", "t1"], ["t11", "t0", "t5"], ["t3", "t3", "t7"], ["t2", "missing", "t9"], [f"t{i}" for i in range(12)]]
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("tokens", QUERIES)
+def test_score_matches_naive(seed, tokens):
+  corpus = random_corpus(seed)
+  scorer = BM25Scorer(*corpus)
+  expected = naive_scores(*corpus, tokens)
+  ranked = sorted(expected, key=lambda row: (-expected[row], row))[:10]
+
+  rows, scores = scorer.score(tokens, 10)
+  assert rows.tolist() == ranked
+  np.testing.assert_allclose(scores, [expected[row] for row in ranked], rtol=1e-12)
+
+def test_bm25_idf():
+  assert bm25_idf(10, 10) == pytest.approx(math.log(1 + 0.5 / 10.5))
+  assert bm25_idf(10, 1) > bm25_idf(10, 2) > 0
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("tokens", QUERIES)
+@pytest.mark.parametrize("block_size", [None, 1, 4])
+@pytest.mark.parametrize("window", [7, 64, 4096])
+def test_score_pruned_matches_score(seed, tokens, block_size, window):
+  doc_ids, doc_lengths, postings, idf = random_corpus(seed)
+  blocks = None
+  if block_size is not None:
+    blocks = {term: posting_blocks(rows, tfs, doc_lengths, block_size) for term, (rows, tfs) in postings.items()}
+  scorer = BM25Scorer(doc_ids, doc_lengths, postings, idf, blocks=blocks)
+  for limit in (1, 5, 50, 1000):
+    rows, scores = scorer.score(tokens, limit)
+    pruned_rows, pruned_scores, _ = scorer.score_pruned(tokens, limit, window)
+    assert pruned_rows.tolist() == rows.tolist()
+    assert pruned_scores.tolist() == scores.tolist()
+
+def test_score_pruned_skips_documents():
+  doc_ids, doc_lengths, postings, idf = random_corpus(0)
+  blocks = {term: posting_blocks(rows, tfs, doc_lengths, 4) for term, (rows, tfs) in postings.items()}
+  scorer = BM25Scorer(doc_ids, doc_lengths, postings, idf, blocks=blocks)
+  tokens = ["t0", "t1", "t11"]
+  matched = len(np.unique(np.concatenate([postings[token][0] for token in tokens])))
+  _, _, scored = scorer.score_pruned(tokens, 3, 16)
+  assert scored < matched
+
+def test_score_pruned_without_matches():
+  scorer = BM25Scorer(*random_corpus(0))
+  rows, scores, scored = scorer.score_pruned(["missing"], 5)
+  assert len(rows) == len(scores) == scored == 0
+
+def test_posting_blocks_bound_their_postings():
+  rows = np.array([0, 2, 3, 7, 8, 11, 12], dtype=np.int32)
+  tfs = np.array([1, 4, 2, 2, 5, 1, 3], dtype=np.int32)
+  doc_lengths = np.arange(20, 0, -1)
+  last_rows, max_tfs, min_lengths = posting_blocks(rows, tfs, doc_lengths, 3)
+  assert last_rows.tolist() == [3, 11, 12]
+  assert max_tfs.tolist() == [4, 5, 3]
+  assert min_lengths.tolist() == [17, 9, 8]
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from data import document_store
+from data.document_store import DocumentFields, DocumentStore, field_sections, write_document_store
+
+DOCUMENTS = [
+  {"id": 5, "title": "Five", "description": "first"},
+  {"id": 2, "title": "Two", "description": "written twice"},
+  {"id": 9, "title": "", "description": ""},
+  {"id": 2, "title": "Two again", "description": "the last write wins"},
+  {"id": -1, "title": "Négatif ☃", "description": "multi-byte \U0001f3ac text"},
+  {"id": 7, "title": "Seven", "description": "x" * 300, "rating": 5},
+]
+
+def expected_documents(documents):
+  # the last row of every id, in the order those rows were written
+  latest = {}
+  for doc in documents:
+    latest.pop(doc["id"], None)
+    latest[doc["id"]] = {"id": doc["id"], "title": doc["title"], "description": doc["description"]}
+  return latest
+
+@pytest.fixture(params=[1, 2, 1024])
+def store(request, tmp_path, monkeypatch):
+  # small batches split the documents across several writes
+  monkeypatch.setattr(document_store, "WRITE_BATCH_SIZE", request.param)
+  path = str(tmp_path / "documents.bin")
+  assert write_document_store(path, iter(DOCUMENTS)) == len(expected_documents(DOCUMENTS))
+  return DocumentStore(path)
+
+def test_store_keeps_last_row_of_each_id(store):
+  expected = expected_documents(DOCUMENTS)
+  assert len(store) == len(expected)
+  assert list(store) == list(expected.values())
+  assert store.row_ids.tolist() == [doc["id"] for doc in DOCUMENTS]
+  for doc_id, doc in expected.items():
+    assert store.document(int(store.rows([doc_id])[0])) == doc
+
+def test_store_keeps_last_row_of_many_duplicates(tmp_path):
+  documents = [{"id": i % 7, "title": f"t{i}", "description": f"d{i}"} for i in range(200)]
+  path = str(tmp_path / "documents.bin")
+  assert write_document_store(path, documents) == 7
+  assert list(DocumentStore(path)) == list(expected_documents(documents).values())
+
+def test_store_rows_reject_missing_ids(store):
+  assert store.rows([]).tolist() == []
+  with pytest.raises(KeyError):
+    store.rows([5, 3])
+
+def test_view_positions_match_list_index(store):
+  expected = list(expected_documents(DOCUMENTS).values())
+  view = store.view()
+  ids = [doc["id"] for doc in expected]
+  assert list(view) == expected
+  assert view.ids().tolist() == ids
+  assert view.positions([7, -1, 5, 7]).tolist() == [ids.index(7), ids.index(-1), ids.index(5), ids.index(7)]
+  assert list(view[1:3]) == expected[1:3]
+
+  rows = store.rows([9, 5])
+  subset = store.view(rows)
+  assert [doc["id"] for doc in subset] == [9, 5]
+  assert subset.positions([5, 9]).tolist() == [1, 0]
+  with pytest.raises(KeyError):
+    subset.positions([2])
+
+def test_empty_store(tmp_path):
+  path = str(tmp_path / "documents.bin")
+  assert write_document_store(path, []) == 0
+  store = DocumentStore(path)
+  assert len(store) == 0 and list(store) == []
+
+def test_store_rejects_other_files(tmp_path):
+  path = tmp_path / "documents.bin"
+  path.write_bytes(b"\0" * 64)
+  with pytest.raises(IOError):
+    DocumentStore(str(path))
+
+def test_field_sections_round_trip():
+  sections = field_sections(DOCUMENTS)
+  # lay the sections out back to back, at arbitrary offsets
+  buffer, table = b"", {}
+  for name, section in sections.items():
+    buffer += b"\0" * (-len(buffer) % 8)
+    table[name] = (len(buffer), len(section))
+    buffer += section
+  fields = DocumentFields(buffer, table)
+  for row, doc in enumerate(DOCUMENTS):
+    assert fields.document(doc["id"], row) == {"id": doc["id"], "title": doc["title"], "description": doc["description"]}
+  assert np.diff(fields.offsets["description"]).tolist() == [len(doc["description"].encode()) for doc in DOCUMENTS]
@@ -0,0 +1,118 @@
+import os
+import zlib
+
+import numpy as np
+import pytest
+
+from data import embedding_table
+from data.embedding_table import EmbeddingTable, _append_rows
+
+def encode(texts):
+  # a fixed vector per text, so rows can be checked after any update
+  return np.array([np.random.default_rng(zlib.crc32(text.encode())).standard_normal(4) for text in texts], dtype=np.float32)
+
+def entries(documents):
+  return [(key, zlib.crc32(" ".join(texts).encode()), texts) for key, texts in documents.items()]
+
+def live_table(table):
+  """key -> its live rows, in part order."""
+  live = table.live_rows()
+  rows = {}
+  for key, part, row in sorted(zip(table.keys[live].tolist(), table.parts[live].tolist(), live.tolist())):
+    rows.setdefault(key, []).append(np.asarray(table.embeddings[row]))
+  return {key: np.stack(key_rows) for key, key_rows in rows.items()}
+
+def assert_table(table, documents):
+  rows = live_table(table)
+  assert sorted(rows) == sorted(documents)
+  for key, texts in documents.items():
+    np.testing.assert_array_equal(rows[key], encode(texts))
+
+DOCUMENTS = {1: ["one"], 2: ["two", "two again"], 3: ["three"], 4: ["four"], 5: ["five", "and", "more"]}
+
+@pytest.fixture
+def table(tmp_path, monkeypatch):
+  monkeypatch.setattr(embedding_table, "COMPACTION_RATIO", 10.0)
+  table = EmbeddingTable(str(tmp_path), "table")
+  assert table.build(lambda: entries(DOCUMENTS), encode, batch_size=2) == 8
+  return table
+
+def reload(table):
+  loaded = EmbeddingTable(os.path.dirname(table.path), os.path.basename(table.path))
+  assert loaded.load()
+  return loaded
+
+def test_upsert_appends_to_the_saved_file(table):
+  inode = os.stat(f"{table.path}.npy").st_ino
+  documents = {**DOCUMENTS, 2: ["two changed"], 6: ["six", "six more"]}
+  assert table.upsert(entries(documents), encode) == 3
+  table.save()
+  assert os.stat(f"{table.path}.npy").st_ino == inode
+  assert np.load(f"{table.path}.npy").shape == (11, 4)
+  assert_table(table, documents)
+  assert_table(reload(table), documents)
+
+  # and again, on top of the appended rows
+  documents[7] = ["seven"]
+  del documents[1]
+  loaded = reload(table)
+  loaded.sync(entries(documents), encode)
+  loaded.save()
+  assert os.stat(f"{table.path}.npy").st_ino == inode
+  assert_table(reload(table), documents)
+
+def test_rows_past_the_saved_columns_are_ignored(table):
+  # an update interrupted after appending its rows, before saving columns
+  assert _append_rows(f"{table.path}.npy", 8, encode(["lost", "rows"]))
+  loaded = reload(table)
+  assert len(loaded.embeddings) == 8
+  assert_table(loaded, DOCUMENTS)
+
+  documents = {**DOCUMENTS, 9: ["nine"]}
+  loaded.upsert(entries(documents), encode)
+  loaded.save()
+  assert np.load(f"{table.path}.npy").shape == (9, 4)
+  assert_table(reload(table), documents)
+
+def test_compaction_rewrites_the_live_rows(table, monkeypatch):
+  monkeypatch.setattr(embedding_table, "COMPACTION_RATIO", 0.1)
+  documents = {key: texts for key, texts in DOCUMENTS.items() if key != 5}
+  assert table.delete([5]) == 3
+  assert table.compact_if_needed()
+  table.save()
+  assert np.load(f"{table.path}.npy").shape == (5, 4)
+  assert_table(reload(table), documents)
+
+  # rows appended after a compaction go through memory until saved
+  loaded = reload(table)
+  documents[6] = ["six"]
+  loaded.upsert(entries(documents), encode)
+  assert not loaded.compact_if_needed()
+  loaded.save()
+  assert_table(reload(table), documents)
+
+def test_append_rows_in_place(tmp_path):
+  path = str(tmp_path / "rows.npy")
+  rows = encode(["a", "b", "c"])
+  np.save(path, rows)
+  before = np.load(path, mmap_mode="r")
+  assert _append_rows(path, 3, encode(["d", "e"]))
+  np.testing.assert_array_equal(np.load(path), encode(["a", "b", "c", "d", "e"]))
+  # a reader that mapped the file before keeps its rows
+  np.testing.assert_array_equal(before, rows)
+  # rows past `count` are overwritten
+  assert _append_rows(path, 2, encode(["x"]))
+  np.testing.assert_array_equal(np.load(path), encode(["a", "b", "x"]))
+
+@pytest.mark.parametrize("saved", [
+  np.zeros((3, 4), dtype=np.float64),
+  np.zeros((3, 5), dtype=np.float32),
+  np.zeros(12, dtype=np.float32),
+  np.asfortranarray(np.zeros((3, 4), dtype=np.float32)),
+])
+def test_append_rows_refuses_other_layouts(tmp_path, saved):
+  path = str(tmp_path / "rows.npy")
+  np.save(path, saved)
+  content = open(path, "rb").read()
+  assert not _append_rows(path, 3, encode(["d"]))
+  assert open(path, "rb").read() == content
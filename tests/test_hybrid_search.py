@@ -0,0 +1,119 @@
+import random
+import zlib
+
+import numpy as np
+import pytest
+
+from data.hybrid_search import HybridSearch, normalize_scores
+from data.inverted_index import InvertedIndex
+from data.semantic_search import SemanticSearch
+from data.utils import Tokenizer
+
+WORDS = ["space", "pirate", "robot", "love", "detective", "ocean", "dragon", "city", "night", "war", "music", "ghost"]
+QUERIES = ["space robot", "ghost at night", "detective", "ocean dragon war"]
+
+class FakeModel:
+  def encode(self, texts, show_progress_bar=False):
+    return np.array([np.random.default_rng(zlib.crc32(text.encode())).standard_normal(8) for text in texts], dtype=np.float32).reshape(-1, 8)
+
+def make_movies(count, seed=0, start=1):
+  rng = random.Random(seed)
+  return [
+    {"id": doc_id, "title": " ".join(rng.choices(WORDS, k=2)).title(), "description": " ".join(rng.choices(WORDS, k=8))}
+    for doc_id in range(start, start + count)
+  ]
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+
+def hybrid(indexed, embedded, cache_dir="cache"):
+  index = InvertedIndex(Tokenizer(), cache_dir)
+  index.build(indexed)
+  index.save()
+  index.load()
+  semantic = SemanticSearch(cache_dir=cache_dir)
+  semantic.model = FakeModel()
+  semantic.build_embeddings(embedded)
+  return HybridSearch(index, semantic)
+
+@pytest.fixture
+def search():
+  return hybrid(make_movies(50), make_movies(50))
+
+def rankings(search, query, candidates):
+  """The BM25 and semantic rankings of `query`, as ids with scores."""
+  bm25 = [(doc["id"], score) for doc, score in search.index.bm25_search(query, candidates)]
+  rows, scores = search.semantic.top_k_rows(search.semantic.generate_embedding(query), candidates)
+  semantic = [(search.semantic.documents[row]["id"], score) for row, score in zip(rows.tolist(), scores.tolist())]
+  return bm25, semantic
+
+def fused(rankings, contribution):
+  scores = {}
+  for ranking in rankings:
+    for rank, (doc_id, score) in enumerate(ranking, 1):
+      scores[doc_id] = scores.get(doc_id, 0.0) + contribution(ranking, rank)
+  return scores
+
+def assert_fused(results, expected, limit):
+  assert len(results) == min(limit, len(expected))
+  assert [result["score"] for result in results] == pytest.approx(sorted(expected.values(), reverse=True)[:limit])
+  for result in results:
+    assert result["score"] == pytest.approx(expected[result["id"]])
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_rrf_adds_reciprocal_ranks(search, query):
+  bm25, semantic = rankings(search, query, 20)
+  results, timings = search.search(query, 10, "rrf", k=60, candidates=20)
+  assert_fused(results, fused([bm25, semantic], lambda ranking, rank: 1 / (60 + rank)), 10)
+  assert set(timings) == {"bm25", "encode", "semantic", "fusion"}
+  for result in results:
+    if result["bm25_rank"] is not None:
+      assert bm25[result["bm25_rank"] - 1] == (result["id"], pytest.approx(result["bm25_score"]))
+    if result["semantic_rank"] is not None:
+      assert semantic[result["semantic_rank"] - 1] == (result["id"], pytest.approx(result["semantic_score"]))
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_weighted_adds_normalized_scores(search, query):
+  bm25, semantic = rankings(search, query, 20)
+  normalized = {id(ranking): normalize_scores([score for _, score in ranking]) for ranking in (bm25, semantic)}
+  weights = {id(bm25): 0.3, id(semantic): 0.7}
+  results, _ = search.search(query, 10, "weighted", alpha=0.3, candidates=20)
+  assert_fused(results, fused([bm25, semantic], lambda ranking, rank: weights[id(ranking)] * normalized[id(ranking)][rank - 1]), 10)
+
+def test_rerank_scores_only_the_bm25_candidates(search):
+  bm25, _ = rankings(search, "space robot", 20)
+  results, _ = search.search("space robot", 20, "rrf", candidates=20, rerank=True)
+  assert {result["id"] for result in results} == {doc_id for doc_id, _ in bm25}
+  embedding = search.semantic.generate_embedding("space robot")
+  for result in results:
+    row = search.semantic.documents.positions([result["id"]])
+    assert result["semantic_score"] == pytest.approx(float(search.semantic.score_rows(embedding, row)[0]))
+
+def test_rerank_skips_movies_without_embeddings():
+  # the keyword index was updated with movies the embeddings lack
+  movies = make_movies(30)
+  added = make_movies(5, seed=1, start=100)
+  for movie in added:
+    movie["description"] = "space robot " * 3
+  search = hybrid(movies + added, movies)
+  for method in ("rrf", "weighted"):
+    results, _ = search.search("space robot", 40, method, candidates=40, rerank=True)
+    by_id = {result["id"]: result for result in results}
+    for movie in added:
+      assert by_id[movie["id"]]["semantic_rank"] is None and by_id[movie["id"]]["bm25_rank"] is not None
+    assert all(result["semantic_rank"] is not None for result in results if result["id"] < 100)
+
+  # nothing embedded matches
+  only_added = hybrid(added, movies, "other")
+  results, _ = only_added.search("space robot", 10, candidates=10, rerank=True)
+  assert {result["id"] for result in results} == {movie["id"] for movie in added}
+
+def test_normalize_scores():
+  assert normalize_scores([]) == []
+  assert normalize_scores([2.0, 2.0]) == [1.0, 1.0]
+  assert normalize_scores([1.0, 3.0, 2.0]) == [0.0, 1.0, 0.5]
+
+def test_unknown_method(search):
+  with pytest.raises(ValueError):
+    search.search("space", 5, "max")
@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+
+from data.bm25 import bm25_idf, posting_blocks
+from data.index_format import (
+  DocLengths, DocumentMap, MappedIndex, MergedIndex, TermBlocks, TermFrequencies, TermIdf, TermPostings,
+  decode_varints, encode_varints, write_index,
+)
+
+def naive_varints(values) -> bytes:
+  out = bytearray()
+  for value in values:
+    while value >= 0x80:
+      out.append(value & 0x7F | 0x80)
+      value >>= 7
+    out.append(value)
+  return bytes(out)
+
+VALUES = [0, 1, 127, 128, 255, 300, 16383, 16384, 2**21 - 1, 2**21, 2**31 - 1, 2**35 + 7, 2**62, 2**63 - 1]
+
+def test_varints_match_naive_encoding():
+  assert encode_varints(np.array(VALUES)) == naive_varints(VALUES)
+  assert decode_varints(naive_varints(VALUES)).tolist() == VALUES
+
+@pytest.mark.parametrize("seed", range(10))
+def test_varints_round_trip(seed):
+  rng = np.random.default_rng(seed)
+  values = rng.integers(0, 2 ** rng.integers(1, 63), rng.integers(0, 200))
+  encoded = encode_varints(values)
+  assert encoded == naive_varints(values.tolist())
+  assert decode_varints(encoded).tolist() == values.tolist()
+
+def test_varints_empty():
+  assert encode_varints(np.array([], dtype=np.int64)) == b""
+  assert decode_varints(b"").tolist() == []
+
+def write_fixture(path, documents):
+  """Index `documents`, a doc id -> {term: tf} dict, the way
+  `InvertedIndex` lays out its rows: by ascending id."""
+  doc_ids = sorted(documents)
+  postings = {}
+  for row, doc_id in enumerate(doc_ids):
+    for term, tf in documents[doc_id].items():
+      postings.setdefault(term, ([], []))
+      postings[term][0].append(row)
+      postings[term][1].append(tf)
+  postings = {term: (np.array(rows), np.array(tfs)) for term, (rows, tfs) in postings.items()}
+  write_index(
+    path,
+    doc_ids,
+    [sum(documents[doc_id].values()) for doc_id in doc_ids],
+    doc_ids,
+    ({"title": f"title {doc_id}", "description": " ".join(documents[doc_id])} for doc_id in doc_ids),
+    postings,
+    {term: bm25_idf(len(doc_ids), len(rows)) for term, (rows, _) in postings.items()},
+  )
+  return MappedIndex(path)
+
+DOCUMENTS = {
+  1: {"alpha": 2, "beta": 1},
+  3: {"alpha": 1, "gamma": 4},
+  4: {"beta": 3, "gone": 1},
+  7: {"alpha": 1, "beta": 1, "gamma": 1, "été": 2},
+  9: {"delta": 2},
+  12: {"alpha": 5},
+}
+
+@pytest.fixture
+def index(tmp_path):
+  return write_fixture(str(tmp_path / "index.bin"), DOCUMENTS)
+
+def test_mapped_index_reads_back_postings(index):
+  doc_ids = sorted(DOCUMENTS)
+  terms = {term for terms in DOCUMENTS.values() for term in terms}
+  assert list(index.terms()) == sorted(terms, key=str.encode)
+  for term in terms:
+    rows, tfs = index.term_postings(term)
+    expected = [(row, DOCUMENTS[doc_id][term]) for row, doc_id in enumerate(doc_ids) if term in DOCUMENTS[doc_id]]
+    assert list(zip(rows.tolist(), tfs.tolist())) == expected
+    assert TermIdf(index)[term] == bm25_idf(len(doc_ids), len(expected))
+  assert index.term_postings("missing") is None and index.lookup("missing") is None
+  assert "alpha" in TermPostings(index) and "missing" not in TermPostings(index)
+  with pytest.raises(KeyError):
+    TermIdf(index)["missing"]
+
+def test_mapped_index_stores_blocks(index):
+  for term in index.terms():
+    rows, tfs = index.term_postings(term)
+    expected = posting_blocks(rows, tfs, index.doc_lengths)
+    assert [array.tolist() for array in TermBlocks(index)[term]] == [array.tolist() for array in expected]
+
+def test_mapped_index_reads_back_documents(index):
+  assert index.doc_ids.tolist() == sorted(DOCUMENTS)
+  assert dict(DocLengths(index)) == {doc_id: sum(terms.values()) for doc_id, terms in DOCUMENTS.items()}
+  assert DocumentMap(index)[7] == {"id": 7, "title": "title 7", "description": "alpha beta gamma été"}
+  assert TermFrequencies(index)[7].get("été") == 2 and TermFrequencies(index)[9].get("alpha") == 0
+  assert index.row(8) is None
+  with pytest.raises(KeyError):
+    DocumentMap(index)[8]
+
+BASE = {
+  1: {"alpha": 2, "beta": 1},
+  3: {"alpha": 1, "gamma": 4},
+  4: {"beta": 3, "gone": 1},
+  7: {"alpha": 1, "beta": 1, "gamma": 1},
+  9: {"delta": 2},
+  12: {"alpha": 5},
+}
+DELTA = {
+  3: {"beta": 2, "epsilon": 1},
+  5: {"alpha": 1, "epsilon": 3},
+  15: {"gamma": 2, "delta": 1},
+  20: {"beta": 1},
+}
+DELETED = [4, 9, 100]
+
+@pytest.fixture
+def indexes(tmp_path):
+  live = {doc_id: terms for doc_id, terms in BASE.items() if doc_id not in DELETED} | DELTA
+  merged = MergedIndex(
+    write_fixture(str(tmp_path / "base.bin"), BASE),
+    write_fixture(str(tmp_path / "delta.bin"), DELTA),
+    np.array(DELETED, dtype=np.int64),
+  )
+  return merged, write_fixture(str(tmp_path / "rebuilt.bin"), live)
+
+def test_merged_index_renumbers_rows(indexes):
+  merged, rebuilt = indexes
+  assert merged.doc_ids.tolist() == rebuilt.doc_ids.tolist()
+  assert merged.doc_lengths.tolist() == rebuilt.doc_lengths.tolist()
+  assert merged.doc_hashes.tolist() == rebuilt.doc_hashes.tolist()
+  for doc_id in (1, 3, 4, 5, 9, 15, 20, 100):
+    assert merged.row(doc_id) == rebuilt.row(doc_id)
+  for row in range(rebuilt.doc_count):
+    assert merged.document(row) == rebuilt.document(row)
+
+def test_merged_index_matches_rebuilt_postings(indexes):
+  merged, rebuilt = indexes
+  # "gone" was only in a deleted document
+  assert list(merged.terms()) == list(rebuilt.terms())
+  assert merged.term_postings("gone") is None
+  for term in [*rebuilt.terms(), "gone", "missing"]:
+    expected = rebuilt.term_postings(term)
+    postings = merged.term_postings(term)
+    if expected is None:
+      assert postings is None
+      continue
+    assert [array.tolist() for array in postings] == [array.tolist() for array in expected]
+
+def test_merged_index_recomputes_idf_and_blocks(indexes):
+  merged, rebuilt = indexes
+  for term in rebuilt.terms():
+    *_, idf, blocks = merged.lookup(term)
+    *_, expected_idf, expected_blocks = rebuilt.lookup(term)
+    assert idf == expected_idf
+    assert [array.tolist() for array in blocks] == [array.tolist() for array in expected_blocks]
+  assert merged.lookup("gone") is None
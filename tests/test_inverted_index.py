@@ -0,0 +1,147 @@
+import random
+
+import pytest
+
+from data import inverted_index
+from data.index_format import MappedIndex, MergedIndex
+from data.inverted_index import DELETED_FILE, DELTA_FILE, InvertedIndex
+from data.utils import Tokenizer
+
+WORDS = ["space", "pirate", "robot", "love", "detective", "ocean", "dragon", "city", "night", "war", "music", "ghost"]
+
+def make_movies(count, seed=0, start=1):
+  rng = random.Random(seed)
+  return [
+    {
+      "id": doc_id,
+      "title": " ".join(rng.choices(WORDS, k=rng.randint(1, 3))).title(),
+      "description": " ".join(rng.choices(WORDS[:rng.randint(2, len(WORDS))], k=rng.randint(3, 20))),
+    }
+    for doc_id in range(start, start + count)
+  ]
+
+def build_index(cache_dir, movies):
+  index = InvertedIndex(Tokenizer(), str(cache_dir))
+  index.build(movies)
+  index.save()
+  return index
+
+def load_index(cache_dir):
+  index = InvertedIndex(Tokenizer(), str(cache_dir))
+  index.load()
+  return index
+
+@pytest.fixture
+def movies():
+  return make_movies(60)
+
+def test_document_frequency_matches_documents(tmp_path, movies):
+  built = build_index(tmp_path, movies)
+  loaded = load_index(tmp_path)
+  for word in [*WORDS, "missing"]:
+    term = built.tokenizer.tokenize_word(word)
+    expected = sum(term in built.tokenizer.tokenize_str(f"{movie['title']} {movie['description']}") for movie in movies)
+    assert built.get_document_frequency(term) == loaded.get_document_frequency(term) == expected
+    assert loaded.get_bm25_idf(word) == built.get_bm25_idf(word)
+
+def test_idf_and_naive_search_do_not_read_documents(tmp_path, movies, monkeypatch):
+  build_index(tmp_path, movies)
+  index = load_index(tmp_path)
+  expected = index.bm25_search("space robot ghost", 3, mode="array")
+  reads = []
+  document = MappedIndex.document
+  monkeypatch.setattr(MappedIndex, "document", lambda mapped, row: reads.append(row) or document(mapped, row))
+
+  index.get_bm25_idf("robot")
+  assert reads == []
+  results = index.bm25_search("space robot ghost", 3, mode="naive")
+  assert len(reads) == 3
+  assert [doc["id"] for doc, _ in results] == [doc["id"] for doc, _ in expected]
+  assert [score for _, score in results] == pytest.approx([score for _, score in expected])
+
+QUERIES = ["space robot", "ghost ghost night", "detective", "ocean dragon war music", "submarine", "missing words"]
+
+def assert_same_results(index, expected):
+  """`index` answers every query like `expected`, an index built from scratch."""
+  assert sorted(index.docmap) == sorted(expected.docmap)
+  assert dict(index.doc_lengths) == dict(expected.doc_lengths)
+  for query in QUERIES:
+    for mode in ("array", "pruned"):
+      results = index.bm25_search(query, 10, mode)
+      reference = expected.bm25_search(query, 10, mode)
+      assert [doc for doc, _ in results] == [doc for doc, _ in reference]
+      assert [score for _, score in results] == pytest.approx([score for _, score in reference])
+    for mode in ("first", "and", "or"):
+      assert index.search(query, 10, mode) == expected.search(query, 10, mode)
+
+def edited(movies):
+  """`movies` with three movies changed, one gone and one new."""
+  movies = [dict(movie) for movie in movies if movie["id"] != 7]
+  movies[0]["description"] = "submarine submarine ghost"
+  movies[2].update(title="Night", description="night night ghost")
+  movies[9]["description"] = "music"
+  return movies + [{"id": 500, "title": "Submarine War", "description": "submarine robot space"}]
+
+@pytest.fixture
+def no_compaction(monkeypatch):
+  monkeypatch.setattr(inverted_index, "COMPACTION_RATIO", 10.0)
+
+def test_sync_matches_a_fresh_build(tmp_path, movies, no_compaction):
+  build_index(tmp_path / "base", movies)
+  index = load_index(tmp_path / "base")
+  changed, deleted = index.sync(edited(movies))
+  assert sorted(changed) == [1, 3, 11, 500] and deleted == [7]
+  assert isinstance(index.mapped, MergedIndex)
+  assert (tmp_path / "base" / DELTA_FILE).exists() and (tmp_path / "base" / DELETED_FILE).exists()
+
+  expected = build_index(tmp_path / "fresh", edited(movies))
+  assert_same_results(index, expected)
+  # the delta and tombstones written are read back by a new process
+  assert_same_results(load_index(tmp_path / "base"), expected)
+  assert index.sync(edited(movies)) == ([], [])
+
+def test_updates_on_top_of_a_delta(tmp_path, movies, no_compaction):
+  build_index(tmp_path / "base", movies)
+  index = load_index(tmp_path / "base")
+  index.upsert([edited(movies)[2], edited(movies)[-1]])
+  # a movie added in the delta, one updated in it and one of the base
+  assert index.delete([500, 3, 12, 12, 999]) == [500, 3, 12]
+  assert index.delete([500, 12]) == []
+  back = {"id": 12, "title": "Back", "description": "submarine detective"}
+  index.upsert([back])
+
+  final = [back if movie["id"] == 12 else movie for movie in movies if movie["id"] != 3]
+  expected = build_index(tmp_path / "fresh", final)
+  assert_same_results(index, expected)
+  assert_same_results(load_index(tmp_path / "base"), expected)
+
+def test_updates_compact_past_the_threshold(tmp_path, movies, monkeypatch):
+  monkeypatch.setattr(inverted_index, "COMPACTION_RATIO", 0.05)
+  build_index(tmp_path / "base", movies)
+  index = load_index(tmp_path / "base")
+  two = {"id": 2, "title": "Two", "description": "submarine"}
+  # 1 tombstone and 1 delta document stay under 5% of 60
+  index.upsert([two])
+  assert isinstance(index.mapped, MergedIndex)
+  final = [two if movie["id"] == 2 else movie for movie in edited(movies)]
+  index.sync(final)
+  assert not isinstance(index.mapped, MergedIndex)
+  assert not (tmp_path / "base" / DELTA_FILE).exists() and not (tmp_path / "base" / DELETED_FILE).exists()
+
+  expected = build_index(tmp_path / "fresh", final)
+  assert_same_results(index, expected)
+  assert_same_results(load_index(tmp_path / "base"), expected)
+
+def test_compact_folds_the_delta_into_the_base(tmp_path, movies, no_compaction):
+  build_index(tmp_path / "base", movies)
+  index = load_index(tmp_path / "base")
+  index.sync(edited(movies))
+  index.compact()
+  assert not isinstance(index.mapped, MergedIndex)
+  assert not (tmp_path / "base" / DELTA_FILE).exists()
+  assert_same_results(load_index(tmp_path / "base"), build_index(tmp_path / "fresh", edited(movies)))
+
+def test_update_needs_a_loaded_index(tmp_path, movies):
+  index = build_index(tmp_path, movies)
+  with pytest.raises(ValueError):
+    index.delete([1])
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from data.movies import MovieStream
+
+MOVIES = [
+  {"id": 1, "title": "Plain", "description": "A movie."},
+  {"id": 2, "title": "Quotes \"and\" braces {[", "description": "Escapes: \\ \n \t é ☃ \U0001f3ac"},
+  {"id": 30000000000, "title": "", "description": "", "rating": 7.25, "tags": ["a", {"b": [1, 2]}], "extra": None},
+  {"id": 4, "title": "Last", "description": "ends with a number", "year": 1999},
+]
+
+@pytest.fixture(params=[None, 2], ids=["compact", "indented"])
+def catalog(request, tmp_path):
+  path = tmp_path / "movies.json"
+  # numbers outside of the movies end reads of a few bytes mid-value
+  data = {"version": 12345, "movies": MOVIES, "count": 40960, "trailing": {"movies": []}}
+  path.write_text(json.dumps(data, indent=request.param, ensure_ascii=False), encoding="utf-8")
+  return str(path)
+
+@pytest.mark.parametrize("read_size", [1, 2, 7, 64, 1 << 20])
+def test_stream_matches_json_load(catalog, read_size):
+  with open(catalog, encoding="utf-8") as f:
+    expected = json.load(f)["movies"]
+  assert list(MovieStream(catalog, read_size)) == expected
+
+def test_stream_reads_again_on_every_iteration(catalog):
+  movies = MovieStream(catalog, 5)
+  assert list(movies) == list(movies) == MOVIES
+
+@pytest.mark.parametrize("text", ['{}', '{"movies": []}', ' { "other" : [1, 2] } ', '{"movies":[ ]}'])
+def test_stream_without_movies(tmp_path, text):
+  path = tmp_path / "movies.json"
+  path.write_text(text)
+  assert list(MovieStream(str(path), 1)) == []
+
+@pytest.mark.parametrize("text", ['{"movies": [{"id": 1}', '{"movies": [{"id": 1},', '["movies"]', '{"movies": [{"id": 1} {"id": 2}]}'])
+def test_stream_rejects_malformed(tmp_path, text):
+  path = tmp_path / "movies.json"
+  path.write_text(text)
+  with pytest.raises(ValueError):
+    list(MovieStream(str(path), 3))
+
+def test_stream_reads_jsonl(tmp_path):
+  path = tmp_path / "movies.jsonl"
+  path.write_text("\n".join(json.dumps(movie) for movie in MOVIES) + "\n\n", encoding="utf-8")
+  assert list(MovieStream(str(path))) == MOVIES
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from data import postings
+from data.postings import first_rows, intersect, union
+
+def random_postings(rng, count, doc_count):
+  return [np.unique(rng.integers(0, doc_count, rng.integers(0, doc_count))).astype(np.int32) for _ in range(count)]
+
+@pytest.fixture(params=[1, 4, 256])
+def window(request, monkeypatch):
+  # small windows make `intersect` gallop across many of them
+  monkeypatch.setattr(postings, "INTERSECT_WINDOW", request.param)
+  return request.param
+
+@pytest.mark.parametrize("seed", range(20))
+def test_intersect_matches_sets(seed, window):
+  rng = np.random.default_rng(seed)
+  lists = random_postings(rng, rng.integers(1, 5), 300)
+  expected = sorted(set.intersection(*(set(rows.tolist()) for rows in lists)))
+  for limit in (1, 3, 10, 1000):
+    assert intersect(lists, limit) == expected[:limit]
+
+@pytest.mark.parametrize("seed", range(20))
+def test_union_matches_sets(seed):
+  rng = np.random.default_rng(seed)
+  lists = random_postings(rng, rng.integers(1, 5), 300)
+  expected = sorted(set().union(*(rows.tolist() for rows in lists)))
+  for limit in (1, 3, 10, 1000):
+    assert union(lists, limit) == expected[:limit]
+
+@pytest.mark.parametrize("seed", range(20))
+def test_first_rows_matches_concatenation(seed):
+  rng = np.random.default_rng(seed)
+  lists = random_postings(rng, rng.integers(1, 5), 300)
+  expected = list(dict.fromkeys(row for rows in lists for row in rows.tolist()))
+  for limit in (1, 3, 10, 1000):
+    assert first_rows(lists, limit) == expected[:limit]
+
+def test_intersect_edges(window):
+  rows = np.array([1, 5, 9], dtype=np.int32)
+  assert intersect([], 5) == []
+  assert intersect([rows], 0) == []
+  assert intersect([rows, rows[:0]], 5) == []
+  assert intersect([rows, np.array([2, 6, 10], dtype=np.int32)], 5) == []
+  assert intersect([rows, np.arange(20, dtype=np.int32)], 5) == [1, 5, 9]
@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import pytest
+
+from data import quantization
+from data.quantization import POPCOUNT, QuantizedVectors, load_or_quantize
+from data.vectors import cosine_top_k, normalize_rows
+
+MODES = ["float32", "float16", "int8", "binary"]
+
+def clustered(count, seed=0, dimensions=64, topics=20):
+  """Rows around a few topic centers, as embeddings of related texts are."""
+  rng = np.random.default_rng(seed)
+  centers = np.random.default_rng(0).standard_normal((topics, dimensions))
+  return (centers[rng.integers(0, topics, count)] + 0.5 * rng.standard_normal((count, dimensions))).astype(np.float32)
+
+@pytest.fixture
+def embeddings():
+  return clustered(1000)
+
+@pytest.mark.parametrize("mode", MODES)
+def test_encode_round_trip(embeddings, mode):
+  vectors = QuantizedVectors.encode(embeddings, mode, batch_size=300)
+  normalized = normalize_rows(embeddings)
+  decoded = vectors[np.arange(len(embeddings))]
+  assert decoded.dtype == np.float32 and decoded.shape == embeddings.shape
+  match mode:
+    case "float32":
+      np.testing.assert_array_equal(decoded, normalized)
+    case "float16":
+      np.testing.assert_allclose(decoded, normalized, atol=1e-3)
+    case "int8":
+      assert np.all(np.abs(decoded - normalized) <= vectors.scale / 2 + 1e-6)
+    case "binary":
+      np.testing.assert_array_equal(decoded > 0, normalized > 0)
+      np.testing.assert_allclose(np.linalg.norm(decoded, axis=1), 1, rtol=1e-6)
+  # single rows decode like the matrix
+  np.testing.assert_array_equal(vectors[5], decoded[5])
+  # the batches only bound memory
+  np.testing.assert_array_equal(vectors.codes, QuantizedVectors.encode(embeddings, mode).codes)
+  assert vectors.nbytes <= normalized.nbytes
+
+@pytest.mark.parametrize("mode", MODES)
+def test_scores_match_decoded_rows(embeddings, mode, monkeypatch):
+  vectors = QuantizedVectors.encode(embeddings, mode)
+  query = clustered(1, seed=1)[0]
+  scores = vectors.scores(query)
+  if mode == "binary":
+    distances = np.array([POPCOUNT[code ^ np.packbits(query > 0)].sum() for code in vectors.codes])
+    expected = np.cos(np.pi * distances / embeddings.shape[1])
+  else:
+    expected = vectors[np.arange(len(embeddings))] @ normalize_rows(query)
+  np.testing.assert_allclose(scores, expected, atol=1e-5)
+
+  rows = np.array([3, 400, 17])
+  np.testing.assert_allclose(vectors.scores(query, rows), scores[rows], atol=1e-6)
+  monkeypatch.setattr(quantization, "SCORE_BATCH_SIZE", 64)
+  np.testing.assert_allclose(vectors.scores(query), scores, atol=1e-6)
+
+@pytest.mark.parametrize("mode", ["int8", "binary"])
+def test_rescore_recovers_the_exact_top_k(embeddings, mode):
+  vectors = QuantizedVectors.encode(embeddings, mode)
+  normalized = normalize_rows(embeddings)
+  for query in clustered(30, seed=2):
+    expected_rows, expected_scores = cosine_top_k(normalized, query, 10)
+    candidates, _ = vectors.top_k(query, 200)
+    rows, scores = vectors.rescore(query, candidates, 10)
+    np.testing.assert_array_equal(rows, expected_rows)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+
+def test_int8_alone_keeps_most_of_the_top_k(embeddings):
+  vectors = QuantizedVectors.encode(embeddings, "int8")
+  normalized = normalize_rows(embeddings)
+  found = 0
+  for query in clustered(30, seed=2):
+    expected, _ = cosine_top_k(normalized, query, 10)
+    rows, _ = vectors.top_k(query, 10)
+    found += len(set(rows.tolist()) & set(expected.tolist()))
+  assert found / 300 >= 0.9
+
+def test_rescore_needs_the_originals(embeddings):
+  vectors = QuantizedVectors.encode(embeddings, "int8")
+  vectors.originals = None
+  with pytest.raises(ValueError):
+    vectors.rescore(embeddings[0], np.arange(10), 5)
+
+@pytest.mark.parametrize("mode", MODES)
+def test_encode_empty(mode):
+  vectors = QuantizedVectors.encode(np.empty((0, 16), dtype=np.float32), mode)
+  assert len(vectors) == 0
+  assert vectors.scores(np.ones(16, dtype=np.float32)).shape == (0,)
+
+@pytest.mark.parametrize("mode", ["float16", "int8", "binary"])
+def test_load_or_quantize_reuses_the_saved_codes(tmp_path, embeddings, mode, monkeypatch):
+  path = str(tmp_path / f"vectors.{mode}.npz")
+  vectors = load_or_quantize(path, embeddings, mode, "v1")
+  assert os.path.exists(path)
+
+  encode = QuantizedVectors.encode
+  encoded = []
+  monkeypatch.setattr(QuantizedVectors, "encode", lambda *args: encoded.append(args) or encode(*args))
+  loaded = load_or_quantize(path, embeddings, mode, "v1")
+  assert encoded == []
+  np.testing.assert_array_equal(loaded.codes, vectors.codes)
+  assert loaded.originals is embeddings and loaded.dimensions == vectors.dimensions
+  np.testing.assert_array_equal(loaded.scores(embeddings[0]), vectors.scores(embeddings[0]))
+
+  # other rows, another count or a damaged file are quantized again
+  changed = clustered(1000, seed=3)
+  np.testing.assert_array_equal(load_or_quantize(path, changed, mode, "v2").codes, encode(changed, mode).codes)
+  load_or_quantize(path, changed[:500], mode, "v2")
+  with open(path, "wb") as f:
+    f.write(b"damaged")
+  assert len(load_or_quantize(path, changed, mode, "v2")) == 1000
+  assert len(encoded) == 3
+
+def test_float32_is_never_saved(tmp_path, embeddings):
+  path = str(tmp_path / "vectors.float32.npz")
+  vectors = load_or_quantize(path, embeddings, "float32", "v1")
+  assert vectors.exact and not os.path.exists(path)
+
+def test_unknown_mode():
+  with pytest.raises(ValueError):
+    QuantizedVectors.encode(np.ones((2, 4), dtype=np.float32), "int4")
@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+from data import query_cache
+from data.inverted_index import InvertedIndex
+from data.query_cache import QueryCache, persistent_cache
+from data.utils import Tokenizer
+
+@pytest.fixture
+def clock(monkeypatch):
+  """The time seen by the cache, set by the test."""
+  now = [1000.0]
+  monkeypatch.setattr(query_cache.time, "time", lambda: now[0])
+  return now
+
+def test_least_recently_used_entries_are_evicted():
+  cache = QueryCache(max_entries=2)
+  cache.put("a", 1, "A")
+  cache.put("b", 1, "B")
+  assert cache.get("a", 1) == "A"
+  cache.put("c", 1, "C")
+  assert cache.get("b", 1) is None
+  assert (cache.get("a", 1), cache.get("c", 1)) == ("A", "C")
+  # writing an entry again makes it the most recent
+  cache.put("a", 1, "A2")
+  cache.put("d", 1, "D")
+  assert list(cache.entries) == ["a", "d"]
+  assert cache.stats() == {"entries": 2, "hits": 3, "misses": 1, "hit_rate": 0.75}
+
+def test_entries_expire_after_ttl(clock):
+  cache = QueryCache(ttl=10)
+  cache.put("a", 1, "A")
+  clock[0] += 10
+  assert cache.get("a", 1) == "A"
+  clock[0] += 0.5
+  assert cache.get("a", 1) is None
+  assert "a" not in cache.entries
+
+def test_another_version_is_a_miss():
+  cache = QueryCache()
+  computed = []
+  compute = lambda: computed.append(1) or len(computed)
+  assert cache.cached("a", "v1", compute) == 1
+  assert cache.cached("a", "v1", compute) == 1
+  assert cache.cached("a", "v2", compute) == 2
+  # an unversioned source is never cached
+  assert cache.cached("a", None, compute) == 3
+  assert cache.cached("a", None, compute) == 4
+  assert cache.get("a", "v2") == 2
+  # a lookup with an older version drops the entry
+  assert cache.get("a", "v1") is None
+  assert "a" not in cache.entries
+
+def test_saved_cache_is_reloaded(tmp_path, monkeypatch, clock):
+  monkeypatch.chdir(tmp_path)
+  cache = persistent_cache("test")
+  cache.put("fresh", 1, ["result"])
+  cache.put("old", 1, ["expired"])
+  cache.entries["old"] = (1, clock[0] - 1, ["expired"])
+  assert cache.get("fresh", 1) == ["result"]
+  cache.save()
+  assert os.path.exists(os.path.join("cache", "test_queries.pkl"))
+
+  loaded = persistent_cache("test")
+  assert list(loaded.entries) == ["fresh"]
+  assert loaded.get("fresh", 1) == ["result"]
+  assert (loaded.hits, loaded.misses) == (2, 0)
+  # expiry survives the reload
+  clock[0] += query_cache.QUERY_CACHE_TTL + 1
+  assert loaded.get("fresh", 1) is None
+
+def test_corrupt_cache_file_is_a_cold_start(tmp_path):
+  path = tmp_path / "queries.pkl"
+  path.write_bytes(b"not a pickle")
+  cache = QueryCache(path=str(path))
+  cache.load()
+  assert len(cache.entries) == 0
+  # a cache without a path is never written
+  QueryCache().save()
+
+MOVIES = [
+  {"id": 1, "title": "Space Robot", "description": "A robot lost in space."},
+  {"id": 2, "title": "Ghost Town", "description": "A ghost haunts the town."},
+  {"id": 3, "title": "Ocean", "description": "Pirates on the ocean."},
+]
+
+def searched(query):
+  """Results of `query` from the index saved in cache/, through the saved
+  result cache, as a process answering a single query gets them."""
+  index = InvertedIndex(Tokenizer())
+  index.load()
+  index.result_cache = persistent_cache("bm25")
+  results = [(doc["id"], score) for doc, score in index.bm25_search(query, 5)]
+  index.result_cache.save()
+  return results, index.result_cache.hits
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_saved_results_are_not_served_after_an_update(tmp_path, monkeypatch, compact):
+  monkeypatch.chdir(tmp_path)
+  index = InvertedIndex(Tokenizer())
+  index.build(MOVIES)
+  index.save()
+  before, _ = searched("robot")
+  assert searched("robot") == (before, 1)
+  assert [doc_id for doc_id, _ in before] == [1]
+
+  index = InvertedIndex(Tokenizer())
+  index.load()
+  index.upsert([{"id": 4, "title": "Robot War", "description": "Robots at war."}])
+  if compact:
+    index.compact()
+  after, hits = searched("robot")
+  assert hits == 1
+  assert sorted(doc_id for doc_id, _ in after) == [1, 4]
@@ -0,0 +1,93 @@
+import threading
+import zlib
+
+import numpy as np
+import pytest
+
+from data.query_encoder import QueryEncoder, check_quantized_model
+
+def vector(text):
+  return np.random.default_rng(zlib.crc32(text.encode())).standard_normal(8).astype(np.float32)
+
+class FakeModel:
+  """Records the batches it encodes; the first call waits for `release`."""
+  def __init__(self, noise=0.0) -> None:
+    self.noise = noise
+    self.batches = []
+    self.started = threading.Event()
+    self.release = threading.Event()
+
+  def encode(self, texts, batch_size=32):
+    self.started.set()
+    assert self.release.wait(10)
+    if "fail" in texts:
+      raise RuntimeError("model failed")
+    self.batches.append(list(texts))
+    return np.array([vector(text) + self.noise * vector(text[::-1]) for text in texts])
+
+def test_queued_queries_share_batches():
+  model = FakeModel()
+  encoder = QueryEncoder(model, wait_ms=0, max_batch=4)
+  first = encoder.submit("first")
+  # the queries arriving while the model is busy are encoded together
+  assert model.started.wait(10)
+  texts = [f"query {i}" for i in range(5)]
+  futures = [encoder.submit(text) for text in texts]
+  model.release.set()
+  np.testing.assert_array_equal(first.result(), vector("first"))
+  for text, future in zip(texts, futures):
+    np.testing.assert_array_equal(future.result(), vector(text))
+  encoder.close()
+  assert model.batches == [["first"], texts[:4], texts[4:]]
+  assert (encoder.batches, encoder.encoded) == (3, 6)
+
+def test_encode_many_from_several_threads():
+  model = FakeModel()
+  model.release.set()
+  encoder = QueryEncoder(model, wait_ms=20, max_batch=16)
+  results = {}
+  def run(worker):
+    texts = [f"worker {worker} query {i}" for i in range(10)]
+    results[worker] = (texts, encoder.encode_many(texts))
+  threads = [threading.Thread(target=run, args=(worker,)) for worker in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  encoder.close()
+
+  for texts, embeddings in results.values():
+    np.testing.assert_array_equal(embeddings, np.array([vector(text) for text in texts]))
+  assert sum(map(len, model.batches)) == 40
+  assert max(map(len, model.batches)) <= 16 and len(model.batches) < 40
+
+def test_model_errors_reach_the_callers():
+  model = FakeModel()
+  model.release.set()
+  encoder = QueryEncoder(model, wait_ms=0)
+  with pytest.raises(RuntimeError, match="model failed"):
+    encoder.encode("fail")
+  np.testing.assert_array_equal(encoder.encode("ok"), vector("ok"))
+  encoder.close()
+
+def test_close_encodes_the_queued_queries():
+  model = FakeModel()
+  encoder = QueryEncoder(model, wait_ms=0, max_batch=2)
+  futures = [encoder.submit(text) for text in ("a", "b", "c")]
+  model.release.set()
+  encoder.close()
+  assert all(future.done() for future in futures)
+  assert not encoder.thread.is_alive()
+
+@pytest.mark.parametrize("precision, max_batch", [("int4", 8), ("float32", 0)])
+def test_invalid_settings(precision, max_batch):
+  with pytest.raises(ValueError):
+    QueryEncoder(FakeModel(), precision, max_batch=max_batch)
+
+def test_check_quantized_model():
+  reference, close, far = FakeModel(), FakeModel(noise=0.01), FakeModel(noise=2.0)
+  for model in (reference, close, far):
+    model.release.set()
+  assert check_quantized_model(reference, close) > 0.99
+  with pytest.raises(ValueError):
+    check_quantized_model(reference, far)
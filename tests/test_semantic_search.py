@@ -0,0 +1,160 @@
+import json
+import os
+import random
+import sys
+import types
+import zlib
+
+import numpy as np
+import pytest
+
+import semantic_search_cli
+from data.ann import IVFIndex
+from data.chunked_semantic_search import ChunkedSemantticSearch
+
+WORDS = ["space", "pirate", "robot", "love", "detective", "ocean", "dragon", "city", "night", "war", "music", "ghost"]
+QUERIES = ["space robot", "a ghost at night", "detective", "ocean dragon war"]
+
+class FakeModel:
+  """A fixed vector per text, and the texts it was asked to encode."""
+  def __init__(self, name=None) -> None:
+    self.encoded = []
+
+  def encode(self, texts, show_progress_bar=False):
+    self.encoded.extend(texts)
+    return np.array([np.random.default_rng(zlib.crc32(text.encode())).standard_normal(8) for text in texts], dtype=np.float32).reshape(-1, 8)
+
+def make_movies(count, seed=0):
+  rng = random.Random(seed)
+  return [
+    {
+      "id": doc_id,
+      "title": " ".join(rng.choices(WORDS, k=2)).title(),
+      # up to 7 sentences, so movies have one to three chunks
+      "description": " ".join(f"{' '.join(rng.choices(WORDS, k=3)).capitalize()}." for _ in range(rng.randint(1, 7))),
+    }
+    for doc_id in range(1, count + 1)
+  ]
+
+def edited(movies):
+  """`movies` with two movies changed, one gone and one new."""
+  movies = [dict(movie) for movie in movies if movie["id"] != 4]
+  movies[0]["description"] = "A submarine. Under the ice. With a ghost. At night. For ever."
+  movies[5]["title"] = "Renamed"
+  return movies + [{"id": 100, "title": "Submarine War", "description": "Robots at sea."}]
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  os.makedirs("cache")
+  os.makedirs("data")
+  return tmp_path
+
+def build(movies, cache_dir="cache", chunks=True):
+  semantic = ChunkedSemantticSearch(cache_dir=cache_dir)
+  semantic.model = FakeModel()
+  os.makedirs(cache_dir, exist_ok=True)
+  if chunks:
+    semantic.build_chunk_embeddings(movies)
+  else:
+    semantic.build_embeddings(movies)
+  return semantic
+
+def opened(cache_dir="cache"):
+  semantic = ChunkedSemantticSearch(cache_dir=cache_dir)
+  semantic.model = FakeModel()
+  # what was saved is enough: the movies given are not read
+  semantic.load_embeddings_to_update([])
+  return semantic
+
+def assert_same_ranking(results, reference):
+  assert [{**result, "score": None} for result in results] == [{**result, "score": None} for result in reference]
+  assert [result["score"] for result in results] == pytest.approx([result["score"] for result in reference])
+
+def assert_same_results(semantic, expected):
+  assert sorted(doc["id"] for doc in semantic.documents) == sorted(doc["id"] for doc in expected.documents)
+  for query in QUERIES:
+    assert_same_ranking(semantic.search(query, 5), expected.search(query, 5))
+    if expected.chunk_embeddings is not None:
+      assert_same_ranking(semantic.search_chunks(query, 5), expected.search_chunks(query, 5))
+
+def test_upsert_and_delete_match_a_fresh_build(workdir):
+  movies = make_movies(30)
+  build(movies)
+  semantic = opened()
+  final = edited(movies)
+  changed = [final[0], final[5], final[-1]]
+  assert semantic.upsert_documents(changed) == changed
+  # only the new texts are encoded
+  assert set(semantic.model.encoded) <= {
+    *(f"{doc['title']}: {doc['description']}" for doc in changed), "A submarine. Under the ice. With a ghost. At night.", "At night. For ever.", "Robots at sea."
+  }
+  assert semantic.delete_documents([4, 4, 999]) == [4]
+  assert semantic.delete_documents([4]) == []
+
+  expected = build(final, "fresh")
+  assert_same_results(semantic, expected)
+  # the updated tables are read back by a new process
+  assert_same_results(opened(), expected)
+
+def test_update_without_chunk_embeddings(workdir):
+  movies = make_movies(10)
+  build(movies, chunks=False)
+  semantic = opened()
+  assert semantic.chunk_embeddings is None
+  added = edited(movies)[-1]
+  semantic.upsert_documents([added])
+  semantic.delete_documents([4])
+  assert not semantic.chunk_table.exists()
+  final = [movie for movie in movies if movie["id"] != 4] + [added]
+  assert_same_results(opened(), build(final, "fresh", chunks=False))
+
+def test_update_needs_loaded_embeddings(workdir):
+  semantic = ChunkedSemantticSearch()
+  with pytest.raises(ValueError):
+    semantic.upsert_documents(make_movies(1))
+  with pytest.raises(ValueError):
+    semantic.delete_documents([1])
+
+def run_cli(monkeypatch, capsys, *argv):
+  monkeypatch.setattr(sys, "argv", ["semantic_search_cli.py", *argv])
+  semantic_search_cli.main()
+  return capsys.readouterr().out.strip()
+
+def test_update_and_delete_commands(workdir, monkeypatch, capsys):
+  monkeypatch.setitem(sys.modules, "sentence_transformers", types.SimpleNamespace(SentenceTransformer=FakeModel))
+  movies = make_movies(20)
+  with open(os.path.join("data", "movies.json"), "w") as f:
+    json.dump({"movies": movies}, f)
+  build(movies)
+
+  final = edited(movies)
+  with open("changed.jsonl", "w") as f:
+    f.writelines(f"{json.dumps(movie)}\n" for movie in [final[0], final[-1]])
+  assert run_cli(monkeypatch, capsys, "update", "changed.jsonl").startswith("Updated 2 movies")
+  assert run_cli(monkeypatch, capsys, "delete", "4", "999") == "Deleted 1 documents"
+
+  final = [final[0], *movies[1:3], *movies[4:], final[-1]]
+  assert_same_results(opened(), build(final, "fresh"))
+
+def test_each_storage_mode_has_its_own_ann_index(workdir):
+  build(make_movies(60))
+  lists = {}
+  for storage in ("int8", "binary", "int8", "float32"):
+    semantic = ChunkedSemantticSearch(storage=storage)
+    semantic.model = FakeModel()
+    semantic.load_chunk_embeddings([])
+    movie_index, chunk_index = semantic.load_or_create_ann_index(), semantic.load_or_create_chunk_ann_index()
+    assert os.path.exists(os.path.join("cache", f"movie_embeddings.{storage}.ivf.npz"))
+    assert os.path.exists(os.path.join("cache", f"chunk_embeddings.{storage}.ivf.npz"))
+    # the lists cluster the vectors searched, at this precision
+    expected = IVFIndex.train(semantic.normalized_embeddings)
+    np.testing.assert_array_equal(movie_index.centroids, expected.centroids)
+    np.testing.assert_array_equal(chunk_index.centroids, IVFIndex.train(semantic.normalized_chunk_embeddings).centroids)
+    lists.setdefault(storage, movie_index.list_rows)
+    np.testing.assert_array_equal(movie_index.list_rows, lists[storage])
+
+def test_ann_index_needs_embeddings(workdir):
+  semantic = build([], chunks=False)
+  with pytest.raises(ValueError, match="without vectors"):
+    semantic.load_or_create_ann_index()
@@ -0,0 +1,80 @@
+import asyncio
+import contextlib
+import os
+import sys
+import threading
+
+import pytest
+
+import semantic_search_cli
+from data.client import request
+from data.query_cache import QueryCache
+from data.server import QueryServer
+
+class StubSemantic:
+  """The parts of ChunkedSemantticSearch a server touches, answering every
+  query with the settings it was asked with."""
+  def __init__(self, storage, rescore) -> None:
+    self.storage = storage
+    self.rescore = rescore
+    self.ann_index = None
+    self.chunk_ann_index = None
+    self.query_encoder = None
+    self.result_cache = QueryCache()
+
+  def search(self, query, limit):
+    return [{"query": query, "limit": limit, "storage": self.storage, "rescore": self.rescore}]
+
+@pytest.fixture
+def server(tmp_path):
+  path = str(tmp_path / "server.sock")
+  started = threading.Event()
+  running = {}
+
+  async def serve():
+    running["loop"], running["stop"] = asyncio.get_running_loop(), asyncio.Event()
+    serving = asyncio.create_task(QueryServer(None, StubSemantic("int8", 50)).serve_forever(path))
+    while not os.path.exists(path):
+      await asyncio.sleep(0.01)
+    started.set()
+    await running["stop"].wait()
+    serving.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+      await serving
+
+  thread = threading.Thread(target=asyncio.run, args=(serve(),))
+  thread.start()
+  assert started.wait(10)
+  yield path
+  running["loop"].call_soon_threadsafe(running["stop"].set)
+  thread.join()
+
+def test_request_without_storage_uses_the_server_settings(server):
+  assert request("search", server, query="q", limit=2, storage=None, rescore=None) == \
+    [{"query": "q", "limit": 2, "storage": "int8", "rescore": 50}]
+  assert request("search", server, query="q", limit=2, storage="int8", rescore=7)[0]["rescore"] == 7
+
+def test_request_for_other_settings_is_answered_locally(server):
+  assert request("search", server, query="q", limit=2, storage="float32") is None
+  assert request("search", server, query="q", limit=2, ann=True) is None
+  with pytest.raises(RuntimeError, match="unknown command"):
+    request("nonsense", server)
+
+def test_request_without_server(tmp_path):
+  assert request("search", str(tmp_path / "missing.sock"), query="q") is None
+
+@pytest.mark.parametrize("argv, storage, rescore", [
+  (["search", "q"], None, None),
+  (["search", "q", "--storage", "binary", "--rescore", "0"], "binary", 0),
+  (["search_chunked", "q"], None, None),
+  (["search_chunked", "q", "--storage", "float16"], "float16", None),
+])
+def test_search_sends_only_the_settings_given(monkeypatch, argv, storage, rescore):
+  sent = []
+  def fake_request(command, **params):
+    sent.append(params)
+    return [{"title": "Title", "description": "Description", "chunk": "Chunk", "score": 1.0}]
+  monkeypatch.setattr(semantic_search_cli, "request", fake_request)
+  monkeypatch.setattr(sys, "argv", ["semantic_search_cli.py", *argv])
+  semantic_search_cli.main()
+  assert (sent[0]["storage"], sent[0]["rescore"]) == (storage, rescore)